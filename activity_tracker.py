@@ -15,6 +15,7 @@ Data Structure:
 - data/activity/test_attempts.json - All test attempts
 - data/activity/activity_logs.json - All system activities
 - data/activity/student_history/ - Per-student history files
+- data/activity/incomplete_attempts.json - Abandoned (expired, never submitted) attempts
 """
 
 import json
@@ -34,6 +35,7 @@ ACTIVITY_DIR = Path("data/activity")
 TEST_ATTEMPTS_FILE = ACTIVITY_DIR / "test_attempts.json"
 ACTIVITY_LOGS_FILE = ACTIVITY_DIR / "activity_logs.json"
 STUDENT_HISTORY_DIR = ACTIVITY_DIR / "student_history"
+INCOMPLETE_ATTEMPTS_FILE = ACTIVITY_DIR / "incomplete_attempts.json"
 
 # Ensure directories exist
 ACTIVITY_DIR.mkdir(parents=True, exist_ok=True)
@@ -161,6 +163,56 @@ def _save_attempts_file(attempts: List[dict]):
         log.error(f"Error saving attempts file: {e}")
 
 
+def save_incomplete_attempts(records: List[dict]) -> int:
+    """
+    Archive abandoned attempts (sessions expired without submission) in one write.
+    Kept apart from test_attempts.json so scores and statistics are unaffected.
+    """
+    if not records:
+        return 0
+    try:
+        attempts = json.loads(INCOMPLETE_ATTEMPTS_FILE.read_text(encoding="utf-8")) \
+            if INCOMPLETE_ATTEMPTS_FILE.exists() else []
+    except Exception as e:
+        log.error(f"Error loading incomplete attempts file: {e}")
+        attempts = []
+
+    attempts.extend(records)
+    if len(attempts) > 10000:
+        attempts = attempts[-10000:]
+
+    try:
+        INCOMPLETE_ATTEMPTS_FILE.write_text(
+            json.dumps(attempts, ensure_ascii=False, indent=2),
+            encoding="utf-8"
+        )
+    except Exception as e:
+        log.error(f"Error saving incomplete attempts file: {e}")
+        return 0
+
+    log_activity(action="tests_abandoned", details={
+        "count": len(records),
+        "tests": sorted({r.get("test_id") for r in records if r.get("test_id")}),
+    })
+    return len(records)
+
+
+def get_incomplete_attempts(test_id: str = None, limit: int = None) -> List[dict]:
+    """Abandoned attempts, most recent first (optionally for one test)"""
+    if not INCOMPLETE_ATTEMPTS_FILE.exists():
+        return []
+    try:
+        attempts = json.loads(INCOMPLETE_ATTEMPTS_FILE.read_text(encoding="utf-8"))
+    except Exception as e:
+        log.error(f"Error loading incomplete attempts file: {e}")
+        return []
+
+    if test_id:
+        attempts = [a for a in attempts if a.get("test_id") == test_id]
+    attempts.sort(key=lambda x: x.get("expired_at", 0), reverse=True)
+    return attempts[:limit] if limit else attempts
+
+
 # ==================================================================================
 # ACTIVITY LOGGING
 # ==================================================================================
@@ -171,7 +223,7 @@ def log_activity(action: str, user_id: int = None, details: dict = None):
 
     Actions:
     - test_created, test_activated, test_deactivated, test_deleted
-    - test_completed, test_started, test_resumed
+    - test_completed, test_started, test_resumed, tests_abandoned
     - admin_added, admin_removed
     - group_added, group_removed, group_synced
     - student_added, student_viewed
@@ -245,6 +297,22 @@ def get_student_attempts(user_id: int, limit: int = None) -> List[dict]:
         return []
 
 
+def get_attempt(attempt_id: str) -> Optional[dict]:
+    """Get one attempt by its attempt_id (student history first, then master file)"""
+    try:
+        user_id = int(str(attempt_id).split("_", 1)[0])
+        for attempt in get_student_attempts(user_id):
+            if attempt.get("attempt_id") == attempt_id:
+                return attempt
+    except (ValueError, TypeError):
+        pass
+
+    for attempt in reversed(_load_attempts_file()):
+        if attempt.get("attempt_id") == attempt_id:
+            return attempt
+    return None
+
+
 def get_test_attempts(test_id: str, limit: int = None) -> List[dict]:
     """Get all attempts for a specific test"""
     all_attempts = _load_attempts_file()
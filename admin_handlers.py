@@ -28,6 +28,8 @@ from utils import (
     get_bot_admin_groups
 )
 from aiogram.utils.exceptions import MessageNotModified
+from delivery_modes import DELIVERY_MODES, get_delivery_mode, next_delivery_mode, set_delivery_mode
+from exam_deadlines import describe_limits
 
 # Add logging
 log = logging.getLogger("admin_handlers")
@@ -993,6 +995,8 @@ def _test_actions_kb(tid: str, active: bool, is_admin_view: bool) -> types.Inlin
     else:
         kb.add(types.InlineKeyboardButton("🟢 Faollashtirish", callback_data=f"t:act:{tid}"))
     kb.add(types.InlineKeyboardButton("📌 Guruhlarga tayinlash", callback_data=f"t:assign:{tid}"))
+    kb.add(types.InlineKeyboardButton("📨 Yetkazish usulini almashtirish", callback_data=f"t:mode:{tid}"))
+    kb.add(types.InlineKeyboardButton("🔀 Aralashtirishni yoqish/o‘chirish", callback_data=f"t:shuffle:{tid}"))
     kb.add(types.InlineKeyboardButton("🗑 O‘chirish", callback_data=f"t:del:{tid}"))
 
     back_to = "admin:tests" if is_admin_view else "panel:tests"
@@ -1079,7 +1083,14 @@ async def _open_test(cb: types.CallbackQuery, tid: str):
     # Show group names here if you like (see Fix 3)
     is_admin_view = (cb.data or "").startswith("admin_t:")
 
-    text = f"<b>{name}</b>\n<code>{tid}</code>\n\n<b>Status:</b> {'🟢 FAOL' if active else '🔴 NOFAOL'}"
+    test = read_test(tid)
+    mode = get_delivery_mode(test)
+    text = (
+        f"<b>{name}</b>\n<code>{tid}</code>\n\n<b>Status:</b> {'🟢 FAOL' if active else '🔴 NOFAOL'}\n"
+        f"<b>Yetkazish:</b> {DELIVERY_MODES[mode]}\n"
+        f"<b>Vaqt:</b> {describe_limits(test)}\n"
+        f"<b>Aralashtirish:</b> {'🔀 yoqilgan' if (test or {}).get('shuffle') else 'o‘chirilgan'}"
+    )
     try:
         await cb.message.edit_text(text, reply_markup=_test_actions_kb(tid, active, is_admin_view))
     except MessageNotModified:
@@ -1370,6 +1381,8 @@ async def cb_test_action(cb: types.CallbackQuery, state: FSMContext):
       - t:view:<tid>
       - t:act:<tid> / t:deact:<tid>  (✅ endi UIga yo'naltiriladi)
       - t:assign:<tid>               (assign UI)
+      - t:mode:<tid>                 (savol yetkazish usuli: message → edit → ...)
+      - t:shuffle:<tid>              (savol/variant tartibini aralashtirish)
       - t:del:<tid> / t:delconfirm:<tid>
     """
     from utils import is_owner, is_admin, can_user_manage_test, load_tests_index, save_tests_index, test_path, read_test
@@ -1448,6 +1461,24 @@ async def cb_test_action(cb: types.CallbackQuery, state: FSMContext):
         await cb.answer("O'chirildi")
         return await cb_panel_tests(cb)
 
+    # ----- delivery mode (cycle) -----
+    if action == "mode":
+        mode = next_delivery_mode(get_delivery_mode(read_test(tid)))
+        if not set_delivery_mode(tid, mode):
+            return await cb.answer("Test topilmadi", show_alert=True)
+        log_action(cb.from_user.id, "test_delivery_mode", ok=True, test_id=tid, note=mode)
+        return await _refresh_to_test(cb, tid, DELIVERY_MODES[mode])
+
+    # ----- per-attempt shuffling (toggle) -----
+    if action == "shuffle":
+        test = read_test(tid)
+        if not test:
+            return await cb.answer("Test topilmadi", show_alert=True)
+        test["shuffle"] = not test.get("shuffle")
+        write_test(tid, test)
+        log_action(cb.from_user.id, "test_shuffle", ok=True, test_id=tid, note=str(test["shuffle"]))
+        return await _refresh_to_test(cb, tid, "🔀 Aralashtirish yoqildi" if test["shuffle"] else "Aralashtirish o‘chirildi")
+
     # ----- assign (OPEN UI) -----
     if action == "assign":
         await cb.answer()
@@ -0,0 +1,417 @@
+"""
+ADMIN COMPLETION REPORTS
+
+How each admin receives "student finished a test" reports:
+
+- immediate : full HTML review per student (the old behaviour)
+- digest    : completions are queued and sent every N minutes as one
+              compact table (or a CSV file for large batches)
+- summary   : completions are queued until the test is deactivated,
+              then sent as one end-of-test summary
+
+Digest rows carry a "📄" button (rv:<attempt_id>) that rebuilds the full
+review from the stored attempt on demand; /review <attempt_id> does the same.
+
+Data:
+- data/report_prefs.json : {admin_id: {"mode", "interval", "last_flush"}}
+- data/report_queue.json : {admin_id: [completion, ...]}
+"""
+
+import asyncio
+import csv
+import html
+import io
+import logging
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiogram import types
+
+from utils import read_json, write_json, is_admin, get_active_tests, can_view_student_results
+
+log = logging.getLogger("admin_reports")
+
+PREFS_FILE = Path("data/report_prefs.json")
+QUEUE_FILE = Path("data/report_queue.json")
+
+MODES = ("immediate", "digest", "summary")
+DEFAULT_MODE = "immediate"
+DEFAULT_INTERVAL_MIN = 30
+DIGEST_INTERVALS = (15, 30, 60)
+FLUSH_CHECK_SECONDS = 60
+MAX_TABLE_ROWS = 20          # above this the digest goes out as a CSV file
+
+MODE_LABELS = {
+    "immediate": "Darhol (har bir talaba)",
+    "digest": "Jamlanma (har {n} daqiqada)",
+    "summary": "Test yakunida umumiy",
+}
+
+_queue_lock = asyncio.Lock()
+
+
+# ---------- preferences ----------
+
+def _load_prefs() -> Dict[str, dict]:
+    return read_json(PREFS_FILE, {})
+
+
+def get_report_pref(admin_id: int) -> dict:
+    pref = _load_prefs().get(str(admin_id)) or {}
+    mode = pref.get("mode") if pref.get("mode") in MODES else DEFAULT_MODE
+    return {
+        "mode": mode,
+        "interval": int(pref.get("interval") or DEFAULT_INTERVAL_MIN),
+        "last_flush": pref.get("last_flush", 0),
+    }
+
+
+def get_report_mode(admin_id: int) -> str:
+    return get_report_pref(admin_id)["mode"]
+
+
+def set_report_mode(admin_id: int, mode: str, interval: Optional[int] = None):
+    if mode not in MODES:
+        raise ValueError(f"Unknown report mode: {mode}")
+    prefs = _load_prefs()
+    pref = prefs.get(str(admin_id)) or {}
+    pref["mode"] = mode
+    if interval:
+        pref["interval"] = max(1, int(interval))
+    pref.setdefault("last_flush", int(time.time()))
+    prefs[str(admin_id)] = pref
+    write_json(PREFS_FILE, prefs)
+
+
+def _touch_last_flush(admin_id: int):
+    prefs = _load_prefs()
+    pref = prefs.get(str(admin_id)) or {}
+    pref["last_flush"] = int(time.time())
+    prefs[str(admin_id)] = pref
+    write_json(PREFS_FILE, prefs)
+
+
+def describe_mode(pref: dict) -> str:
+    return MODE_LABELS[pref["mode"]].format(n=pref["interval"])
+
+
+# ---------- queue ----------
+
+async def queue_completion(admin_id: int, record: dict):
+    """Hold one completion for the admin's next digest/summary."""
+    async with _queue_lock:
+        queue = read_json(QUEUE_FILE, {})
+        first = not queue.get(str(admin_id))
+        queue.setdefault(str(admin_id), []).append(record)
+        write_json(QUEUE_FILE, queue)
+    if first:
+        # Digest window starts with the first queued completion
+        _touch_last_flush(admin_id)
+
+
+async def _take_records(admin_id: int, test_ids: Optional[set] = None) -> List[dict]:
+    """Remove and return queued records of an admin (optionally only for some tests)."""
+    async with _queue_lock:
+        queue = read_json(QUEUE_FILE, {})
+        records = queue.get(str(admin_id), [])
+        if test_ids is None:
+            taken, kept = records, []
+        else:
+            taken = [r for r in records if r.get("test_id") in test_ids]
+            kept = [r for r in records if r.get("test_id") not in test_ids]
+        if kept:
+            queue[str(admin_id)] = kept
+        else:
+            queue.pop(str(admin_id), None)
+        if taken:
+            write_json(QUEUE_FILE, queue)
+        return taken
+
+
+# ---------- rendering ----------
+
+def _fmt_time(ts) -> str:
+    try:
+        return datetime.fromtimestamp(float(ts)).strftime("%H:%M")
+    except Exception:
+        return "—"
+
+
+def _render_table(records: List[dict], title: str) -> str:
+    by_test: Dict[str, List[dict]] = {}
+    for r in records:
+        by_test.setdefault(r.get("test_id") or "", []).append(r)
+
+    parts = [f"📊 <b>{html.escape(title)}</b> — {len(records)} ta natija"]
+    n = 0
+    for test_id, rows in by_test.items():
+        avg = sum(r.get("pct", 0) for r in rows) / len(rows)
+        parts.append("")
+        parts.append(f"🧪 <b>{html.escape(rows[0].get('test_name') or test_id)}</b> "
+                     f"(o'rtacha {avg:.1f}%)")
+        table = [f"{'#':>2} {'Talaba':<18} {'Ball':>7} {'%':>5} {'Vaqt':>5}"]
+        for r in rows:
+            n += 1
+            name = (r.get("student_name") or "—")[:18]
+            score = f"{r.get('ok', 0)}/{r.get('total', 0)}"
+            table.append(f"{n:>2} {name:<18} {score:>7} {r.get('pct', 0):>5.0f} {_fmt_time(r.get('finished_at')):>5}")
+        parts.append("<pre>" + html.escape("\n".join(table)) + "</pre>")
+    return "\n".join(parts)
+
+
+def _review_keyboard(records: List[dict]) -> Optional[types.InlineKeyboardMarkup]:
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    for n, r in enumerate(records, 1):
+        data = f"rv:{r.get('attempt_id')}"
+        if not r.get("attempt_id") or len(data.encode()) > 64:
+            continue
+        name = (r.get("student_name") or "—")[:20]
+        buttons.append(types.InlineKeyboardButton(f"📄 {n}. {name}", callback_data=data))
+    if not buttons:
+        return None
+    kb.add(*buttons)
+    return kb
+
+
+def _render_csv(records: List[dict]) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["Test", "Student", "Username", "Score", "Total", "Percentage",
+                     "Duration (min)", "Finished", "Attempt ID"])
+    for r in records:
+        writer.writerow([
+            r.get("test_name"), r.get("student_name"), r.get("username") or "",
+            r.get("ok"), r.get("total"), r.get("pct"), r.get("duration_min"),
+            datetime.fromtimestamp(float(r.get("finished_at") or 0)).strftime("%Y-%m-%d %H:%M"),
+            r.get("attempt_id") or "",
+        ])
+    return buf.getvalue()
+
+
+async def _send_digest(admin_id: int, records: List[dict], title: str):
+    from outbox import deliver
+
+    records.sort(key=lambda r: (r.get("test_id") or "", r.get("finished_at") or 0))
+    key = f"digest:{admin_id}:{records[0].get('attempt_id')}:{records[-1].get('attempt_id')}:{len(records)}"
+
+    if len(records) <= MAX_TABLE_ROWS:
+        text = _render_table(records, title)
+        kb = _review_keyboard(records)
+        extra = {"reply_markup": kb.to_python()} if kb else {}
+        await deliver(key, admin_id, chunks=[text], **extra)
+    else:
+        stamp = datetime.now().strftime("%Y%m%d_%H%M")
+        await deliver(key, admin_id, document={
+            "filename": f"natijalar_{stamp}.csv",
+            "content": _render_csv(records),
+            "caption": (f"📊 {title}: {len(records)} ta natija.\n"
+                        "To'liq tahlil: /review &lt;Attempt ID&gt;"),
+        })
+
+
+# ---------- flushing ----------
+
+async def flush_admin(admin_id: int, test_ids: Optional[set] = None, title: str = "Natijalar jamlanmasi") -> int:
+    records = await _take_records(admin_id, test_ids)
+    if records:
+        await _send_digest(admin_id, records, title)
+    _touch_last_flush(admin_id)
+    return len(records)
+
+
+async def flush_due_reports() -> int:
+    """Send every digest whose interval passed and every summary of a closed test."""
+    queue = read_json(QUEUE_FILE, {})
+    if not queue:
+        return 0
+
+    sent = 0
+    now = time.time()
+    active = set(get_active_tests())
+    for admin_key, records in queue.items():
+        try:
+            admin_id = int(admin_key)
+        except ValueError:
+            continue
+        if not records:
+            continue
+        pref = get_report_pref(admin_id)
+        try:
+            if pref["mode"] == "digest":
+                if now - pref["last_flush"] >= pref["interval"] * 60:
+                    sent += await flush_admin(admin_id)
+            elif pref["mode"] == "summary":
+                closed = {r.get("test_id") for r in records if r.get("test_id") not in active}
+                if closed:
+                    sent += await flush_admin(admin_id, closed, title="Test yakuni bo'yicha natijalar")
+            else:
+                # Switched back to immediate: don't keep anything behind
+                sent += await flush_admin(admin_id)
+        except Exception as e:
+            log.error(f"Report flush failed for admin {admin_id}: {e}")
+    return sent
+
+
+async def report_digest_loop():
+    while True:
+        try:
+            await flush_due_reports()
+        except Exception as e:
+            log.error(f"Report digest loop error: {e}")
+        await asyncio.sleep(FLUSH_CHECK_SECONDS)
+
+
+# ---------- full review on demand ----------
+
+def build_attempt_review(attempt: dict) -> str:
+    from student_handlers import _review_lines
+    from utils import read_test
+
+    test = read_test(attempt.get("test_id")) or {}
+    if not test.get("answers"):
+        test = dict(test, answers=attempt.get("correct_answers") or {})
+    lines, _ = _review_lines(attempt.get("answers") or {}, test)
+
+    wrong_attempts = attempt.get("wrong_attempts") or {}
+    if wrong_attempts:
+        lines.append("")
+        lines.append("<b>📊 Urinishlar statistikasi:</b>")
+        for q_idx, attempts in wrong_attempts.items():
+            lines.append(f"Savol {q_idx}: {attempts + 1} ta urinish")
+
+    minutes = int((attempt.get("time_spent_seconds") or 0) / 60)
+    header = (
+        "📊 <b>Test natijasi</b>\n\n"
+        f"👤 Talaba: {html.escape(str(attempt.get('student_name') or '—'))}\n"
+        f"🧪 Test: {html.escape(str(attempt.get('test_name') or '—'))}\n"
+        f"⏱ Vaqt: {minutes} daqiqa\n\n"
+    )
+    return header + "\n".join(lines)
+
+
+async def send_attempt_review(chat_id: int, attempt_id: str) -> bool:
+    from activity_tracker import get_attempt
+    from review_render import get_review, send_review
+    from config import bot
+
+    if get_review(attempt_id) is not None:
+        await send_review(bot, chat_id, attempt_id)
+        return True
+    attempt = get_attempt(attempt_id)
+    if not attempt:
+        return False
+    await send_review(bot, chat_id, attempt_id, build_attempt_review(attempt))
+    return True
+
+
+# ---------- handlers ----------
+
+def _mode_keyboard(pref: dict) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup(row_width=1)
+
+    def mark(on: bool) -> str:
+        return "✅ " if on else ""
+
+    kb.add(types.InlineKeyboardButton(
+        mark(pref["mode"] == "immediate") + MODE_LABELS["immediate"], callback_data="rmode:immediate"))
+    for n in DIGEST_INTERVALS:
+        on = pref["mode"] == "digest" and pref["interval"] == n
+        kb.add(types.InlineKeyboardButton(
+            mark(on) + MODE_LABELS["digest"].format(n=n), callback_data=f"rmode:digest:{n}"))
+    kb.add(types.InlineKeyboardButton(
+        mark(pref["mode"] == "summary") + MODE_LABELS["summary"], callback_data="rmode:summary"))
+    return kb
+
+
+async def cmd_report_mode(message: types.Message):
+    """/reportmode [immediate | digest <min> | summary]"""
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        return await message.reply("Faqat adminlar uchun.")
+
+    args = (message.get_args() or "").split()
+    if args:
+        mode = args[0].lower()
+        interval = None
+        if mode == "digest" and len(args) > 1:
+            try:
+                interval = int(args[1])
+            except ValueError:
+                return await message.reply("Masalan: /reportmode digest 30")
+        if mode not in MODES:
+            return await message.reply("Rejimlar: immediate, digest &lt;daqiqa&gt;, summary")
+        set_report_mode(user_id, mode, interval)
+
+    pref = get_report_pref(user_id)
+    await message.reply(
+        f"📬 <b>Natija hisobotlari</b>\n\nHozirgi rejim: <b>{describe_mode(pref)}</b>",
+        reply_markup=_mode_keyboard(pref),
+    )
+
+
+async def cb_report_mode(cb: types.CallbackQuery):
+    user_id = cb.from_user.id
+    if not is_admin(user_id):
+        return await cb.answer("Faqat adminlar uchun", show_alert=True)
+
+    parts = (cb.data or "").split(":")
+    mode = parts[1] if len(parts) > 1 else ""
+    interval = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else None
+    if mode not in MODES:
+        return await cb.answer("Noma'lum rejim")
+
+    set_report_mode(user_id, mode, interval)
+    if mode == "immediate":
+        await flush_admin(user_id)
+
+    pref = get_report_pref(user_id)
+    try:
+        await cb.message.edit_text(
+            f"📬 <b>Natija hisobotlari</b>\n\nHozirgi rejim: <b>{describe_mode(pref)}</b>",
+            reply_markup=_mode_keyboard(pref),
+        )
+    except Exception:
+        pass
+    await cb.answer("Saqlandi ✅")
+
+
+def _attempt_student(attempt_id: str) -> Optional[int]:
+    """Whose attempt this is, from the stored attempt (not from the id's shape)."""
+    from activity_tracker import get_attempt
+    attempt = get_attempt(attempt_id)
+    if not attempt or attempt.get("user_id") is None:
+        return None
+    return int(attempt["user_id"])
+
+
+async def cb_attempt_review(cb: types.CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        return await cb.answer("Faqat adminlar uchun", show_alert=True)
+    attempt_id = (cb.data or "")[len("rv:"):]
+    student_id = _attempt_student(attempt_id)
+    if student_id is None:
+        return await cb.answer("❌ Urinish topilmadi.", show_alert=True)
+    if not can_view_student_results(cb.from_user.id, student_id):
+        return await cb.answer("Ruxsat yo'q", show_alert=True)
+    await cb.answer("⏳ Yuklanmoqda...")
+    if not await send_attempt_review(cb.message.chat.id, attempt_id):
+        await cb.message.answer("❌ Urinish topilmadi.")
+
+
+async def cmd_review(message: types.Message):
+    """/review <attempt_id>"""
+    if not is_admin(message.from_user.id):
+        return await message.reply("Faqat adminlar uchun.")
+    attempt_id = (message.get_args() or "").strip()
+    if not attempt_id:
+        return await message.reply("Foydalanish: /review &lt;attempt_id&gt;")
+    student_id = _attempt_student(attempt_id)
+    if student_id is None:
+        return await message.reply("❌ Urinish topilmadi.")
+    if not can_view_student_results(message.from_user.id, student_id):
+        return await message.reply("Bu o'quvchining natijalarini ko'rishga ruxsat yo'q.")
+    if not await send_attempt_review(message.chat.id, attempt_id):
+        await message.reply("❌ Urinish topilmadi.")
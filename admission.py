@@ -0,0 +1,227 @@
+"""
+ADMISSION CONTROL
+
+When a test is activated for big groups, hundreds of students press /start
+within seconds. Each start does Telegram membership checks and reads the
+group/test files, so they are admitted through one controller:
+
+- at most ADMISSION_MAX_CONCURRENT heavyweight starts run at once
+- new starts are admitted at ADMISSION_RATE per second (token bucket)
+- the rest wait in a FIFO queue and get a "siz navbatda #N" message that is
+  edited in place as the queue moves (notification lane, coarse positions,
+  so the edits themselves don't flood the outbound budget)
+- a user already waiting is not queued twice; beyond ADMISSION_MAX_QUEUE new
+  starts are turned away with "keyinroq urinib ko'ring"
+
+Usage:
+    from admission import admit
+    await admit(message, student_start, message, state)
+
+Queue depth, in-flight starts and admission wait: get_admission_metrics()
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from aiogram import types
+
+from ordered_dispatch import worker_idle
+from outbound import TokenBucket, dispatch
+
+log = logging.getLogger("admission")
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "8"))
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "5"))          # starts/s
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1000"))
+POSITION_UPDATE_EVERY = 5.0    # seconds between position edits of one message
+
+QUEUED_TEXT = "⏳ Hozir ko'pchilik testni boshlayapti.\nSiz navbatda: <b>#{pos}</b>. Tez orada boshlaymiz..."
+ALREADY_QUEUED_TEXT = "⏳ Siz allaqachon navbatdasiz. Iltimos, kuting."
+BUSY_TEXT = "🚦 Hozir juda band. Iltimos, 1 daqiqadan keyin /start ni bosing."
+
+
+def _shown_position(pos: int) -> int:
+    """Exact near the front, rounded up to 10s further back (fewer edits)."""
+    return pos if pos <= 10 else (pos + 9) // 10 * 10
+
+
+class _Waiter:
+    __slots__ = ("future", "chat_id", "enqueued_at", "message", "shown", "updated_at", "admitted")
+
+    def __init__(self, chat_id: int):
+        self.future = asyncio.get_event_loop().create_future()
+        self.chat_id = chat_id
+        self.enqueued_at = time.monotonic()
+        self.message: Optional[types.Message] = None
+        self.shown = 0
+        self.updated_at = 0.0
+        self.admitted = False       # set by the worker when it takes a slot for us
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT, rate: float = ADMISSION_RATE,
+                 max_queue: int = ADMISSION_MAX_QUEUE):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(1, int(max_queue))
+        self.bucket = TokenBucket(rate, capacity=self.max_concurrent)
+        self._queue: "OrderedDict[int, _Waiter]" = OrderedDict()    # user_id -> waiter, FIFO
+        self._inflight = 0
+        self._slot_freed: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._metrics = {"admitted": 0, "queued": 0, "rejected": 0, "wait_avg": 0.0, "wait_max": 0.0}
+
+    def _ensure_worker(self):
+        if self._slot_freed is None:
+            self._slot_freed = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def run(self, sender, func: Callable, *args, **kwargs) -> Any:
+        """Run `func(*args, **kwargs)` for the user of `sender` once admitted."""
+        user = sender.from_user
+        chat_id = sender.message.chat.id if isinstance(sender, types.CallbackQuery) else sender.chat.id
+
+        if user.id in self._queue:
+            self._metrics["rejected"] += 1
+            await self._reply(sender, chat_id, ALREADY_QUEUED_TEXT)
+            return None
+
+        waiter: Optional[_Waiter] = None
+        if not self._queue and self._inflight < self.max_concurrent and self.bucket.try_acquire():
+            self._inflight += 1
+            self._record_wait(0.0)
+        else:
+            if len(self._queue) >= self.max_queue:
+                self._metrics["rejected"] += 1
+                await self._reply(sender, chat_id, BUSY_TEXT)
+                return None
+            waiter = _Waiter(chat_id)
+
+        # Every await after this point may be cancelled; the finally below is
+        # the one place that gives the slot back (or leaves the queue)
+        try:
+            if waiter is not None:
+                # Waiting in line is not work: free the update worker meanwhile
+                async with worker_idle():
+                    await self._wait(user.id, waiter)
+                await self._clear_position(user.id, waiter)
+            return await func(*args, **kwargs)
+        finally:
+            if waiter is None or waiter.admitted:
+                self._release()
+            elif self._queue.get(user.id) is waiter:
+                del self._queue[user.id]    # left before its turn
+
+    def _release(self):
+        self._inflight -= 1
+        if self._slot_freed is not None:
+            self._slot_freed.set()
+
+    async def _wait(self, user_id: int, waiter: _Waiter):
+        """Queue the user; returns once the worker has admitted them (slot taken)."""
+        self._queue[user_id] = waiter
+        self._metrics["queued"] += 1
+        self._ensure_worker()
+        self._slot_freed.set()
+        await self._update_position(waiter, len(self._queue))
+        await waiter.future
+
+    async def _clear_position(self, user_id: int, waiter: _Waiter):
+        if waiter.message is not None:
+            try:
+                await dispatch("interactive", waiter.message.delete)
+            except Exception as e:
+                log.debug(f"Queue message cleanup failed for {user_id}: {e}")
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            if self._inflight >= self.max_concurrent:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            await self.bucket.acquire()
+            if not self._queue:
+                continue
+            user_id, waiter = self._queue.popitem(last=False)
+            # Slot is taken here, before the admitted coroutine gets to run
+            self._inflight += 1
+            waiter.admitted = True
+            self._record_wait(time.monotonic() - waiter.enqueued_at)
+            if not waiter.future.done():
+                waiter.future.set_result(True)
+            self._refresh_positions()
+
+    def _refresh_positions(self):
+        now = time.monotonic()
+        for pos, waiter in enumerate(self._queue.values(), start=1):
+            if (waiter.message is not None and _shown_position(pos) != waiter.shown
+                    and now - waiter.updated_at >= POSITION_UPDATE_EVERY):
+                asyncio.ensure_future(self._update_position(waiter, pos))
+
+    async def _update_position(self, waiter: _Waiter, pos: int):
+        from config import bot
+        shown = _shown_position(pos)
+        waiter.shown, waiter.updated_at = shown, time.monotonic()
+        text = QUEUED_TEXT.format(pos=shown)
+        try:
+            if waiter.message is None:
+                waiter.message = await dispatch("interactive", bot.send_message, waiter.chat_id, text)
+            else:
+                await dispatch("notification", waiter.message.edit_text, text)
+        except Exception as e:
+            log.debug(f"Queue position update failed for chat {waiter.chat_id}: {e}")
+
+    async def _reply(self, sender, chat_id: int, text: str):
+        from config import bot
+        try:
+            if isinstance(sender, types.CallbackQuery):
+                await dispatch("interactive", sender.answer, text, show_alert=True)
+            else:
+                await dispatch("interactive", bot.send_message, chat_id, text)
+        except Exception as e:
+            log.debug(f"Admission reply failed for chat {chat_id}: {e}")
+
+    def _record_wait(self, wait: float):
+        m = self._metrics
+        m["wait_avg"] = wait if m["admitted"] == 0 else (m["wait_avg"] * 0.9 + wait * 0.1)
+        m["wait_max"] = max(m["wait_max"], wait)
+        m["admitted"] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        oldest = (time.monotonic() - next(iter(self._queue.values())).enqueued_at) if self._queue else 0.0
+        return {
+            "depth": len(self._queue),
+            "inflight": self._inflight,
+            "oldest_wait": round(oldest, 3),
+            "wait_avg": round(self._metrics["wait_avg"], 3),
+            "wait_max": round(self._metrics["wait_max"], 3),
+            "admitted": self._metrics["admitted"],
+            "queued": self._metrics["queued"],
+            "rejected": self._metrics["rejected"],
+        }
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController()
+    return _controller
+
+
+async def admit(sender, func: Callable, *args, **kwargs) -> Any:
+    return await get_admission_controller().run(sender, func, *args, **kwargs)
+
+
+def get_admission_metrics() -> Dict[str, Any]:
+    return get_admission_controller().metrics()
@@ -0,0 +1,278 @@
+"""
+ANSWER SHEET (exam mode)
+
+"sheet" delivery mode for formal exams: instead of one round trip per
+question with learning-mode retries, the student gets
+
+- all questions as ONE HTML document (identical bytes for every student,
+  so it is uploaded once and re-sent by file_id, see file_cache; shuffled
+  tests get a per-attempt document)
+- one answer-sheet message with a compact toggle keyboard, 10 questions
+  per page; marks can be changed freely until submission
+- or a text message like "1a 2c 3b" / "1a2c3b" that fills many marks at once
+
+Marks are stored canonical (see shuffle.py); the sheet shows them in the
+attempt's own order and letters.
+
+Nothing is scored until "Topshirish": then _finish_test scores the whole
+sheet in one pass (score_user_answers) and sends the usual review/reports.
+
+Callback data:
+    sh:m:<q>:<opt>   – mark / unmark option <opt> of question <q>
+    sh:p:<page>      – show sheet page
+    sh:submit        – ask for confirmation
+    sh:confirm       – submit and score
+    sh:noop          – question number label
+"""
+
+import html
+import logging
+import re
+from typing import Dict, Optional, Tuple
+
+from aiogram import types
+from aiogram.dispatcher import FSMContext
+from aiogram.utils.exceptions import MessageNotModified
+
+from file_cache import send_cached_document
+from exam_deadlines import finish_expired, is_expired
+from outbound import dispatch
+from question_compiler import OPTION_KEYS, get_compiled, render_question
+from shuffle import AttemptShuffle, get_attempt_shuffle
+
+log = logging.getLogger("answer_sheet")
+
+SHEET_PAGE_SIZE = 10
+
+_MARK_RE = re.compile(r"(\d+)\s*[-.):]?\s*([a-dA-D])")
+_SHEET_TEXT_RE = re.compile(r"^\s*(?:\d+\s*[-.):]?\s*[a-dA-D][\s,;]*)+$")
+
+
+def is_sheet_text(text: str) -> bool:
+    return bool(text) and bool(_SHEET_TEXT_RE.match(text))
+
+
+def parse_marks(text: str, total: int) -> Dict[str, str]:
+    """'1a 2c3-b' → {'1': 'A', '2': 'C', '3': 'B'}; numbers outside 1..total are ignored."""
+    marks = {}
+    for num, opt in _MARK_RE.findall(text or ""):
+        if 1 <= int(num) <= total:
+            marks[str(int(num))] = opt.upper()
+    return marks
+
+
+def build_question_sheet(test: dict, shuffle: Optional[AttemptShuffle] = None) -> str:
+    """
+    All questions of the test as one HTML document (from the compiled form).
+    Shuffled attempts get their own order/letters (and so their own upload).
+    """
+    blocks = []
+    for position in range(1, len(get_compiled(test)["questions"]) + 1):
+        if shuffle:
+            canon = shuffle.question(position)
+            rendered = render_question(test, canon, number=position, option_order=shuffle.option_order(canon))
+        else:
+            rendered = render_question(test, position)
+        if rendered is None:
+            continue
+        lead_chunks, text = rendered
+        body = "\n".join(lead_chunks + [text])
+        blocks.append(f'<div style="white-space: pre-wrap; margin-bottom: 1.5em">{body}</div>')
+    name = html.escape(test.get("test_name") or "Test")
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+        f"<title>{name}</title></head><body>"
+        f"<h2>{name}</h2>" + "<hr>".join(blocks) + "</body></html>"
+    )
+
+
+def _sheet_text(test: dict, answers: Dict[str, str], total: int) -> str:
+    marked = sum(1 for k in answers if k.isdigit() and 1 <= int(k) <= total)
+    return (
+        f"📝 <b>Javoblar varaqasi</b> — {test.get('test_name') or 'Test'}\n\n"
+        f"Belgilangan: <b>{marked}/{total}</b>\n\n"
+        "Savollar ilovadagi faylda. Javobni tugmalar bilan belgilang yoki "
+        "<code>1a 2c 3b</code> ko'rinishida xabar yuboring. "
+        "Topshirguncha javoblarni o'zgartirish mumkin."
+    )
+
+
+def _sheet_keyboard(answers: Dict[str, str], total: int, page: int) -> types.InlineKeyboardMarkup:
+    pages = max(1, (total + SHEET_PAGE_SIZE - 1) // SHEET_PAGE_SIZE)
+    page = max(0, min(page, pages - 1))
+    kb = types.InlineKeyboardMarkup(row_width=5)
+    first = page * SHEET_PAGE_SIZE + 1
+    for q in range(first, min(total, first + SHEET_PAGE_SIZE - 1) + 1):
+        marked = answers.get(str(q))
+        row = [types.InlineKeyboardButton(f"{q}.", callback_data="sh:noop")]
+        for opt in OPTION_KEYS:
+            label = f"✅{opt}" if marked == opt else opt
+            row.append(types.InlineKeyboardButton(label, callback_data=f"sh:m:{q}:{opt}"))
+        kb.row(*row)
+
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("◀️", callback_data=f"sh:p:{page - 1}"))
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="sh:noop"))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton("▶️", callback_data=f"sh:p:{page + 1}"))
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("📤 Topshirish", callback_data="sh:submit"))
+    return kb
+
+
+def _total(test: dict, s: dict) -> int:
+    return int(s.get("total_q") or len(test.get("questions") or []))
+
+
+def _shown(answers: Dict[str, str], shuffle: Optional[AttemptShuffle]) -> Dict[str, str]:
+    """Stored (canonical) answers as the sheet shows them: {position: letter}."""
+    return shuffle.marks_to_display(answers) if shuffle else answers
+
+
+def _canonical(shuffle: Optional[AttemptShuffle], position: int, letter: str) -> Tuple[str, Optional[str]]:
+    if not shuffle:
+        return str(position), letter
+    qidx = shuffle.question(position)
+    return str(qidx), shuffle.to_canonical(qidx, letter)
+
+
+async def send_sheet(sender, state: FSMContext, test: dict, with_questions: bool = True):
+    """Send the questions document (optional) and a fresh answer-sheet message."""
+    from config import bot
+    chat_id = sender.message.chat.id if isinstance(sender, types.CallbackQuery) else sender.chat.id
+    s = await state.get_data()
+    total = _total(test, s)
+    shuffle = get_attempt_shuffle(s, test)
+    answers = _shown(s.get("answers", {}), shuffle)
+
+    if with_questions:
+        try:
+            await send_cached_document(bot, chat_id, build_question_sheet(test, shuffle),
+                                       f"savollar_{s.get('active_test_id') or 'test'}.html",
+                                       caption="📄 Test savollari")
+        except Exception as e:
+            log.error(f"Question sheet upload failed for chat {chat_id}: {e}")
+
+    page = int(s.get("sheet_page", 0))
+    await dispatch("interactive", bot.send_message, chat_id, _sheet_text(test, answers, total),
+                   reply_markup=_sheet_keyboard(answers, total, page))
+
+
+async def _refresh(cb: types.CallbackQuery, test: dict, answers: Dict[str, str], total: int, page: int):
+    try:
+        await dispatch("interactive", cb.message.edit_text, _sheet_text(test, answers, total),
+                       reply_markup=_sheet_keyboard(answers, total, page))
+    except MessageNotModified:
+        pass
+
+
+async def cb_sheet(cb: types.CallbackQuery, state: FSMContext):
+    from student_handlers import _finish_test, _save_session
+    from utils import read_test
+
+    data = cb.data or ""
+    s = await state.get_data()
+    tid = s.get("active_test_id")
+    if not tid or s.get("delivery_mode") != "sheet":
+        return await cb.answer("Sessiya topilmadi. /start ni bosing.", show_alert=True)
+    test = read_test(tid)
+    if not test or not test.get("questions"):
+        await state.finish()
+        return await cb.answer("Test topilmadi yoki o'chirilgan.", show_alert=True)
+
+    if is_expired(s):
+        return await finish_expired(cb, state, test)
+
+    total = _total(test, s)
+    shuffle = get_attempt_shuffle(s, test)
+    answers: Dict[str, str] = s.get("answers", {})
+    page = int(s.get("sheet_page", 0))
+    parts = data.split(":")
+
+    if parts[1] == "noop":
+        return await cb.answer()
+
+    if parts[1] == "m" and len(parts) == 4:
+        try:
+            q = int(parts[2])
+        except ValueError:
+            return await cb.answer("Noto'g'ri so'rov")
+        opt = parts[3].upper()
+        key, letter = _canonical(shuffle, q, opt) if 1 <= q <= total else (None, None)
+        if not letter or opt not in OPTION_KEYS:
+            return await cb.answer("Noto'g'ri so'rov")
+        if answers.get(key) == letter:
+            answers.pop(key, None)
+            toast = f"{q}: belgi olib tashlandi"
+        else:
+            answers[key] = letter
+            toast = f"{q}: {opt}"
+        await state.update_data(answers=answers)
+        await _save_session(cb.from_user.id, tid, await state.get_data())
+        await _refresh(cb, test, _shown(answers, shuffle), total, page)
+        return await cb.answer(toast)
+
+    if parts[1] == "p" and len(parts) == 3:
+        try:
+            page = int(parts[2])
+        except ValueError:
+            return await cb.answer()
+        await state.update_data(sheet_page=page)
+        await _refresh(cb, test, _shown(answers, shuffle), total, page)
+        return await cb.answer()
+
+    if parts[1] == "submit":
+        missing = total - len(_shown(answers, shuffle))
+        kb = types.InlineKeyboardMarkup(row_width=2)
+        kb.row(
+            types.InlineKeyboardButton("✅ Ha, topshirish", callback_data="sh:confirm"),
+            types.InlineKeyboardButton("⬅️ Varaqqa qaytish", callback_data=f"sh:p:{page}"),
+        )
+        warn = f"\n\n⚠️ {missing} ta savol belgilanmagan." if missing else ""
+        await dispatch("interactive", cb.message.edit_text,
+                       f"📤 <b>Javoblarni topshirasizmi?</b>{warn}\n\nTopshirgandan keyin o'zgartirib bo'lmaydi.",
+                       reply_markup=kb)
+        return await cb.answer()
+
+    if parts[1] == "confirm":
+        try:
+            await dispatch("interactive", cb.message.edit_text, "📤 Javoblar topshirildi. Natijalar quyida.")
+        except Exception as e:
+            log.debug(f"Sheet confirm edit skipped: {e}")
+        return await _finish_test(cb, state, test)
+
+    await cb.answer("Noma'lum tanlov")
+
+
+async def msg_sheet_marks(message: types.Message, state: FSMContext):
+    """Text like '1a 2c 3b' while an answer sheet is open."""
+    from student_handlers import _save_session
+    from utils import read_test
+
+    s = await state.get_data()
+    if s.get("delivery_mode") != "sheet":
+        return await message.reply("Javobni savol ostidagi tugmalar orqali tanlang.")
+    tid = s.get("active_test_id")
+    test = read_test(tid) if tid else None
+    if not test:
+        return await message.reply("Sessiya topilmadi. /start ni bosing.")
+    if is_expired(s):
+        return await finish_expired(message, state, test)
+
+    total = _total(test, s)
+    marks = parse_marks(message.text, total)
+    if not marks:
+        return await message.reply(f"Savol raqamlari 1 dan {total} gacha bo'lishi kerak.")
+
+    shuffle = get_attempt_shuffle(s, test)
+    answers: Dict[str, str] = s.get("answers", {})
+    for position, letter in marks.items():
+        key, canon = _canonical(shuffle, int(position), letter)
+        if canon:
+            answers[key] = canon
+    await state.update_data(answers=answers)
+    await _save_session(message.from_user.id, tid, await state.get_data())
+    await message.reply(f"✅ {len(marks)} ta javob belgilandi.")
+    await send_sheet(message, state, test, with_questions=False)
@@ -3,6 +3,7 @@ import sys
 import time
 import asyncio, random
 import re
+import html
 from pathlib import Path
 import json
 
@@ -30,7 +31,11 @@ try:
     from custom_storage import CustomJSONStorage
     from config import bot, OWNER_ID, ALLOWED_UPDATES
     from logging_setup import setup_logging
-    from middleware import AuditMiddleware
+    from middleware import (
+        AuditMiddleware, CallbackDedupMiddleware, StateTransaction,
+        StateTransactionMiddleware, ThrottlingMiddleware,
+    )
+    from ordered_dispatch import OrderedDispatcher
     from audit import log_action
     from utils import ensure_data, is_owner
     from states import StudentStates, AdminStates
@@ -67,10 +72,12 @@ from student_handlers import (
     handle_resume,
     handle_restart,
     process_understanding_response,
+    on_poll_answer,
     safe_student_operation,
-    rate_limit,
-    cleanup_old_user_sessions,
 )
+from answer_sheet import is_sheet_text
+from admission import admit
+from live_sessions import get_live_sessions
 from utils import (
     ensure_data,
     is_owner,
@@ -115,9 +122,10 @@ _CONNECTION_STATUS = {"online": True}
 _users_to_notify = set()
 
 # FSM storage (local JSON file) - FIXED FOR AIOGRAM 3.x
+# Updates are processed one at a time per user, in parallel across users (ordered_dispatch.py)
 try:
     storage = CustomJSONStorage("data/fsm_states.json")
-    dp = Dispatcher(bot, storage=storage)
+    dp = OrderedDispatcher(bot, storage=storage)
     log.info(f"Custom JSON storage initialized successfully (aiogram v{AIOGRAM_VERSION})")
 except Exception as e:
     log.error(f"Failed to initialize custom storage: {e}")
@@ -128,11 +136,18 @@ except Exception as e:
         from aiogram.contrib.fsm_storage.memory import MemoryStorage
     
     storage = MemoryStorage()
-    dp = Dispatcher(bot, storage=storage)
+    dp = OrderedDispatcher(bot, storage=storage)
     log.warning(f"Using fallback MemoryStorage instead of custom storage (aiogram v{AIOGRAM_VERSION})")
 
-# Middleware (audit)
+# Middleware: duplicate callbacks and floods are dropped before anything else
+# (state loading, audit)
+callback_dedup = CallbackDedupMiddleware()
+dp.middleware.setup(callback_dedup)
+throttling = ThrottlingMiddleware()
+dp.middleware.setup(throttling)
 dp.middleware.setup(AuditMiddleware())
+# Handlers get a per-update FSM transaction: data loaded once, committed once
+dp.middleware.setup(StateTransactionMiddleware())
 
 # -------------------------
 # Global navigation helpers
@@ -219,8 +234,8 @@ async def cmd_start_any(message: types.Message, state: FSMContext):
         )
         return
 
-    # Oddiy foydalanuvchi — to'g'ridan-to'g'ri testlar oqimi
-    await student_start(message, state)
+    # Oddiy foydalanuvchi — to'g'ridan-to'g'ri testlar oqimi (navbat orqali)
+    await admit(message, student_start, message, state)
 
 
 
@@ -257,42 +272,36 @@ async def cb_start_role_admin(cb: types.CallbackQuery, state: FSMContext):
 async def cb_start_role_student(cb: types.CallbackQuery, state: FSMContext):
     await state.finish()
     # Talaba oqimiga o‘tkazamiz (ismni so‘rashi, test tanlash va hok.)
-    await student_start(cb.message, state)
     await cb.answer()
+    await admit(cb, student_start, cb.message, state)
 
 
 
 # -------------------------
-# Student flow (public) - ENHANCED WITH RATE LIMITING AND ERROR HANDLING
+# Student flow (public) - rate limits live in ThrottlingMiddleware (middleware.py)
 # -------------------------
 
 # 1. MOST SPECIFIC FIRST - Answer buttons during answering state with validation and rate limiting
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("ans:") and len(c.data.split(":")) == 3, state=StudentStates.Answering)
-@rate_limit(max_calls=10, window_seconds=60)
 async def cb_ans_safe(cb: types.CallbackQuery, state: FSMContext):
     """Rate-limited and error-safe answer handler"""
     log.info(f"Answer callback received: {cb.data}")
-    current_state = await state.get_state()
-    log.info(f"Current user state: {current_state}")
     return await safe_student_operation(on_answer, cb, state)
 
 # 2. Test selection from clickable buttons with validation
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("select_test:") and len(c.data.replace("select_test:", "")) > 0, state=StudentStates.Choosing)
-@rate_limit(max_calls=5, window_seconds=30)
 async def cb_select_test_safe(cb: types.CallbackQuery, state: FSMContext):
     """Rate-limited and error-safe test selection"""
     log.info(f"Test selection callback: {cb.data}")
-    return await safe_student_operation(handle_test_selection, cb, state)
+    return await admit(cb, safe_student_operation, handle_test_selection, cb, state)
 
 # 3. Resume/restart handlers with validation
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("resume:"), state=StudentStates.Choosing)
-@rate_limit(max_calls=3, window_seconds=30)
 async def cb_resume_safe(cb: types.CallbackQuery, state: FSMContext):
     """Rate-limited and error-safe resume handler"""
     return await safe_student_operation(handle_resume, cb, state)
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("restart:"), state=StudentStates.Choosing)
-@rate_limit(max_calls=3, window_seconds=30)
 async def cb_restart_safe(cb: types.CallbackQuery, state: FSMContext):
     """Rate-limited and error-safe restart handler"""
     return await safe_student_operation(handle_restart, cb, state)
@@ -303,6 +312,33 @@ async def cb_understand_safe(cb: types.CallbackQuery, state: FSMContext):
     """Error-safe understanding response handler"""
     return await safe_student_operation(process_understanding_response, cb, state)
 
+# 4b. Quiz-poll votes ("poll" delivery mode). poll_answer has no chat and no
+# state filter: the student's FSM state is looked up by user id (private chat).
+@dp.poll_answer_handler()
+async def poll_answer_safe(poll_answer: types.PollAnswer):
+    """Error-safe quiz-poll answer handler"""
+    uid = poll_answer.user.id
+    async with StateTransaction(dp.storage, chat=uid, user=uid) as state:
+        if await state.get_state() != StudentStates.Answering.state:
+            return
+        try:
+            await on_poll_answer(poll_answer, state)
+        except Exception as e:
+            log.error(f"Poll answer failed for user {uid}: {e}", exc_info=True)
+
+# 4c. Answer sheet (exam mode): toggle keyboard and "1a 2c 3b" text marks
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("sh:"), state=StudentStates.Answering)
+async def cb_sheet_safe(cb: types.CallbackQuery, state: FSMContext):
+    """Error-safe answer-sheet handler"""
+    from answer_sheet import cb_sheet
+    return await safe_student_operation(cb_sheet, cb, state)
+
+@dp.message_handler(lambda m: is_sheet_text(m.text), state=StudentStates.Answering)
+async def msg_sheet_safe(message: types.Message, state: FSMContext):
+    """Error-safe answer-sheet text marks"""
+    from answer_sheet import msg_sheet_marks
+    return await safe_student_operation(msg_sheet_marks, message, state)
+
 # 5. New test selection
 @dp.callback_query_handler(lambda c: c.data == "new_test", state=StudentStates.Choosing)
 async def cb_new_test_safe(cb: types.CallbackQuery, state: FSMContext):
@@ -588,7 +624,7 @@ async def cmd_notify_test(message: types.Message):
     test_id = args.strip()
     
     try:
-        from utils import read_test, notify_group_students, get_unreachable_users_info
+        from utils import read_test, notify_test_students
         
         test_data = read_test(test_id)
         if not test_data:
@@ -602,23 +638,46 @@ async def cmd_notify_test(message: types.Message):
         
         await message.reply(f"Notifying students about test '{test_name}'...")
         
-        total_notified = 0
-        total_failed = 0
-        
-        for group_id in assigned_groups:
-            try:
-                group_id = int(group_id)
-                notified, failed = await notify_group_students(group_id, test_name, test_id)
-                total_notified += len(notified)
-                total_failed += len(failed)
-            except Exception as e:
-                log.error(f"Failed to notify group {group_id}: {e}")
+        notified, failed = await notify_test_students(
+            [int(g) for g in assigned_groups], test_name, test_id
+        )
+        total_notified = len(notified)
+        total_failed = len(failed)
         
         summary = f"✅ Notification complete!\n\n"
         summary += f"📊 Results:\n"
         summary += f"• ✅ Notified: {total_notified} students\n"
         summary += f"• ❌ Failed: {total_failed} students"
         
+        # Who has to press /start (blocked the bot, never started it, ...)
+        from utils import get_group_member_ids, get_unreachable_users_info
+        unreachable = []
+        remaining = set(failed)
+        for gid in assigned_groups:
+            # Each group only names its own members (names come from its member data)
+            members = set(get_group_member_ids(int(gid)))
+            in_group = [uid for uid in failed if uid in remaining and uid in members]
+            remaining.difference_update(in_group)
+            if in_group:
+                unreachable.extend(await get_unreachable_users_info(int(gid), in_group))
+        if remaining:
+            # Not in any group's member list: listed without a name
+            unreachable.extend(await get_unreachable_users_info(int(assigned_groups[0]), sorted(remaining)))
+        if unreachable:
+            seen = set()
+            summary += "\n\n🚫 <b>Unreachable (need to press /start):</b>\n"
+            shown = 0
+            for u in unreachable:
+                if u["id"] in seen:
+                    continue
+                seen.add(u["id"])
+                if shown < 20:
+                    uname = f" @{u['username']}" if u.get("username") else ""
+                    summary += f"• {html.escape(u['full_name'])}{uname} — {u['reason_label']}\n"
+                    shown += 1
+            if len(seen) > shown:
+                summary += f"• ... and {len(seen) - shown} more\n"
+        
         await message.reply(summary)
         
     except Exception as e:
@@ -962,45 +1021,16 @@ async def cmd_active_sessions(message: types.Message):
         return await message.reply("Owner only.")
     
     try:
-        session_dir = Path("data/sessions")
-        if not session_dir.exists():
-            return await message.reply("No session directory found.")
-        
-        sessions_info = []
-        
-        # Check all session files
-        for session_file in session_dir.rglob("*.json"):
-            try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    session_data = json.load(f)
-                
-                user_id = None
-                test_id = session_data.get("active_test_id", "unknown")
-                
-                # Extract user_id from file path or data
-                if session_file.name.startswith("session_"):
-                    parts = session_file.stem.split("_")
-                    if len(parts) >= 2:
-                        user_id = parts[1]
-                elif session_file.parent.name.isdigit():
-                    user_id = session_file.parent.name
-                
-                if user_id:
-                    current_q = session_data.get("current_q", 0)
-                    total_q = session_data.get("total_q", 0)
-                    last_updated = session_data.get("last_updated", session_file.stat().st_mtime)
-                    age_minutes = int((time.time() - last_updated) / 60)
-                    
-                    sessions_info.append({
-                        'user_id': user_id,
-                        'test_id': test_id[:8] + "..." if len(test_id) > 8 else test_id,
-                        'progress': f"{current_q}/{total_q}",
-                        'age_minutes': age_minutes
-                    })
-                    
-            except Exception as e:
-                log.debug(f"Error reading session {session_file}: {e}")
-                continue
+        now = time.time()
+        sessions_info = [
+            {
+                'user_id': e['user_id'],
+                'test_id': e['test_id'][:8] + "..." if len(e['test_id']) > 8 else e['test_id'],
+                'progress': f"{e['current_q']}/{e['total_q']}",
+                'age_minutes': int((now - e['last_activity']) / 60),
+            }
+            for e in get_live_sessions().active()
+        ]
         
         if not sessions_info:
             return await message.reply("No active sessions found.")
@@ -1376,6 +1406,35 @@ async def bot_health_check() -> dict:
     except:
         pass
     
+    try:
+        from outbox import outbox_pending_count
+        health["outbox_pending"] = outbox_pending_count()
+    except:
+        pass
+    
+    try:
+        from file_cache import get_file_cache
+        fc = get_file_cache().stats()
+        health["file_id_cache"] = f"{fc['size']} files, {fc['hits']} hits / {fc['misses']} uploads"
+    except:
+        pass
+    
+    try:
+        from outbound import get_outbound_metrics
+        health["outbound_lanes"] = get_outbound_metrics()
+    except:
+        pass
+
+    health["throttled"] = throttling.stats()
+    health["duplicate_callbacks"] = callback_dedup.stats()
+    health["update_queues"] = dp.queue_metrics()
+
+    try:
+        from admission import get_admission_metrics
+        health["start_admission"] = get_admission_metrics()
+    except:
+        pass
+    
     return health
 
 @dp.message_handler(commands=['health'])
@@ -1396,7 +1455,7 @@ async def cmd_health(message: types.Message):
         health_report = f"{status_emoji} <b>Bot Health Report</b>\n\n"
         
         for key, value in health.items():
-            if key == "timestamp":
+            if key in ("timestamp", "outbound_lanes"):
                 continue
                 
             emoji = "✅" if value else "❌"
@@ -1409,6 +1468,16 @@ async def cmd_health(message: types.Message):
             clean_key = key.replace("_", " ").title()
             health_report += f"{emoji} {clean_key}: {display_value}\n"
         
+        lanes = health.get("outbound_lanes") or {}
+        if lanes:
+            health_report += "\n<b>Outbound lanes</b>\n"
+            for lane, m in lanes.items():
+                health_report += (
+                    f"📤 {lane}: queue {m['depth']}, oldest {m['oldest_wait']}s, "
+                    f"avg wait {m['wait_avg']}s, max {m['wait_max']}s, "
+                    f"sent {m['sent']}, failed {m['failed']}\n"
+                )
+        
         health_report += f"\n🕒 Check time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(health['timestamp']))}"
         
         await message.reply(health_report)
@@ -1423,24 +1492,19 @@ async def cmd_cleanup(message: types.Message):
         return await message.reply("Owner only.")
     
     try:
+        # Expired session files (from the session index; abandoned ones are archived)
+        from session_expiry import expire_sessions
+        total_cleaned_files, archived = await expire_sessions(max_age_hours=24, storage=storage)
+
         # Clean up old FSM states
         cleaned_states = 0
         if hasattr(storage, 'cleanup_old_sessions'):
             cleaned_states = await storage.cleanup_old_sessions(max_age_hours=24)
         
-        # Clean up old session files
-        session_dir = Path("data/sessions")
-        total_cleaned_files = 0
-        if session_dir.exists():
-            for user_dir in session_dir.iterdir():
-                if user_dir.is_dir() and user_dir.name.isdigit():
-                    user_id = int(user_dir.name)
-                    cleaned = await cleanup_old_user_sessions(user_id, max_age_hours=24)
-                    total_cleaned_files += cleaned
-        
         summary = f"🧹 Cleanup complete!\n\n"
         summary += f"🗑 FSM states cleaned: {cleaned_states}\n"
-        summary += f"📁 Session files cleaned: {total_cleaned_files}"
+        summary += f"📁 Session files cleaned: {total_cleaned_files}\n"
+        summary += f"📦 Archived as incomplete attempts: {archived}"
         
         await message.reply(summary)
         
@@ -1461,6 +1525,9 @@ async def cmd_help(message: types.Message):
             "/cleanup - Clean old sessions\n"
             "/joingroup - Force join current group\n"
             "/notify <test_id> - Manually notify about test\n"
+            "/reportmode - How completion reports are delivered\n"
+            "/review &lt;attempt_id&gt; - Full review of one attempt\n"
+            "/examtime &lt;test_id&gt; &lt;min&gt; [open] [close] - Exam time limit / window\n"
             "/telethon - Check Telethon status\n"
             "/groupinfo <group_id> - Detailed group info\n"
             "/testaccess - Check your test access\n"
@@ -1931,6 +1998,43 @@ async def _activity_admins(cb: types.CallbackQuery):
 async def _activity_export(cb: types.CallbackQuery):
     await activity_export(cb)
 
+# Admin completion reports (immediate / digest / end-of-test summary)
+@dp.message_handler(commands=['reportmode'])
+async def _cmd_report_mode(message: types.Message):
+    from admin_reports import cmd_report_mode
+    await cmd_report_mode(message)
+
+@dp.message_handler(commands=['examtime'])
+async def _cmd_exam_time(message: types.Message):
+    from exam_deadlines import cmd_exam_time
+    await cmd_exam_time(message)
+
+@dp.message_handler(commands=['review'])
+async def _cmd_review(message: types.Message):
+    from admin_reports import cmd_review
+    await cmd_review(message)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("rmode:"))
+async def _cb_report_mode(cb: types.CallbackQuery):
+    from admin_reports import cb_report_mode
+    await cb_report_mode(cb)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("rv:"))
+async def _cb_attempt_review(cb: types.CallbackQuery):
+    from admin_reports import cb_attempt_review
+    await cb_attempt_review(cb)
+
+# Paginated test reviews (students and admins)
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("rvp:"), state="*")
+async def _cb_review_page(cb: types.CallbackQuery):
+    from review_render import cb_review_page
+    await cb_review_page(cb)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("rvf:"), state="*")
+async def _cb_review_file(cb: types.CallbackQuery):
+    from review_render import cb_review_file
+    await cb_review_file(cb)
+
 log.info("✅ New enhanced admin panels registered successfully")
 
 
@@ -1992,6 +2096,23 @@ async def on_startup(dp: Dispatcher):
 
         asyncio.create_task(_heartbeat_watchdog())
         log.info("Watchdog started")
+
+        # Resume broadcasts interrupted by the previous shutdown
+        from broadcast import resume_pending_campaigns
+        asyncio.create_task(resume_pending_campaigns())
+
+        # Digest / end-of-test summary reports for admins
+        from admin_reports import report_digest_loop
+        asyncio.create_task(report_digest_loop())
+
+        # Time limits of running exams (one heap for all students)
+        from exam_deadlines import deadline_loop
+        asyncio.create_task(deadline_loop(dp))
+
+        # Idle sessions expire on a schedule (TTL index, see session_expiry)
+        from session_expiry import session_expiry_loop
+        asyncio.create_task(session_expiry_loop(dp))
+
         owner_telethon = await get_user_telethon_service()
 
         if owner_telethon:
@@ -2064,12 +2185,19 @@ async def _heartbeat_watchdog():
                 except Exception:
                     pass
                 
+                # Deliver whatever piled up in the outbox during the outage
+                from outbox import drain_outbox
+                await drain_outbox()
+
                 # Notify affected users
                 await notify_users_on_reconnect()
                 
             else:
-                # Still online, nothing to do
+                # Still online: retry outbox items left over from earlier failures
                 _CONNECTION_STATUS["online"] = True
+                from outbox import outbox_pending_count, drain_outbox
+                if outbox_pending_count():
+                    await drain_outbox()
 
         except Exception as e:
             # Connection failed
@@ -2111,17 +2239,12 @@ async def notify_users_on_reconnect():
         "Test davom ettirish uchun /start yuboring."
     )
     
-    notified_count = 0
-    
-    for user_id in notify_list:
-        try:
-            await bot.send_message(user_id, message)
-            notified_count += 1
-            await asyncio.sleep(0.1)  # Rate limiting
-        except Exception as e:
-            log.debug(f"Failed to notify user {user_id} about reconnection: {e}")
+    from broadcast import get_broadcast_engine
+    stats = await get_broadcast_engine().run(
+        f"reconnect_{int(time.time())}", notify_list, message
+    )
     
-    log.info(f"Notified {notified_count}/{len(notify_list)} users about reconnection")
+    log.info(f"Notified {stats['sent']}/{stats['total']} users about reconnection")
 
 
 
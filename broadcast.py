@@ -0,0 +1,251 @@
+"""
+BROADCAST ENGINE
+
+Rate-limited fan-out of one message to many Telegram chats.
+
+- Sends go through the "bulk" lane of the outbound dispatcher, so they share
+  the global rate budget and never delay interactive replies
+- Per-chat pacing so the same chat is never hit faster than once per second
+- Bounded concurrency (fixed pool of worker tasks)
+- Automatic RetryAfter backoff (the dispatcher pauses every lane)
+- Recipients are de-duplicated: a user in several target groups gets one DM
+- Recipients known to be unreachable (blocked bot, deleted account, ...) are
+  skipped; new permanent failures are recorded (see recipients.py)
+- Every campaign is persisted under data/broadcasts/ so an interrupted
+  broadcast resumes after restart (see resume_pending_campaigns)
+
+Usage:
+    engine = get_broadcast_engine()
+    stats = await engine.run("activate:<tid>", user_ids, text)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from aiogram.utils.exceptions import RetryAfter, NetworkError
+
+from outbound import dispatch
+from recipients import get_unreachable_registry
+
+log = logging.getLogger("broadcast")
+
+BROADCAST_DIR = Path(os.getenv("BROADCAST_DIR", "data/broadcasts"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+PER_CHAT_INTERVAL = 1.0      # seconds between two sends to the same chat
+MAX_RETRIES = 3
+PROGRESS_FLUSH_EVERY = 25    # persist campaign progress every N deliveries
+DONE_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+def _campaign_path(campaign_id: str) -> Path:
+    safe = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in campaign_id)
+    return BROADCAST_DIR / f"{safe}.json"
+
+
+def _write_campaign(campaign: dict):
+    try:
+        BROADCAST_DIR.mkdir(parents=True, exist_ok=True)
+        path = _campaign_path(campaign["campaign_id"])
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(campaign, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+    except Exception as e:
+        log.error(f"Could not persist campaign {campaign.get('campaign_id')}: {e}")
+
+
+def _read_campaign(campaign_id: str) -> Optional[dict]:
+    path = _campaign_path(campaign_id)
+    try:
+        if path.exists():
+            return json.loads(path.read_text(encoding="utf-8"))
+    except Exception as e:
+        log.error(f"Could not read campaign {campaign_id}: {e}")
+    return None
+
+
+class BroadcastEngine:
+    def __init__(self, bot, concurrency: int = BROADCAST_CONCURRENCY,
+                 per_chat_interval: float = PER_CHAT_INTERVAL, lane: str = "bulk"):
+        self.bot = bot
+        self.lane = lane
+        self.concurrency = max(1, int(concurrency))
+        self.per_chat_interval = per_chat_interval
+        self._chat_last_sent: Dict[int, float] = {}
+        self.registry = get_unreachable_registry()
+
+    async def _pace_chat(self, chat_id: int):
+        last = self._chat_last_sent.get(chat_id)
+        if last is not None:
+            wait = self.per_chat_interval - (time.monotonic() - last)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        self._chat_last_sent[chat_id] = time.monotonic()
+        if len(self._chat_last_sent) > 10000:
+            cutoff = time.monotonic() - self.per_chat_interval
+            self._chat_last_sent = {k: v for k, v in self._chat_last_sent.items() if v >= cutoff}
+
+    async def _deliver(self, chat_id: int, text: str, send_kwargs: dict, stats: dict) -> Optional[str]:
+        """Send one message. Returns None on success, error text otherwise."""
+        last_error = "unknown"
+        for attempt in range(MAX_RETRIES + 1):
+            await self._pace_chat(chat_id)
+            try:
+                await dispatch(self.lane, self.bot.send_message, chat_id, text, **send_kwargs)
+                self.registry.mark_reachable(chat_id, save=False)
+                return None
+            except RetryAfter as e:
+                # The dispatcher already paused the shared budget; just retry
+                stats["retried"] += 1
+                last_error = f"RetryAfter {e.timeout}s"
+            except NetworkError as e:
+                stats["retried"] += 1
+                last_error = str(e)
+                await asyncio.sleep(min(2 ** attempt, 10))
+            except Exception as e:
+                self.registry.record_error(chat_id, e, save=False)
+                return str(e)
+        return last_error
+
+    async def run(self, campaign_id: str, recipients: Iterable[int], text: str,
+                  **send_kwargs) -> dict:
+        """
+        Deliver `text` to every recipient exactly once and return stats:
+          {campaign_id, total, sent, failed, skipped, retried, elapsed,
+           sent_ids, failed_ids, skipped_ids}
+        `skipped` are recipients the registry already knows to be unreachable.
+        Re-running an existing campaign_id only sends to recipients not yet done.
+        """
+        started = time.time()
+        campaign = _read_campaign(campaign_id)
+        if not campaign:
+            unique: List[int] = []
+            seen = set()
+            for uid in recipients:
+                try:
+                    uid = int(uid)
+                except (TypeError, ValueError):
+                    continue
+                if uid not in seen:
+                    seen.add(uid)
+                    unique.append(uid)
+            campaign = {
+                "campaign_id": campaign_id,
+                "text": text,
+                "send_kwargs": send_kwargs,
+                "recipients": unique,
+                "results": {},
+                "status": "running",
+                "created_at": int(started),
+            }
+            _write_campaign(campaign)
+
+        return await self._run_campaign(campaign, started)
+
+    async def _run_campaign(self, campaign: dict, started: float) -> dict:
+        results: Dict[str, str] = campaign.setdefault("results", {})
+        pending = [uid for uid in campaign.get("recipients", []) if str(uid) not in results]
+        pending, dead = self.registry.partition(pending)
+        for uid in dead:
+            results[str(uid)] = f"skipped: {self.registry.get(uid)['reason']}"
+        text = campaign.get("text", "")
+        send_kwargs = campaign.get("send_kwargs") or {}
+
+        stats = {"retried": 0}
+        queue: asyncio.Queue = asyncio.Queue()
+        for uid in pending:
+            queue.put_nowait(uid)
+
+        done_since_flush = 0
+
+        async def _worker():
+            nonlocal done_since_flush
+            while True:
+                try:
+                    uid = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                error = await self._deliver(uid, text, send_kwargs, stats)
+                results[str(uid)] = "ok" if error is None else f"failed: {error}"[:200]
+                if error is not None:
+                    log.debug(f"Broadcast {campaign['campaign_id']}: {uid} failed: {error}")
+                done_since_flush += 1
+                if done_since_flush >= PROGRESS_FLUSH_EVERY:
+                    done_since_flush = 0
+                    _write_campaign(campaign)
+                    self.registry.flush()
+
+        workers = min(self.concurrency, len(pending)) or 0
+        if workers:
+            await asyncio.gather(*(_worker() for _ in range(workers)))
+
+        campaign["status"] = "done"
+        campaign["finished_at"] = int(time.time())
+        _write_campaign(campaign)
+        self.registry.flush()
+
+        sent_ids = [int(uid) for uid, r in results.items() if r == "ok"]
+        skipped_ids = [int(uid) for uid, r in results.items() if r.startswith("skipped")]
+        failed_ids = [int(uid) for uid, r in results.items() if r.startswith("failed")]
+        out = {
+            "campaign_id": campaign["campaign_id"],
+            "total": len(campaign.get("recipients", [])),
+            "sent": len(sent_ids),
+            "failed": len(failed_ids),
+            "skipped": len(skipped_ids),
+            "retried": stats["retried"],
+            "elapsed": round(time.time() - started, 2),
+            "sent_ids": sent_ids,
+            "failed_ids": failed_ids,
+            "skipped_ids": skipped_ids,
+        }
+        log.info(
+            f"Broadcast {out['campaign_id']} done: {out['sent']}/{out['total']} sent, "
+            f"{out['failed']} failed, {out['skipped']} skipped, {out['retried']} retries in {out['elapsed']}s"
+        )
+        return out
+
+    async def resume_pending(self) -> List[dict]:
+        """Resume every campaign that was still running when the bot stopped."""
+        resumed = []
+        if not BROADCAST_DIR.exists():
+            return resumed
+        for path in sorted(BROADCAST_DIR.glob("*.json")):
+            try:
+                campaign = json.loads(path.read_text(encoding="utf-8"))
+            except Exception as e:
+                log.warning(f"Skipping unreadable campaign file {path}: {e}")
+                continue
+            if campaign.get("status") != "running":
+                finished_at = campaign.get("finished_at") or 0
+                if time.time() - finished_at > DONE_RETENTION_SECONDS:
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+                continue
+            log.info(f"Resuming interrupted broadcast {campaign.get('campaign_id')}")
+            resumed.append(await self._run_campaign(campaign, time.time()))
+        return resumed
+
+
+_engine: Optional[BroadcastEngine] = None
+
+
+def get_broadcast_engine() -> BroadcastEngine:
+    global _engine
+    if _engine is None:
+        from config import bot
+        _engine = BroadcastEngine(bot)
+    return _engine
+
+
+async def resume_pending_campaigns():
+    try:
+        await get_broadcast_engine().resume_pending()
+    except Exception as e:
+        log.error(f"Failed to resume pending broadcasts: {e}")
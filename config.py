@@ -70,7 +70,7 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 LOG_DIR = os.getenv("LOG_DIR", "logs")
 
 # Bot update types
-ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member', 'my_chat_member']
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member', 'my_chat_member', 'poll_answer']
 
 # Telethon session file
 TELETHON_SESSION = os.path.join(DATA_DIR, "telethon_session")
@@ -1,9 +1,13 @@
 import json
+import time
 import asyncio
 import logging
 from pathlib import Path
 from typing import Dict, Any, Optional
 
+from session_codec import decode_session, encode_session
+from session_store import get_session_store
+
 # Import the correct storage base class
 try:
     from aiogram.contrib.fsm_storage.memory import BaseStorage  # aiogram 2.x
@@ -17,10 +21,17 @@ except ImportError:
 
 log = logging.getLogger("custom_storage")
 
+# Data updates are flushed at most this often; the durable copy of a running
+# attempt is its session file (session_store), not this file
+FSM_FLUSH_DELAY = 2.0
+
 class CustomJSONStorage(BaseStorage):
     """
     JSON file-based storage for FSM states (aiogram 2.x/3.x bilan mos).
     Signaturalari positional ham, keyword ham qabul qiladi.
+
+    State changes are written immediately, data updates lazily (FSM_FLUSH_DELAY).
+    On load, the attempt fields of a running test come from its session file.
     """
 
     def __init__(self, file_path: str = "data/fsm_states.json"):
@@ -28,6 +39,7 @@ class CustomJSONStorage(BaseStorage):
         self.file_path = Path(file_path)
         self._data: Dict[str, Dict[str, Any]] = {}
         self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
         self._load_data()
 
     def _load_data(self):
@@ -45,8 +57,12 @@ class CustomJSONStorage(BaseStorage):
                             else:
                                 if 'data' not in value or not isinstance(value.get('data'), dict):
                                     value['data'] = {}
+                                value['data'] = decode_session(value['data'])
                                 if 'state' not in value:
                                     value['state'] = None
+                                # Records from before timestamps were written age from now
+                                value.setdefault('timestamp', time.time())
+                                self._rehydrate(key, value['data'])
                     else:
                         log.warning("Invalid data format in storage file, starting fresh")
                         self._data = {}
@@ -57,6 +73,30 @@ class CustomJSONStorage(BaseStorage):
             log.error(f"Could not load FSM storage from {self.file_path}: {e}")
             self._data = {}
 
+    @staticmethod
+    def _rehydrate(key: str, data: dict):
+        """Take a running attempt's fields from the session store (authoritative)."""
+        test_id = data.get('active_test_id')
+        if not test_id:
+            return
+        try:
+            stored = get_session_store().read(int(key.split(':')[-1]), test_id)
+        except Exception as e:
+            log.warning(f"Could not load session {key}/{test_id}: {e}")
+            return
+        if stored:
+            data.update(stored)
+
+    def _schedule_save(self):
+        """Coalesce data updates into one write per FSM_FLUSH_DELAY."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._delayed_save())
+
+    async def _delayed_save(self):
+        await asyncio.sleep(FSM_FLUSH_DELAY)
+        async with self._lock:
+            await self._save_data()
+
     async def _save_data(self):
         """Save data to JSON file with error handling"""
         try:
@@ -68,7 +108,9 @@ class CustomJSONStorage(BaseStorage):
                 if isinstance(value, dict):
                     clean_value = {
                         'state': value.get('state'),
-                        'data': value.get('data', {}) if isinstance(value.get('data'), dict) else {}
+                        'timestamp': value.get('timestamp', time.time()),
+                        # answers / exclusions / counters as compact strings
+                        'data': encode_session(value['data']) if isinstance(value.get('data'), dict) else {}
                     }
                     # Save all records (hatto bo‘sh bo‘lsa ham) — lekin xohlasangiz shu yerda filtrlasangiz bo‘ladi
                     clean_data[key] = clean_value
@@ -76,7 +118,7 @@ class CustomJSONStorage(BaseStorage):
             # Write atomically using a temporary file
             temp_file = self.file_path.with_suffix('.tmp')
             with open(temp_file, 'w', encoding='utf-8') as f:
-                json.dump(clean_data, f, ensure_ascii=False, indent=2)
+                json.dump(clean_data, f, ensure_ascii=False, separators=(",", ":"))
 
             # Atomic move
             temp_file.replace(self.file_path)
@@ -102,6 +144,8 @@ class CustomJSONStorage(BaseStorage):
             record['data'] = {}
         if 'state' not in record:
             record['state'] = None
+        # Last activity, used by cleanup_old_sessions
+        record['timestamp'] = time.time()
         return record
 
     def _safe_dict_update(self, target: dict, source: Any) -> None:
@@ -166,7 +210,7 @@ class CustomJSONStorage(BaseStorage):
                 else:
                     log.warning(f"Invalid data type for user {user}: {type(data)}")
                     record['data'] = {}
-                await self._save_data()
+                self._schedule_save()
             except Exception as e:
                 log.error(f"Error setting data for user {user}: {e}")
 
@@ -181,7 +225,7 @@ class CustomJSONStorage(BaseStorage):
                 if kwargs:
                     self._safe_dict_update(record['data'], kwargs)
 
-                await self._save_data()
+                self._schedule_save()
             except Exception as e:
                 log.error(f"Error updating data for user {user}: {e}")
 
@@ -240,7 +284,6 @@ class CustomJSONStorage(BaseStorage):
     async def cleanup_old_sessions(self, max_age_hours: int = 24):
         async with self._lock:
             try:
-                import time
                 cutoff_time = time.time() - (max_age_hours * 3600)
                 cleaned = 0
 
@@ -266,7 +309,10 @@ class CustomJSONStorage(BaseStorage):
 
     async def close(self) -> None:
         try:
-            await self._save_data()
+            if self._flush_task is not None and not self._flush_task.done():
+                self._flush_task.cancel()
+            async with self._lock:
+                await self._save_data()
             log.info("Storage closed successfully")
         except Exception as e:
             log.error(f"Error closing storage: {e}")
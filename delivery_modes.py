@@ -0,0 +1,58 @@
+"""
+QUESTION DELIVERY MODES
+
+How a test is shown to students, stored per test as test["delivery_mode"]:
+
+    message – every question, explanation and separator is a new message
+              (the original behaviour, default)
+    edit    – the test runs inside ONE message: the next question, the
+              explanation and the "Tushundingizmi?" step replace its text and
+              keyboard in place. Questions too long for one message (pre-split
+              code) fall back to new messages.
+    poll    – short plain-text questions are sent as native Telegram quiz
+              polls; the client shows right/wrong itself and the bot gets
+              one poll_answer update. Questions with code, markup or long
+              options use the inline-keyboard flow.
+    sheet   – exam mode: all questions in one document, answers marked on an
+              answer sheet and submitted once (see answer_sheet.py)
+
+The mode is copied into the student's session when the test starts, so
+changing it does not affect attempts already in progress.
+"""
+
+import os
+
+DELIVERY_MODES = {
+    "message": "💬 Har biri yangi xabar",
+    "edit": "✏️ Bitta xabarda (tahrirlash)",
+    "poll": "📊 Telegram viktorina (quiz)",
+    "sheet": "📝 Javoblar varaqasi (imtihon)",
+}
+DEFAULT_DELIVERY_MODE = os.getenv("DEFAULT_DELIVERY_MODE", "message")
+if DEFAULT_DELIVERY_MODE not in DELIVERY_MODES:
+    DEFAULT_DELIVERY_MODE = "message"
+
+
+def get_delivery_mode(test: dict) -> str:
+    mode = (test or {}).get("delivery_mode")
+    return mode if mode in DELIVERY_MODES else DEFAULT_DELIVERY_MODE
+
+
+def next_delivery_mode(mode: str) -> str:
+    modes = list(DELIVERY_MODES)
+    try:
+        return modes[(modes.index(mode) + 1) % len(modes)]
+    except ValueError:
+        return DEFAULT_DELIVERY_MODE
+
+
+def set_delivery_mode(test_id: str, mode: str) -> bool:
+    from utils import read_test, write_test
+    if mode not in DELIVERY_MODES:
+        return False
+    test = read_test(test_id)
+    if not test:
+        return False
+    test["delivery_mode"] = mode
+    write_test(test_id, test)
+    return True
@@ -0,0 +1,266 @@
+"""
+TIMED EXAMS
+
+Optional per-test limits, stored in the test JSON:
+    time_limit_min : minutes a student has after pressing "Boshlaymiz"
+    opens_at       : unix time before which the test cannot be started
+    closes_at      : unix time after which it cannot be started, and by
+                     which every running attempt is submitted
+
+A student's deadline = min(start + time_limit, closes_at) is written into the
+session (state + data/sessions/<uid>/<tid>.json) when the test starts.
+
+One in-process DeadlineScheduler enforces all deadlines: a heap of
+(when, kind, user, test) entries and a single task sleeping until the
+earliest one, instead of a sleeping task per student.
+- "remind" entries send "5 daqiqa qoldi" through the notification lane
+- "expire" entries auto-submit the attempt (_finish_test), EXPIRY_BATCH at a time
+- Finished attempts are not removed from the heap; an entry whose session is
+  gone or has a different deadline is simply skipped when it fires
+- On startup the heap is rebuilt from the stored sessions, so deadlines
+  survive restarts (already expired ones are submitted right away)
+
+Admin: /examtime <test_id> <daqiqa> [ochilish] [yopilish]
+       times as YYYY-MM-DDTHH:MM (server time), "-" for none
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from aiogram import types
+
+from outbound import dispatch
+from session_store import get_session_store
+
+log = logging.getLogger("exam_deadlines")
+
+REMINDER_BEFORE = 5 * 60
+EXPIRY_BATCH = 20
+MAX_SLEEP = 60               # re-check the heap at least once a minute
+
+EXPIRED_TEXT = "⏰ <b>Vaqt tugadi!</b> Javoblaringiz avtomatik topshirildi."
+REMINDER_TEXT = "⏳ Testni yakunlashga <b>5 daqiqa</b> qoldi!"
+_TIME_FMT = "%Y-%m-%dT%H:%M"
+
+
+# ---------- limits ----------
+
+def _fmt(ts: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+
+
+def window_error(test: dict, now: Optional[float] = None) -> Optional[str]:
+    """Why the test cannot be started right now, or None."""
+    now = now or time.time()
+    opens_at, closes_at = test.get("opens_at"), test.get("closes_at")
+    if opens_at and now < opens_at:
+        return f"⏳ Test hali ochilmagan. Boshlanish vaqti: <b>{_fmt(opens_at)}</b>"
+    if closes_at and now >= closes_at:
+        return f"🔒 Test yopilgan ({_fmt(closes_at)})."
+    return None
+
+
+def compute_deadline(test: dict, started_at: float) -> Optional[int]:
+    candidates = []
+    if test.get("time_limit_min"):
+        candidates.append(started_at + int(test["time_limit_min"]) * 60)
+    if test.get("closes_at"):
+        candidates.append(float(test["closes_at"]))
+    return int(min(candidates)) if candidates else None
+
+
+def describe_limits(test: dict) -> str:
+    parts = []
+    if test.get("time_limit_min"):
+        parts.append(f"{int(test['time_limit_min'])} daqiqa")
+    if test.get("opens_at"):
+        parts.append(f"ochiladi {_fmt(test['opens_at'])}")
+    if test.get("closes_at"):
+        parts.append(f"yopiladi {_fmt(test['closes_at'])}")
+    return ", ".join(parts) or "cheklanmagan"
+
+
+def is_expired(session: dict, now: Optional[float] = None) -> bool:
+    deadline = (session or {}).get("deadline")
+    return bool(deadline) and (now or time.time()) >= deadline
+
+
+# ---------- scheduler ----------
+
+class DeadlineScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str, int, str, int]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dp = None
+
+    def schedule(self, user_id: int, test_id: str, deadline: int):
+        now = time.time()
+        if deadline - REMINDER_BEFORE > now:
+            heapq.heappush(self._heap, (deadline - REMINDER_BEFORE, next(self._seq), "remind",
+                                        user_id, test_id, deadline))
+        heapq.heappush(self._heap, (deadline, next(self._seq), "expire", user_id, test_id, deadline))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def load_sessions(self) -> int:
+        """Re-schedule every stored session that has a deadline (after a restart)."""
+        count = 0
+        for (user_id, test_id), data in get_session_store().scan():
+            deadline = data.get("deadline")
+            if not deadline:
+                continue
+            try:
+                self.schedule(user_id, test_id, int(deadline))
+                count += 1
+            except (TypeError, ValueError) as e:
+                log.debug(f"Skipping session {user_id}/{test_id}: {e}")
+        return count
+
+    async def run(self, dp):
+        self._dp = dp
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < EXPIRY_BATCH:
+                due.append(heapq.heappop(self._heap))
+            if due:
+                results = await asyncio.gather(*(self._fire(item) for item in due), return_exceptions=True)
+                for item, res in zip(due, results):
+                    if isinstance(res, Exception):
+                        log.error(f"Deadline {item[2]} for {item[3]}:{item[4]} failed: {res}")
+                continue
+
+            timeout = min(MAX_SLEEP, self._heap[0][0] - now) if self._heap else MAX_SLEEP
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _active_state(self, user_id: int, test_id: str, deadline: int):
+        """FSM state of the attempt if it is still running with this deadline."""
+        from student_handlers import recover_session_state
+        state = self._dp.current_state(chat=user_id, user=user_id)
+        s = await state.get_data()
+        if s.get("active_test_id") != test_id:
+            # FSM data lost (or another test active): only a stored session counts
+            if s.get("active_test_id") or not await recover_session_state(user_id, test_id, state):
+                return None, None
+            s = await state.get_data()
+        if int(s.get("deadline") or 0) != deadline:
+            return None, None
+        return state, s
+
+    async def _fire(self, item):
+        # In the user's update queue: never interleaves with their answer handlers
+        user_id = item[3]
+        update_queue = getattr(self._dp, "update_queue", None)
+        if update_queue is None:
+            return await self._fire_now(item)
+        return await update_queue.run(user_id, self._fire_now, item)
+
+    async def _fire_now(self, item):
+        _, _, kind, user_id, test_id, deadline = item
+        from config import bot
+        state, s = await self._active_state(user_id, test_id, deadline)
+        if state is None:
+            return
+
+        if kind == "remind":
+            await dispatch("notification", bot.send_message, user_id, REMINDER_TEXT)
+            return
+
+        from utils import read_test
+        test = read_test(test_id)
+        if not test:
+            return
+        log.info(f"Auto-submitting expired attempt {user_id}:{test_id}")
+        await finish_expired(types.User(id=user_id, username=s.get("username")), state, test)
+
+
+async def finish_expired(sender, state, test: dict):
+    """Tell the student time is up and submit what they have answered."""
+    from config import bot
+    from student_handlers import _finish_test, _sender_chat_id
+    try:
+        await dispatch("notification", bot.send_message, _sender_chat_id(sender), EXPIRED_TEXT)
+    except Exception as e:
+        log.warning(f"Expiry notice failed: {e}")
+    await _finish_test(sender, state, test)
+
+
+_scheduler: Optional[DeadlineScheduler] = None
+
+
+def get_deadline_scheduler() -> DeadlineScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = DeadlineScheduler()
+    return _scheduler
+
+
+async def deadline_loop(dp):
+    scheduler = get_deadline_scheduler()
+    loaded = scheduler.load_sessions()
+    if loaded:
+        log.info(f"Deadline scheduler: {loaded} timed session(s) restored")
+    await scheduler.run(dp)
+
+
+# ---------- admin command ----------
+
+def _parse_time(value: str) -> Optional[int]:
+    if value in ("-", "0", ""):
+        return None
+    return int(datetime.strptime(value, _TIME_FMT).timestamp())
+
+
+async def cmd_exam_time(message: types.Message):
+    """/examtime <test_id> <daqiqa> [ochilish] [yopilish]"""
+    from utils import can_user_manage_test, is_admin, read_test, write_test
+
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        return await message.reply("Faqat adminlar uchun.")
+
+    args = (message.get_args() or "").split()
+    usage = (
+        "Foydalanish: /examtime &lt;test_id&gt; &lt;daqiqa&gt; [ochilish] [yopilish]\n"
+        "Vaqt: YYYY-MM-DDTHH:MM, cheklovsiz uchun 0 yoki -\n"
+        "Masalan: /examtime abc123 45 2026-05-20T09:00 2026-05-20T12:00"
+    )
+    if not args:
+        return await message.reply(usage)
+
+    tid = args[0]
+    if not can_user_manage_test(user_id, tid):
+        return await message.reply("Bu testni boshqara olmaysiz.")
+    test = read_test(tid)
+    if not test:
+        return await message.reply("Test topilmadi.")
+
+    if len(args) > 1:
+        try:
+            minutes = int(args[1])
+            opens_at = _parse_time(args[2]) if len(args) > 2 else test.get("opens_at")
+            closes_at = _parse_time(args[3]) if len(args) > 3 else test.get("closes_at")
+        except ValueError:
+            return await message.reply(usage)
+        if minutes < 0 or (opens_at and closes_at and opens_at >= closes_at):
+            return await message.reply(usage)
+        test["time_limit_min"] = minutes or None
+        test["opens_at"] = opens_at
+        test["closes_at"] = closes_at
+        write_test(tid, test)
+
+    await message.reply(f"⏱ <b>{test.get('test_name') or tid}</b>: {describe_limits(test)}")
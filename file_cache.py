@@ -0,0 +1,131 @@
+"""
+UPLOAD-ONCE DOCUMENT CACHE
+
+Maps the SHA-256 of a document's filename and bytes to the Telegram file_id
+returned by its first upload. Later sends of the same file (same review to
+several admins) reuse the file_id instead of uploading again. The filename is
+part of the key because a file_id keeps the name it was uploaded with.
+
+- Bounded LRU (FILE_CACHE_SIZE entries) with a TTL per entry
+- Concurrent sends of the same content wait for the first upload
+- A rejected file_id is dropped and the bytes are uploaded again
+
+Usage:
+    await send_cached_document(bot, chat_id, data_bytes, "report.csv", caption="...")
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+from outbound import dispatch
+
+log = logging.getLogger("file_cache")
+
+FILE_CACHE_SIZE = 500
+FILE_CACHE_TTL = 24 * 3600
+
+
+class FileIdCache:
+    def __init__(self, max_size: int = FILE_CACHE_SIZE, ttl: float = FILE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._uploading: Dict[str, list] = {}    # key -> [lock, refs]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(content: bytes, filename: str = "") -> str:
+        h = hashlib.sha256(filename.encode("utf-8"))
+        h.update(b"\0")
+        h.update(content)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        file_id, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key: str, file_id: str):
+        self._entries[key] = (file_id, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: str):
+        self._entries.pop(key, None)
+
+    async def send(self, bot, chat_id: int, content: bytes, filename: str,
+                   lane: str = "interactive", **kwargs):
+        key = self.content_key(content, filename)
+
+        file_id = self.get(key)
+        if file_id:
+            try:
+                self.hits += 1
+                return await dispatch(lane, bot.send_document, chat_id, file_id, **kwargs)
+            except BadRequest as e:
+                log.warning(f"Cached file_id rejected, re-uploading {filename}: {e}")
+                self.discard(key)
+
+        # Reference-counted like session_store's locks: the last waiter
+        # removes the entry, also when the upload fails
+        entry = self._uploading.get(key)
+        if entry is None:
+            entry = self._uploading[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # Somebody else may have uploaded it while we waited
+                file_id = self.get(key)
+                if file_id:
+                    self.hits += 1
+                    return await dispatch(lane, bot.send_document, chat_id, file_id, **kwargs)
+
+                self.misses += 1
+                doc = types.InputFile(io.BytesIO(content), filename=filename)
+                message = await dispatch(lane, bot.send_document, chat_id, doc, **kwargs)
+                try:
+                    self.put(key, message.document.file_id)
+                except AttributeError:
+                    pass
+                return message
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._uploading.get(key) is entry:
+                del self._uploading[key]
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_cache: Optional[FileIdCache] = None
+
+
+def get_file_cache() -> FileIdCache:
+    global _cache
+    if _cache is None:
+        _cache = FileIdCache()
+    return _cache
+
+
+async def send_cached_document(bot, chat_id: int, content, filename: str,
+                               lane: str = "interactive", **kwargs):
+    """Send `content` (bytes or str) as a document, uploading it only once."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return await get_file_cache().send(bot, chat_id, content, filename, lane=lane, **kwargs)
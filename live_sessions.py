@@ -0,0 +1,100 @@
+"""
+LIVE SESSION REGISTRY
+
+Who is taking which test right now, answered from memory:
+
+    {(uid, tid): {"user_id", "test_id", "test_name", "student_name",
+                  "current_q", "total_q", "started_at", "last_activity"}}
+
+SessionStore.write() updates the entry and SessionStore.remove() drops it,
+so the registry always matches data/sessions. It is restored from the
+session files once at startup (the same scan also seeds the expiry index).
+Test names are resolved once per attempt from the tests index, not on every
+query.
+
+Used by get_users_with_active_sessions / get_user_sessions, /sessions,
+the "Live" activity panel and the reconnect-notification capture.
+"""
+
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger("live_sessions")
+
+_Key = Tuple[int, str]
+
+
+def _test_names() -> Dict[str, str]:
+    from utils import load_tests_index
+    try:
+        return {tid: rec.get("name") or "Test" for tid, rec in load_tests_index().get("tests", {}).items()}
+    except Exception as e:
+        log.warning(f"Tests index unavailable: {e}")
+        return {}
+
+
+class LiveSessionRegistry:
+    def __init__(self):
+        self._sessions: Dict[_Key, dict] = {}
+
+    def update(self, user_id: int, test_id: str, data: dict, test_name: Optional[str] = None):
+        key = (int(user_id), test_id)
+        entry = self._sessions.get(key)
+        if entry is None:
+            entry = self._sessions[key] = {
+                "user_id": key[0],
+                "test_id": test_id,
+                "test_name": test_name or _test_names().get(test_id, "Test"),
+            }
+        entry.update(
+            student_name=data.get("student_name"),
+            current_q=data.get("current_q", 1),
+            total_q=data.get("total_q", 0),
+            started_at=data.get("started_at", 0),
+            last_activity=data.get("last_updated") or time.time(),
+        )
+
+    def remove(self, user_id: int, test_id: str):
+        self._sessions.pop((int(user_id), test_id), None)
+
+    def get(self, user_id: int, test_id: str) -> Optional[dict]:
+        return self._sessions.get((int(user_id), test_id))
+
+    def active(self, since: float = 0) -> List[dict]:
+        """Sessions active since `since`, most recent first."""
+        out = [e for e in self._sessions.values() if e["last_activity"] >= since]
+        out.sort(key=lambda e: e["last_activity"], reverse=True)
+        return out
+
+    def for_user(self, user_id: int) -> List[dict]:
+        out = [e for (uid, _), e in self._sessions.items() if uid == int(user_id)]
+        out.sort(key=lambda e: e["last_activity"], reverse=True)
+        return out
+
+    def users(self, since: float = 0) -> List[int]:
+        return sorted({e["user_id"] for e in self._sessions.values() if e["last_activity"] >= since})
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def load(self) -> int:
+        """Restore from the session files (once, at startup)."""
+        from session_store import get_session_store
+        names = _test_names()
+        for (user_id, test_id), data in get_session_store().scan():
+            self.update(user_id, test_id, data, test_name=names.get(test_id, "Test"))
+        return len(self._sessions)
+
+
+_registry: Optional[LiveSessionRegistry] = None
+
+
+def get_live_sessions() -> LiveSessionRegistry:
+    global _registry
+    if _registry is None:
+        _registry = LiveSessionRegistry()
+        loaded = _registry.load()
+        if loaded:
+            log.info(f"Live sessions restored: {loaded}")
+    return _registry
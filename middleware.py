@@ -1,5 +1,12 @@
 import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from aiogram.dispatcher.handler import CancelHandler
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import FSMContext
 from aiogram.types import Update
 
 logger = logging.getLogger("bot.audit")
@@ -44,4 +51,322 @@ class AuditMiddleware(BaseMiddleware):
     async def on_post_process_update(self, update: Update, result, data: dict):
         """Log any errors that occurred during update processing"""
         if isinstance(result, Exception):
-            logger.error("Update processing failed: %s", result)
\ No newline at end of file
+            logger.error("Update processing failed: %s", result)
+
+# ---------- Throttling ----------
+
+throttle_log = logging.getLogger("bot.throttle")
+
+FLOOD_TEXT = "Test savollarini yaxshilab o'qib javob beramiz"
+BUSY_TEXT = "Bot hozir band, bir oz kutib qayta urinib ko'ring"
+
+# (callback data prefix, max calls, window seconds) — first match wins
+CALLBACK_POLICIES = (
+    ("ans:", 10, 60),
+    ("select_test:", 5, 30),
+    ("resume:", 3, 30),
+    ("restart:", 3, 30),
+)
+DEFAULT_POLICY = (30, 10)        # any update kind, per user
+GLOBAL_POLICY = (
+    int(os.getenv("THROTTLE_GLOBAL_CALLS", "300")),
+    float(os.getenv("THROTTLE_GLOBAL_WINDOW", "1")),
+)
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "50000"))
+
+
+class GCRALimiter:
+    """
+    Generic cell rate algorithm: "max_calls per window" kept as ONE float per
+    key (the theoretical arrival time). Keys live in an LRU; a key whose TAT
+    has passed carries no information and is evicted, and the table never
+    grows past max_keys (the least recently seen key is dropped first).
+    """
+
+    def __init__(self, max_keys: int = THROTTLE_MAX_KEYS):
+        self.max_keys = max(1, int(max_keys))
+        self._tat: "OrderedDict[tuple, float]" = OrderedDict()
+
+    @staticmethod
+    def _next_tat(tat: float, now: float, max_calls: int, window: float) -> Optional[float]:
+        interval = window / max_calls
+        tat = max(tat, now)
+        if tat - now > window - interval:
+            return None
+        return tat + interval
+
+    def check(self, *limits: Tuple[tuple, int, float], now: Optional[float] = None) -> Optional[tuple]:
+        """
+        Admit one call against every (key, max_calls, window) limit, or none:
+        returns the key of the first limit that rejects, None when admitted.
+        """
+        now = time.monotonic() if now is None else now
+        updates = []
+        for key, max_calls, window in limits:
+            tat = self._next_tat(self._tat.get(key, now), now, max_calls, window)
+            if tat is None:
+                return key
+            updates.append((key, tat))
+        for key, tat in updates:
+            self._tat[key] = tat
+            self._tat.move_to_end(key)
+        self._evict(now)
+        return None
+
+    def _evict(self, now: float):
+        while self._tat:
+            key, tat = next(iter(self._tat.items()))
+            if tat > now and len(self._tat) <= self.max_keys:
+                break
+            del self._tat[key]
+
+    def __len__(self):
+        return len(self._tat)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Rejects floods in on_pre_process_update, i.e. before aiogram loads FSM
+    state or runs handler filters. Per-user limits per callback kind
+    (CALLBACK_POLICIES), a per-user default for every update and one global
+    limit. A flooding user gets one warning per window, not one per update.
+    """
+
+    def __init__(self, limiter: Optional[GCRALimiter] = None):
+        super().__init__()
+        self.limiter = limiter or GCRALimiter()
+        self._warned = GCRALimiter(max_keys=self.limiter.max_keys)
+        self.rejected = {"user": 0, "global": 0}
+
+    @staticmethod
+    def _policy(data: str) -> Tuple[str, int, float]:
+        for prefix, max_calls, window in CALLBACK_POLICIES:
+            if data.startswith(prefix):
+                return prefix, max_calls, window
+        return "", 0, 0
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        cb = update.callback_query
+        user = (
+            (update.message and update.message.from_user)
+            or (cb and cb.from_user)
+            or (update.poll_answer and update.poll_answer.user)
+        )
+        if not user:
+            return
+
+        limits = [((user.id, "*"), *DEFAULT_POLICY)]
+        if cb:
+            name, max_calls, window = self._policy(cb.data or "")
+            if name:
+                limits.append(((user.id, name), max_calls, window))
+        limits.append((("*",), *GLOBAL_POLICY))
+
+        rejected = self.limiter.check(*limits)
+        if rejected is None:
+            return
+
+        scope = "global" if rejected == ("*",) else "user"
+        self.rejected[scope] += 1
+        # One notice per user per 10 s, whatever the flood size
+        if self._warned.check(((user.id,), 1, 10.0)) is None:
+            text = BUSY_TEXT if scope == "global" else FLOOD_TEXT
+            try:
+                if cb:
+                    await cb.answer(text, show_alert=True)
+                elif update.message:
+                    await update.message.reply(text)
+            except Exception as e:
+                throttle_log.debug("Throttle notice failed for %s: %s", user.id, e)
+        elif cb:
+            try:
+                await cb.answer()
+            except Exception:
+                pass
+        throttle_log.info("Throttled %s update from %s (%s)", scope, user.id, rejected)
+        raise CancelHandler()
+
+    def stats(self) -> dict:
+        return {"keys": len(self.limiter), **self.rejected}
+
+# ---------- Callback idempotency ----------
+
+# Callbacks where a repeat of the same button on the same message can only
+# repeat the work. Not listed: toggles and pagination (a second tap means it)
+# and understand: (in edit-in-place mode every retry of a question reuses the
+# same message and the same "understand:yes" button)
+DEDUPE_CALLBACKS = ("ans:", "select_test:", "resume:", "restart:")
+CALLBACK_ID_TTL = 300.0          # Telegram redelivery of the same query
+CALLBACK_REPEAT_TTL = float(os.getenv("CALLBACK_REPEAT_TTL", "3"))   # double taps
+DEDUPE_MAX_KEYS = 20000
+
+
+class CallbackDedupMiddleware(BaseMiddleware):
+    """
+    Short-circuits duplicate callbacks in on_pre_process_update, before the
+    throttle, FSM state or any test is loaded: a callback query id seen in
+    the last CALLBACK_ID_TTL seconds, or the same (user, message, data) for
+    a DEDUPE_CALLBACKS button within CALLBACK_REPEAT_TTL, only gets an empty
+    answer_callback_query. Keys expire from the front of insertion-ordered
+    dicts, each capped at DEDUPE_MAX_KEYS.
+    """
+
+    def __init__(self, max_keys: int = DEDUPE_MAX_KEYS):
+        super().__init__()
+        self.max_keys = max_keys
+        # One dict per TTL, so insertion order is also expiry order
+        self._ids: "OrderedDict[str, float]" = OrderedDict()
+        self._repeats: "OrderedDict[tuple, float]" = OrderedDict()
+        self.suppressed = {"redelivered": 0, "repeated": 0}
+
+    def _seen(self, seen: OrderedDict, key, ttl: float, now: float) -> bool:
+        """True if `key` is still remembered; otherwise remember it for `ttl`."""
+        while seen:
+            _, expires = next(iter(seen.items()))
+            if expires > now and len(seen) < self.max_keys:
+                break
+            seen.popitem(last=False)
+        if key in seen:
+            return True
+        seen[key] = now + ttl
+        return False
+
+    def _duplicate(self, cb, now: Optional[float] = None) -> Optional[str]:
+        now = time.monotonic() if now is None else now
+        if self._seen(self._ids, cb.id, CALLBACK_ID_TTL, now):
+            return "redelivered"
+        data = cb.data or ""
+        if data.startswith(DEDUPE_CALLBACKS):
+            message_id = cb.message.message_id if cb.message else cb.inline_message_id
+            if self._seen(self._repeats, (cb.from_user.id, message_id, data), CALLBACK_REPEAT_TTL, now):
+                return "repeated"
+        return None
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        cb = update.callback_query
+        if cb is None:
+            return
+        kind = self._duplicate(cb)
+        if kind is None:
+            return
+        self.suppressed[kind] += 1
+        try:
+            await cb.answer()
+        except Exception:
+            pass
+        throttle_log.debug("Suppressed %s callback %s from %s", kind, cb.data, cb.from_user.id)
+        raise CancelHandler()
+
+    def stats(self) -> dict:
+        return {"keys": len(self._ids) + len(self._repeats), **self.suppressed}
+
+# ---------- FSM transaction ----------
+
+class StateTransaction(FSMContext):
+    """
+    FSMContext for one update: the data is loaded from storage once (on first
+    use), get_data/update_data/set_data work on that copy, and commit() writes
+    only the changed keys back in a single update_data (nothing if unchanged).
+    State changes (set_state, finish, reset_state) still go straight to storage.
+
+    After commit() the object is a plain FSMContext again, so work that outlives
+    the update (e.g. a queued admission) is not lost.
+
+        async with StateTransaction(dp.storage, chat=uid, user=uid) as state:
+            ...
+    """
+
+    def __init__(self, storage, chat, user):
+        super().__init__(storage, chat=chat, user=user)
+        self._working: Optional[dict] = None
+        self._changed: Set[str] = set()
+        self._replace = False
+        self._open = True
+
+    async def _load(self) -> dict:
+        if self._working is None:
+            self._working = await super().get_data() or {}
+        return self._working
+
+    async def get_data(self, default: Optional[dict] = None) -> Dict:
+        if not self._open:
+            return await super().get_data(default)
+        data = await self._load()
+        return dict(data) if data else (default or {})
+
+    async def update_data(self, data: Dict = None, **kwargs):
+        if not self._open:
+            return await super().update_data(data, **kwargs)
+        working = await self._load()
+        for source in (data, kwargs):
+            if source:
+                working.update(source)
+                self._changed.update(source)
+
+    async def set_data(self, data: Dict = None):
+        if not self._open:
+            return await super().set_data(data)
+        self._working = dict(data or {})
+        self._changed.clear()
+        self._replace = True
+
+    async def finish(self):
+        self._working, self._changed, self._replace = {}, set(), False
+        await super().finish()
+
+    async def reset_state(self, with_data: Optional[bool] = True):
+        if with_data:
+            self._working, self._changed, self._replace = {}, set(), False
+        await super().reset_state(with_data=with_data)
+
+    async def reset_data(self):
+        await self.set_data({})
+
+    async def commit(self):
+        """Write pending data changes (one storage call) and stop buffering."""
+        if not self._open:
+            return
+        self._open = False
+        if self._replace:
+            await super().set_data(self._working)
+        elif self._changed:
+            await super().update_data({k: self._working[k] for k in self._changed})
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.commit()
+
+
+class StateTransactionMiddleware(BaseMiddleware):
+    """
+    Gives every handler a StateTransaction instead of a plain FSMContext and
+    commits it when the handler is done (also when it failed: updates made
+    before an error were persisted before transactions existed, too).
+    """
+
+    async def _begin(self, data: dict):
+        state = data.get("state")
+        if isinstance(state, FSMContext) and not isinstance(state, StateTransaction):
+            data["state"] = StateTransaction(state.storage, chat=state.chat, user=state.user)
+
+    async def _commit(self, data: dict):
+        state = data.get("state")
+        if isinstance(state, StateTransaction):
+            try:
+                await state.commit()
+            except Exception as e:
+                logger.error("FSM commit failed for %s: %s", state.user, e)
+
+    async def on_process_message(self, message, data: dict):
+        await self._begin(data)
+
+    async def on_process_callback_query(self, cb, data: dict):
+        await self._begin(data)
+
+    async def on_post_process_message(self, message, results, data: dict):
+        await self._commit(data)
+
+    async def on_post_process_callback_query(self, cb, results, data: dict):
+        await self._commit(data)
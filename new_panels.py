@@ -18,7 +18,6 @@ from typing import List, Dict, Optional
 from datetime import datetime, timedelta
 from pathlib import Path
 import csv
-import io
 
 from activity_tracker import (
     get_recent_attempts,
@@ -41,6 +40,7 @@ from utils import (
     load_students,
 )
 
+from file_cache import send_cached_document
 from keyboards import (
     results_panel_kb,
     analytics_panel_kb,
@@ -332,12 +332,10 @@ async def export_results_csv(cb: types.CallbackQuery):
 
     # Create file
     filename = f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    file_obj = io.BytesIO(csv_content.encode('utf-8'))
-    file_obj.name = filename
 
-    # Send file
-    await cb.message.answer_document(
-        types.InputFile(file_obj, filename=filename),
+    # Send file (identical exports are uploaded only once - file_id cache)
+    await send_cached_document(
+        cb.bot, cb.message.chat.id, csv_content, filename,
         caption=f"📊 Test Results Export\n\nTotal attempts: {len(attempts)}"
     )
 
@@ -369,11 +367,9 @@ async def export_test_csv(cb: types.CallbackQuery):
     csv_content = export_attempts_to_csv(attempts)
 
     filename = f"{test_name[:20]}_{datetime.now().strftime('%Y%m%d')}.csv"
-    file_obj = io.BytesIO(csv_content.encode('utf-8'))
-    file_obj.name = filename
-
-    await cb.message.answer_document(
-        types.InputFile(file_obj, filename=filename),
+    # Identical exports are uploaded only once (file_id cache)
+    await send_cached_document(
+        cb.bot, cb.message.chat.id, csv_content, filename,
         caption=f"📊 Results for: {test_name}\n\nTotal attempts: {len(attempts)}"
     )
 
@@ -402,11 +398,9 @@ async def export_student_csv(cb: types.CallbackQuery):
     csv_content = export_attempts_to_csv(attempts)
 
     filename = f"{student_name[:20]}_{datetime.now().strftime('%Y%m%d')}.csv"
-    file_obj = io.BytesIO(csv_content.encode('utf-8'))
-    file_obj.name = filename
-
-    await cb.message.answer_document(
-        types.InputFile(file_obj, filename=filename),
+    # Identical exports are uploaded only once (file_id cache)
+    await send_cached_document(
+        cb.bot, cb.message.chat.id, csv_content, filename,
         caption=f"📊 History for: {student_name}\n\nTotal attempts: {len(attempts)}"
     )
 
@@ -658,11 +652,9 @@ async def activity_export(cb: types.CallbackQuery):
     csv_content = export_activity_logs_to_csv(logs)
 
     filename = f"activity_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    file_obj = io.BytesIO(csv_content.encode('utf-8'))
-    file_obj.name = filename
-
-    await cb.message.answer_document(
-        types.InputFile(file_obj, filename=filename),
+    # Identical exports are uploaded only once (file_id cache)
+    await send_cached_document(
+        cb.bot, cb.message.chat.id, csv_content, filename,
         caption=f"📋 Activity Logs Export\n\nTotal entries: {len(logs)}"
     )
 
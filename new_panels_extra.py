@@ -4,10 +4,10 @@ These are the missing features that were showing "Coming soon"
 """
 
 import logging
+import time
 from aiogram import types
 from datetime import datetime, timedelta
 from typing import List, Dict
-import io
 
 from activity_tracker import (
     get_recent_attempts,
@@ -22,11 +22,11 @@ from utils import (
     load_tests_index,
     load_group_titles,
     load_students,
-    get_users_with_active_sessions,
-    get_user_sessions,
     read_test,
 )
+from live_sessions import get_live_sessions
 
+from file_cache import send_cached_document
 from keyboards import back_kb
 
 log = logging.getLogger("new_panels_extra")
@@ -308,11 +308,9 @@ async def export_group_csv(cb: types.CallbackQuery):
     csv_content = export_attempts_to_csv(attempts)
 
     filename = f"{group_name[:20]}_{datetime.now().strftime('%Y%m%d')}.csv"
-    file_obj = io.BytesIO(csv_content.encode('utf-8'))
-    file_obj.name = filename
-
-    await cb.message.answer_document(
-        types.InputFile(file_obj, filename=filename),
+    # Identical exports are uploaded only once (file_id cache)
+    await send_cached_document(
+        cb.bot, cb.message.chat.id, csv_content, filename,
         caption=f"📊 Results for: {group_name}\n\nTotal attempts: {len(attempts)}"
     )
 
@@ -460,10 +458,10 @@ async def activity_live(cb: types.CallbackQuery):
 
     await cb.answer()
 
-    # Get users with active sessions (within last 6 hours)
-    active_user_ids = get_users_with_active_sessions(max_age_hours=6)
+    # Sessions active within the last 6 hours (live registry, most recent first)
+    active_sessions = get_live_sessions().active(since=time.time() - 6 * 3600)
 
-    if not active_user_ids:
+    if not active_sessions:
         text = (
             "🔴 <b>LIVE ACTIVITY</b>\n\n"
             "No students are currently taking tests.\n\n"
@@ -480,44 +478,38 @@ async def activity_live(cb: types.CallbackQuery):
     active_count = 0
     now = datetime.now()
 
-    for user_id in active_user_ids:
-        # Get session details for this user
-        sessions = get_user_sessions(user_id)
-
-        if not sessions:
-            continue
+    for session in active_sessions:
+        active_count += 1
+        user_id = session["user_id"]
 
         # Get student name
         student_info = students_data.get(str(user_id), {})
-        student_name = student_info.get("student_name", f"User {user_id}")
-
-        for session in sessions:
-            active_count += 1
-
-            test_name = session.get("test_name", "Unknown Test")
-            progress = session.get("progress", "0/0")
-            started_at = session.get("started_at", 0)
-
-            # Calculate time elapsed
-            if started_at:
-                elapsed_seconds = int(now.timestamp() - started_at)
-                if elapsed_seconds < 60:
-                    time_str = f"{elapsed_seconds}s ago"
-                elif elapsed_seconds < 3600:
-                    time_str = f"{elapsed_seconds // 60}m ago"
-                else:
-                    hours = elapsed_seconds // 3600
-                    mins = (elapsed_seconds % 3600) // 60
-                    time_str = f"{hours}h {mins}m ago"
+        student_name = session.get("student_name") or student_info.get("student_name", f"User {user_id}")
+
+        test_name = session.get("test_name", "Unknown Test")
+        progress = f"{session.get('current_q', 0)}/{session.get('total_q', 0)}"
+        started_at = session.get("started_at", 0)
+
+        # Calculate time elapsed
+        if started_at:
+            elapsed_seconds = int(now.timestamp() - started_at)
+            if elapsed_seconds < 60:
+                time_str = f"{elapsed_seconds}s ago"
+            elif elapsed_seconds < 3600:
+                time_str = f"{elapsed_seconds // 60}m ago"
             else:
-                time_str = "Unknown"
-
-            lines.append(
-                f"👤 <b>{student_name}</b>\n"
-                f"   📝 {test_name}\n"
-                f"   📊 Progress: {progress}\n"
-                f"   ⏱️ Started: {time_str}\n"
-            )
+                hours = elapsed_seconds // 3600
+                mins = (elapsed_seconds % 3600) // 60
+                time_str = f"{hours}h {mins}m ago"
+        else:
+            time_str = "Unknown"
+
+        lines.append(
+            f"👤 <b>{student_name}</b>\n"
+            f"   📝 {test_name}\n"
+            f"   📊 Progress: {progress}\n"
+            f"   ⏱️ Started: {time_str}\n"
+        )
 
     if active_count == 0:
         text = (
@@ -0,0 +1,208 @@
+"""
+ORDERED UPDATE PROCESSING
+
+aiogram processes every polled update as its own task, so two fast taps of
+one student ran through on_answer/_process_answer at the same time. The
+OrderedDispatcher routes updates into per-user serial queues instead:
+
+- updates of one user are handled one at a time, in arrival order
+- different users run in parallel, at most UPDATE_WORKERS handlers at once;
+  a handler that only waits (e.g. in the /start admission queue) gives its
+  worker slot back meanwhile: `async with worker_idle(): await ...`
+- a DEDUPE_CALLBACKS callback (answer, test selection, ...) identical to one
+  of the same user's still queued or running (same message, same button) is
+  dropped and just acknowledged; repeat taps of toggles, pagination and the
+  like always run
+- once a user has UPDATE_MAX_USER_QUEUE updates pending, further ones are
+  dropped (a flood would otherwise only reach the throttle at dequeue time)
+
+Updates without a user (channel posts, ...) are processed directly.
+
+Queue lengths and drop counters: dp.queue_metrics()
+"""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, Hashable, Optional, Set, Tuple
+
+from aiogram import Dispatcher, types
+
+from middleware import DEDUPE_CALLBACKS
+
+log = logging.getLogger("ordered_dispatch")
+
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+UPDATE_MAX_USER_QUEUE = int(os.getenv("UPDATE_MAX_USER_QUEUE", "20"))
+
+
+class _KeyQueue:
+    __slots__ = ("lock", "size", "callbacks")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()        # FIFO: waiters acquire in arrival order
+        self.size = 0                     # queued + running
+        self.callbacks: Set[Tuple] = set()
+
+
+class _WorkerSlot:
+    """One handler's claim on the executor's worker semaphore."""
+
+    __slots__ = ("executor", "held")
+
+    def __init__(self, executor: "KeyedExecutor"):
+        self.executor = executor
+        self.held = False
+
+    async def acquire(self):
+        await self.executor._semaphore().acquire()
+        self.held = True
+        self.executor.running += 1
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.executor.running -= 1
+            self.executor._semaphore().release()
+
+
+_current_slot: ContextVar[Optional[_WorkerSlot]] = ContextVar("update_worker_slot", default=None)
+
+
+@asynccontextmanager
+async def worker_idle():
+    """
+    Give the current handler's worker slot back while it waits; the user's
+    queue stays held, so their later updates still wait their turn.
+    Outside the executor this does nothing.
+    """
+    slot = _current_slot.get()
+    if slot is None or not slot.held:
+        yield
+        return
+    slot.release()
+    try:
+        yield
+    finally:
+        await slot.acquire()
+
+
+class KeyedExecutor:
+    """
+    Runs coroutines serially per key and concurrently across keys, with at
+    most `max_workers` running at once. Per-key queues exist only while
+    they have work (same reference counting as session_store's locks).
+    """
+
+    def __init__(self, max_workers: int = UPDATE_WORKERS, max_queue: int = UPDATE_MAX_USER_QUEUE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._workers: Optional[asyncio.Semaphore] = None
+        self._queues: Dict[Hashable, _KeyQueue] = {}
+        self.running = 0
+        self.processed = 0
+        self.dropped = {"duplicate": 0, "overflow": 0}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Created lazily, inside the running loop
+        if self._workers is None:
+            self._workers = asyncio.Semaphore(self.max_workers)
+        return self._workers
+
+    def admit(self, key: Hashable, fingerprint: Optional[Tuple] = None) -> Optional[str]:
+        """None if the item may be queued, else the drop reason."""
+        queue = self._queues.get(key)
+        if queue is None:
+            return None
+        if fingerprint is not None and fingerprint in queue.callbacks:
+            return "duplicate"
+        if queue.size >= self.max_queue:
+            return "overflow"
+        return None
+
+    async def run(self, key: Hashable, func, *args, fingerprint: Optional[Tuple] = None):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _KeyQueue()
+        queue.size += 1
+        if fingerprint is not None:
+            queue.callbacks.add(fingerprint)
+        try:
+            async with queue.lock:
+                slot = _WorkerSlot(self)
+                await slot.acquire()
+                token = _current_slot.set(slot)
+                try:
+                    return await func(*args)
+                finally:
+                    _current_slot.reset(token)
+                    slot.release()
+                    self.processed += 1
+        finally:
+            queue.size -= 1
+            if fingerprint is not None:
+                queue.callbacks.discard(fingerprint)
+            if queue.size == 0 and self._queues.get(key) is queue:
+                del self._queues[key]
+
+    def metrics(self) -> dict:
+        sizes = [q.size for q in self._queues.values()]
+        return {
+            "users": len(sizes),
+            "running": self.running,
+            "queued": sum(sizes) - self.running,
+            "max_user_queue": max(sizes, default=0),
+            "processed": self.processed,
+            "dropped_duplicates": self.dropped["duplicate"],
+            "dropped_overflow": self.dropped["overflow"],
+        }
+
+
+def _update_user(update: types.Update) -> Optional[int]:
+    for event in (
+        update.message, update.edited_message, update.callback_query,
+        update.my_chat_member, update.chat_member, update.inline_query,
+    ):
+        if event is not None and event.from_user:
+            return event.from_user.id
+    if update.poll_answer is not None:
+        return update.poll_answer.user.id
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher whose updates go through a per-user KeyedExecutor."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_queue = KeyedExecutor()
+
+    async def _process_ordered(self, update: types.Update):
+        user_id = _update_user(update)
+        if user_id is None:
+            return await self.updates_handler.notify(update)
+
+        cb = update.callback_query
+        fingerprint = None
+        if cb and cb.data and cb.data.startswith(DEDUPE_CALLBACKS):
+            fingerprint = (cb.message.message_id if cb.message else None, cb.data)
+        reason = self.update_queue.admit(user_id, fingerprint)
+        if reason:
+            self.update_queue.dropped[reason] += 1
+            log.debug(f"Dropped {reason} update {update.update_id} from {user_id}")
+            if cb:
+                try:
+                    await cb.answer()
+                except Exception:
+                    pass
+            return []
+        return await self.update_queue.run(user_id, self.updates_handler.notify, update, fingerprint=fingerprint)
+
+    async def process_updates(self, updates, fast: bool = True):
+        # Ordering is per user now, so one batch is always spread out
+        return await asyncio.gather(*(self._process_ordered(update) for update in updates))
+
+    def queue_metrics(self) -> dict:
+        return self.update_queue.metrics()
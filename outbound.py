@@ -0,0 +1,215 @@
+"""
+OUTBOUND DISPATCHER
+
+Every Bot API call that sends something goes through one of three lanes:
+
+- interactive  : replies to the student in front of the screen
+                 (cb.answer, next question, review)  — always served first
+- notification : admin reports, reminders
+- bulk         : broadcasts (test announcements, reconnect notices)
+
+Lanes share ONE rate budget (a token bucket sized below Telegram's global
+limit). Interactive work strictly pre-empts the other lanes; notification
+and bulk are served by weighted round-robin so bulk never starves.
+
+Usage:
+    from outbound import dispatch
+    await dispatch("interactive", cb.message.answer, text, reply_markup=kb)
+
+Queue depth and wait time per lane: get_outbound_metrics()
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from aiogram.utils.exceptions import RetryAfter
+
+log = logging.getLogger("outbound")
+
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "28"))         # msg/s shared by all lanes
+OUTBOUND_MAX_INFLIGHT = int(os.getenv("OUTBOUND_MAX_INFLIGHT", "16"))
+
+LANES = ("interactive", "notification", "bulk")
+# Weighted round-robin for the non-interactive lanes
+LANE_WEIGHTS = {"notification": 3, "bulk": 1}
+
+
+class TokenBucket:
+    """Async token bucket. `pause()` freezes it for a flood-wait period."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = max(0.1, float(rate))
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens only if they are available right now."""
+        now = time.monotonic()
+        if now < self._paused_until or self._lock.locked():
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (Telegram flood wait)."""
+        until = time.monotonic() + max(0.0, float(seconds))
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+
+
+_Job = Tuple[float, Callable, tuple, dict, asyncio.Future]
+
+
+class OutboundDispatcher:
+    def __init__(self, rate: float = OUTBOUND_RATE, max_inflight: int = OUTBOUND_MAX_INFLIGHT):
+        self.bucket = TokenBucket(rate)
+        self._queues: Dict[str, Deque[_Job]] = {lane: deque() for lane in LANES}
+        self._credits = dict(LANE_WEIGHTS)
+        self._inflight = asyncio.Semaphore(max(1, int(max_inflight)))
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks = set()
+        self._metrics = {
+            lane: {"sent": 0, "failed": 0, "wait_avg": 0.0, "wait_max": 0.0}
+            for lane in LANES
+        }
+
+    def _ensure_worker(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def dispatch(self, lane: str, func: Callable, *args, **kwargs) -> Any:
+        """Queue `func(*args, **kwargs)` on `lane` and wait for its result."""
+        if lane not in self._queues:
+            lane = "bulk"
+        fut = asyncio.get_event_loop().create_future()
+        self._queues[lane].append((time.monotonic(), func, args, kwargs, fut))
+        self._ensure_worker()
+        self._wakeup.set()
+        return await fut
+
+    def _next_lane(self) -> Optional[str]:
+        if self._queues["interactive"]:
+            return "interactive"
+        ready = [lane for lane in LANE_WEIGHTS if self._queues[lane]]
+        if not ready:
+            return None
+        if len(ready) == 1:
+            return ready[0]
+        if all(self._credits[lane] <= 0 for lane in ready):
+            self._credits = dict(LANE_WEIGHTS)
+        for lane in ready:
+            if self._credits[lane] > 0:
+                self._credits[lane] -= 1
+                return lane
+        return ready[0]
+
+    async def _run(self):
+        while True:
+            if not any(self._queues.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            await self._inflight.acquire()
+            # Lane is picked only now, so an interactive job that arrived
+            # while we waited for budget still goes first
+            lane = self._next_lane()
+            if lane is None:
+                self._inflight.release()
+                continue
+            job = self._queues[lane].popleft()
+            task = asyncio.ensure_future(self._execute(lane, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, lane: str, job: _Job):
+        enqueued_at, func, args, kwargs, fut = job
+        wait = time.monotonic() - enqueued_at
+        m = self._metrics[lane]
+        m["wait_avg"] = wait if m["sent"] + m["failed"] == 0 else (m["wait_avg"] * 0.9 + wait * 0.1)
+        m["wait_max"] = max(m["wait_max"], wait)
+        try:
+            result = await func(*args, **kwargs)
+            m["sent"] += 1
+            if not fut.done():
+                fut.set_result(result)
+        except RetryAfter as e:
+            # Flood wait is global for the bot: stop every lane
+            log.warning(f"Flood limit on {lane} lane, pausing outbound for {e.timeout}s")
+            self.bucket.pause(e.timeout + 1)
+            m["failed"] += 1
+            if not fut.done():
+                fut.set_exception(e)
+        except Exception as e:
+            m["failed"] += 1
+            if not fut.done():
+                fut.set_exception(e)
+        finally:
+            self._inflight.release()
+
+    def metrics(self) -> Dict[str, dict]:
+        out = {}
+        for lane in LANES:
+            m = self._metrics[lane]
+            queue = self._queues[lane]
+            oldest = (time.monotonic() - queue[0][0]) if queue else 0.0
+            out[lane] = {
+                "depth": len(queue),
+                "oldest_wait": round(oldest, 3),
+                "wait_avg": round(m["wait_avg"], 3),
+                "wait_max": round(m["wait_max"], 3),
+                "sent": m["sent"],
+                "failed": m["failed"],
+            }
+        return out
+
+
+_dispatcher: Optional[OutboundDispatcher] = None
+
+
+def get_outbound_dispatcher() -> OutboundDispatcher:
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = OutboundDispatcher()
+    return _dispatcher
+
+
+async def dispatch(lane: str, func: Callable, *args, **kwargs) -> Any:
+    return await get_outbound_dispatcher().dispatch(lane, func, *args, **kwargs)
+
+
+def get_outbound_metrics() -> Dict[str, dict]:
+    return get_outbound_dispatcher().metrics()
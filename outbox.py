@@ -0,0 +1,236 @@
+"""
+DURABLE OUTBOX
+
+Sends that must not be lost (admin result reports) are written to
+data/outbox.json BEFORE they are attempted. An item is removed only after
+every part was delivered, so a Bot API outage or a restart just leaves it
+pending; the heartbeat watchdog drains the outbox when connectivity returns.
+deliver() only enqueues and starts a background drain, so a handler never
+waits for the backlog.
+
+- Every item has an idempotency key: enqueueing the same key twice is a no-op,
+  and keys of delivered items are remembered for a day
+- Items are drained strictly in insertion order, one at a time, through the
+  "notification" lane of the outbound dispatcher (shared rate budget)
+- Delivery progress is stored per part, so a half-sent report resumes from
+  the first undelivered part instead of repeating the whole thing
+
+Usage:
+    from outbox import deliver
+    await deliver(f"report:{attempt_id}:{admin_id}", admin_id, chunks=[...])
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from aiogram.utils.exceptions import NetworkError, RetryAfter
+
+from file_cache import send_cached_document
+from outbound import dispatch
+
+log = logging.getLogger("outbox")
+
+OUTBOX_FILE = Path(os.getenv("OUTBOX_FILE", "data/outbox.json"))
+OUTBOX_MAX_ATTEMPTS = 5                 # non-network failures before an item is dropped
+OUTBOX_DRAIN_INTERVAL = 0.5             # pause between drained items (seconds)
+DELIVERED_KEY_TTL = 24 * 3600
+
+_TRANSIENT_ERRORS = (NetworkError, RetryAfter, asyncio.TimeoutError, ConnectionError, OSError)
+
+
+class Outbox:
+    def __init__(self, path: Path = OUTBOX_FILE):
+        self.path = path
+        self._lock = asyncio.Lock()
+        self._drain_lock = asyncio.Lock()
+        self._drain_task: Optional[asyncio.Task] = None
+        self._items: List[dict] = []
+        self._delivered: dict = {}
+        self._loaded = False
+
+    # ---------- persistence ----------
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            if self.path.exists():
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                self._items = list(data.get("items", []))
+                self._delivered = dict(data.get("delivered", {}))
+        except Exception as e:
+            log.error(f"Could not read outbox {self.path}: {e}")
+
+    def _save(self):
+        now = time.time()
+        self._delivered = {k: ts for k, ts in self._delivered.items() if now - ts < DELIVERED_KEY_TTL}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(
+                json.dumps({"items": self._items, "delivered": self._delivered}, ensure_ascii=False),
+                encoding="utf-8",
+            )
+            tmp.replace(self.path)
+        except Exception as e:
+            log.error(f"Could not persist outbox: {e}")
+
+    # ---------- public API ----------
+
+    def pending_count(self) -> int:
+        self._load()
+        return len(self._items)
+
+    async def enqueue(self, key: str, chat_id: int, chunks: Optional[List[str]] = None,
+                      document: Optional[dict] = None, **send_kwargs) -> bool:
+        """
+        Record a send. `chunks` are sent as separate messages, `document`
+        ({filename, content, caption}) as one file. Returns False if the key
+        is already pending or was delivered recently.
+        """
+        async with self._lock:
+            self._load()
+            if key in self._delivered or any(it["key"] == key for it in self._items):
+                return False
+            self._items.append({
+                "key": key,
+                "chat_id": int(chat_id),
+                "chunks": list(chunks or []),
+                "document": document,
+                "send_kwargs": send_kwargs,
+                "sent_parts": 0,
+                "attempts": 0,
+                "last_error": None,
+                "created_at": int(time.time()),
+            })
+            self._save()
+            return True
+
+    async def deliver(self, key: str, chat_id: int, chunks: Optional[List[str]] = None,
+                      document: Optional[dict] = None, **send_kwargs) -> bool:
+        """
+        Enqueue and start a background drain; the caller (a student's handler)
+        never waits for other pending items or for a send to time out.
+        Returns False if the key was already pending or delivered.
+        """
+        added = await self.enqueue(key, chat_id, chunks=chunks, document=document, **send_kwargs)
+        self.drain_soon()
+        return added
+
+    def drain_soon(self):
+        """Start a background drain unless one is already running."""
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.ensure_future(self._background_drain())
+
+    async def _background_drain(self):
+        try:
+            # Items enqueued while a drain was running are picked up here;
+            # a drain that delivered nothing (offline) is left to the watchdog
+            while await self.drain() and self._items:
+                pass
+        except Exception as e:
+            log.error(f"Background outbox drain failed: {e}")
+
+    def is_done(self, key: str) -> bool:
+        self._load()
+        return not any(it["key"] == key for it in self._items)
+
+    async def drain(self) -> int:
+        """
+        Deliver pending items in order. Stops at the first network failure
+        (still offline) and leaves the rest for the next drain.
+        Returns the number of items delivered.
+        """
+        from config import bot
+
+        delivered = 0
+        async with self._drain_lock:
+            self._load()
+            while self._items:
+                item = self._items[0]
+                try:
+                    await self._send_item(bot, item)
+                except _TRANSIENT_ERRORS as e:
+                    item["last_error"] = str(e)[:200]
+                    async with self._lock:
+                        self._save()
+                    log.warning(f"Outbox drain paused ({len(self._items)} pending): {e}")
+                    break
+                except Exception as e:
+                    item["attempts"] += 1
+                    item["last_error"] = str(e)[:200]
+                    async with self._lock:
+                        if item["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                            log.error(f"Outbox item {item['key']} dropped after {item['attempts']} attempts: {e}")
+                            self._items.pop(0)
+                        else:
+                            # Move it to the back so one bad recipient doesn't block the rest
+                            self._items.append(self._items.pop(0))
+                        self._save()
+                    if all(it["attempts"] > 0 for it in self._items):
+                        break
+                    continue
+
+                async with self._lock:
+                    self._items.pop(0)
+                    self._delivered[item["key"]] = int(time.time())
+                    self._save()
+                delivered += 1
+                if self._items:
+                    await asyncio.sleep(OUTBOX_DRAIN_INTERVAL)
+
+        if delivered:
+            log.info(f"Outbox delivered {delivered} item(s), {len(self._items)} pending")
+        return delivered
+
+    async def _send_item(self, bot, item: dict):
+        chat_id = item["chat_id"]
+        send_kwargs = item.get("send_kwargs") or {}
+        chunks = item.get("chunks") or []
+        while item["sent_parts"] < len(chunks):
+            await dispatch("notification", bot.send_message, chat_id, chunks[item["sent_parts"]],
+                           disable_web_page_preview=True, **send_kwargs)
+            item["sent_parts"] += 1
+            async with self._lock:
+                self._save()
+
+        doc = item.get("document")
+        if doc and not item.get("document_sent"):
+            # Same report to several admins is uploaded once (file_id cache)
+            await send_cached_document(bot, chat_id, doc.get("content", ""),
+                                       doc.get("filename", "report.html"),
+                                       lane="notification", caption=doc.get("caption"))
+            item["document_sent"] = True
+
+
+_outbox: Optional[Outbox] = None
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox()
+    return _outbox
+
+
+async def deliver(key: str, chat_id: int, chunks: Optional[List[str]] = None,
+                  document: Optional[dict] = None, **send_kwargs) -> bool:
+    return await get_outbox().deliver(key, chat_id, chunks=chunks, document=document, **send_kwargs)
+
+
+async def drain_outbox() -> int:
+    try:
+        return await get_outbox().drain()
+    except Exception as e:
+        log.error(f"Outbox drain failed: {e}")
+        return 0
+
+
+def outbox_pending_count() -> int:
+    return get_outbox().pending_count()
@@ -0,0 +1,226 @@
+"""
+QUESTION COMPILER
+
+A test is imported once and answered hundreds of times, so the Telegram-ready
+form of every question is built when the test is SAVED, not on every send.
+The compiled form is stored next to the source under test["compiled"]:
+
+    {
+      "version": "2.1",
+      "questions": {
+        "3": {
+          "lead_chunks": ["<pre><code>…</code></pre>"],   # long code, sent first
+          "head": "<b>Savol 3.</b>\\n…",                   # goes with the options
+          "options": {"A": "A) …", "B": "B) …"},
+          "poll": {"question": "3. …", "options": ["…"], "keys": ["A", "B"]}
+        }
+      },
+      "references": {"3": "…"}
+    }
+
+- Question text, options and references are sanitized once
+- Questions too long for one message are pre-split (code blocks kept whole);
+  the last piece is sent together with the options and the answer keyboard
+- Short plain-text questions also get a native quiz-poll form ("poll"),
+  None when the question has markup/code or does not fit poll limits
+- COMPILED_VERSION follows the sanitizer version: a test compiled by an older
+  sanitizer is recompiled (and re-saved) the first time it is used
+"""
+
+import html
+import logging
+import re
+from typing import List, Optional, Sequence, Tuple
+
+from telegram_html import (
+    MAX_TG_CHUNK,
+    SANITIZER_VERSION,
+    sanitize_html_for_telegram,
+    split_html_preserving_codeblocks,
+)
+
+log = logging.getLogger("question_compiler")
+
+COMPILED_VERSION = f"{SANITIZER_VERSION}.2"
+COMPILED_KEY = "compiled"
+
+OPTION_KEYS = ("A", "B", "C", "D")
+MIN_HEAD_BUDGET = 1000      # never split question text finer than this
+
+# Bot API sendPoll limits
+POLL_QUESTION_MAX = 300
+POLL_OPTION_MAX = 100
+POLL_EXPLANATION_MAX = 200
+
+
+def excluded_option_line(key: str) -> str:
+    return f"<s>{key}) ❌ Noto'g'ri</s>"
+
+
+def _plain(sanitized: str) -> Optional[str]:
+    """Plain text of sanitized HTML, or None if it carries any markup (tags, code)."""
+    if "<" in sanitized:
+        return None
+    return html.unescape(sanitized)
+
+
+def _compile_poll(idx, text: str, opts: dict) -> Optional[dict]:
+    question = _plain(text)
+    if not question:
+        return None
+    question = f"{idx}. {question}"
+    keys = [key for key in OPTION_KEYS if key in opts]
+    options = [_plain(sanitize_html_for_telegram(opts[key])) for key in keys]
+    if (len(question) > POLL_QUESTION_MAX or len(keys) < 2
+            or any(not o or len(o) > POLL_OPTION_MAX for o in options)):
+        return None
+    return {"question": question, "options": options, "keys": keys}
+
+
+def _compile_question(q: dict) -> dict:
+    idx = q.get("index")
+    text = sanitize_html_for_telegram(q.get("text") or "")
+    opts = q.get("options") or {}
+
+    # Header on its own line so it doesn't jam into a leading code block
+    header = f"<b>Savol {idx}.</b>"
+    head = f"{header}\n{text}" if text else header
+
+    options = {
+        key: f"{key}) {sanitize_html_for_telegram(opts[key])}"
+        for key in OPTION_KEYS if key in opts
+    }
+
+    lead_chunks: List[str] = []
+    options_len = sum(len(line) + 1 for line in options.values())
+    if len(head) + options_len > MAX_TG_CHUNK:
+        budget = max(MIN_HEAD_BUDGET, MAX_TG_CHUNK - options_len - len(header) - 1)
+        chunks = split_html_preserving_codeblocks(text, max_len=budget)
+        if chunks:
+            chunks[0] = f"{header}\n{chunks[0]}"
+            lead_chunks, head = chunks[:-1], chunks[-1]
+
+    return {"lead_chunks": lead_chunks, "head": head, "options": options,
+            "poll": _compile_poll(idx, text, opts)}
+
+
+def compile_test(test: dict) -> dict:
+    """Build the compiled form of a test from its source fields."""
+    questions = {}
+    for q in (test.get("questions") or []):
+        try:
+            questions[str(int(q.get("index", 0)))] = _compile_question(q)
+        except (ValueError, TypeError) as e:
+            log.warning(f"Skipping question with bad index in {test.get('test_id')}: {e}")
+
+    references = {
+        str(k): sanitize_html_for_telegram(v or "")
+        for k, v in (test.get("references") or {}).items()
+    }
+    return {"version": COMPILED_VERSION, "questions": questions, "references": references}
+
+
+def ensure_compiled(test: dict) -> dict:
+    """(Re)compile `test` in place before it is written. Returns the test."""
+    if isinstance(test, dict) and ("questions" in test or "references" in test):
+        test[COMPILED_KEY] = compile_test(test)
+    return test
+
+
+def get_compiled(test: dict) -> dict:
+    """
+    Compiled form of a loaded test. Tests saved before compilation existed,
+    or by an older sanitizer version, are compiled now and written back once.
+    """
+    compiled = test.get(COMPILED_KEY)
+    if isinstance(compiled, dict) and compiled.get("version") == COMPILED_VERSION:
+        return compiled
+
+    compiled = compile_test(test)
+    test[COMPILED_KEY] = compiled
+    test_id = test.get("test_id")
+    if test_id:
+        try:
+            from utils import read_test, write_test
+            stored = read_test(test_id)
+            if stored:
+                write_test(test_id, stored)
+        except Exception as e:
+            log.error(f"Could not persist compiled test {test_id}: {e}")
+    return compiled
+
+
+def _renumber(text: str, qidx, number) -> str:
+    old = f"<b>Savol {qidx}.</b>"
+    return f"<b>Savol {number}.</b>" + text[len(old):] if text.startswith(old) else text
+
+
+def render_question(test: dict, qidx: int, excluded_options: Optional[List[str]] = None,
+                    number: Optional[int] = None,
+                    option_order: Optional[Sequence[str]] = None) -> Optional[Tuple[List[str], str]]:
+    """
+    (lead_chunks, text) for question `qidx`: lead chunks are sent as-is,
+    `text` carries the options and goes with the answer keyboard.
+
+    Shuffled attempts pass the displayed `number` and `option_order` (canonical
+    keys in displayed order; they are relabelled A, B, ...). `excluded_options`
+    are displayed letters.
+    """
+    cq = get_compiled(test)["questions"].get(str(qidx))
+    if cq is None:
+        return None
+    excluded_options = excluded_options or []
+    lead_chunks, head = list(cq["lead_chunks"]), cq["head"]
+    if number is not None and number != int(qidx):
+        if lead_chunks:
+            lead_chunks[0] = _renumber(lead_chunks[0], qidx, number)
+        else:
+            head = _renumber(head, qidx, number)
+
+    options = cq["options"]
+    if option_order is not None:
+        # "A) text" → "<shown letter>) text"
+        options = {shown: f"{shown}) {options[key][len(key) + 2:]}"
+                   for shown, key in zip(OPTION_KEYS, option_order) if key in options}
+
+    lines = [head]
+    for key, line in options.items():
+        lines.append(excluded_option_line(key) if key in excluded_options else line)
+    return lead_chunks, "\n".join(lines)
+
+
+def compiled_reference(test: dict, qidx, default: str = "") -> str:
+    return get_compiled(test)["references"].get(str(qidx), default)
+
+
+def quiz_poll(test: dict, qidx, number: Optional[int] = None,
+              option_order: Optional[Sequence[str]] = None) -> Optional[dict]:
+    """
+    sendPoll arguments for question `qidx` in quiz mode, or None when it
+    must go through the inline-keyboard flow (markup, code, long options,
+    unknown correct answer). "keys" are the canonical letters of the poll
+    options in the order they are shown.
+    """
+    cq = get_compiled(test)["questions"].get(str(qidx))
+    poll = (cq or {}).get("poll")
+    correct = (test.get("answers") or {}).get(str(qidx))
+    if not poll or correct not in poll["keys"]:
+        return None
+
+    if number is not None or option_order is not None:
+        keys = [k for k in (option_order or poll["keys"]) if k in poll["keys"]]
+        by_key = dict(zip(poll["keys"], poll["options"]))
+        question = poll["question"]
+        if number is not None:
+            question = f"{number}." + question[len(f"{qidx}."):]
+        poll = {"question": question, "options": [by_key[k] for k in keys], "keys": keys}
+
+    explanation = compiled_reference(test, qidx)
+    plain = html.unescape(re.sub(r"<[^>]+>", "", explanation))
+    return {
+        "question": poll["question"],
+        "options": poll["options"],
+        "keys": poll["keys"],
+        "correct_option_id": poll["keys"].index(correct),
+        "explanation": explanation if explanation and len(plain) <= POLL_EXPLANATION_MAX else None,
+    }
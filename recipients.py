@@ -0,0 +1,157 @@
+"""
+UNREACHABLE RECIPIENT REGISTRY
+
+Remembers chats the bot cannot message, classified by the last error:
+
+- forbidden       : user blocked the bot or never pressed /start
+- chat_not_found  : chat id unknown to Telegram for this bot
+- deactivated     : account deleted
+
+Entries expire (a user may unblock the bot) and are cleared as soon as the
+user talks to the bot again. Broadcasts skip known-dead recipients instead
+of burning an API call on each of them.
+
+Stored in data/unreachable.json:
+    { "<chat_id>": {"reason", "error", "since", "last_seen", "expires_at"} }
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aiogram.utils.exceptions import (
+    BotBlocked, CantInitiateConversation, ChatNotFound, Unauthorized, UserDeactivated,
+)
+
+log = logging.getLogger("recipients")
+
+REGISTRY_FILE = Path(os.getenv("UNREACHABLE_FILE", "data/unreachable.json"))
+
+# How long a classification is trusted before the recipient is tried again
+REASON_TTL = {
+    "forbidden": 3 * 24 * 3600,
+    "chat_not_found": 7 * 24 * 3600,
+    "deactivated": 30 * 24 * 3600,
+}
+
+REASON_LABELS = {
+    "forbidden": "botni bloklagan yoki /start bosmagan",
+    "chat_not_found": "chat topilmadi",
+    "deactivated": "akkaunt o'chirilgan",
+}
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """Map a send error to a registry reason, or None if it is not permanent."""
+    if isinstance(error, UserDeactivated):
+        return "deactivated"
+    if isinstance(error, ChatNotFound):
+        return "chat_not_found"
+    if isinstance(error, (BotBlocked, CantInitiateConversation, Unauthorized)):
+        return "forbidden"
+    return None
+
+
+class UnreachableRegistry:
+    def __init__(self, path: Path = REGISTRY_FILE):
+        self.path = path
+        self._entries: Dict[str, dict] = {}
+        self._loaded = False
+        self._dirty = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            if self.path.exists():
+                self._entries = json.loads(self.path.read_text(encoding="utf-8")) or {}
+        except Exception as e:
+            log.error(f"Could not read unreachable registry: {e}")
+            self._entries = {}
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.path)
+            self._dirty = False
+        except Exception as e:
+            log.error(f"Could not persist unreachable registry: {e}")
+
+    def _live_entry(self, chat_id: int) -> Optional[dict]:
+        entry = self._entries.get(str(chat_id))
+        if entry and entry.get("expires_at", 0) > time.time():
+            return entry
+        return None
+
+    def get(self, chat_id: int) -> Optional[dict]:
+        self._load()
+        return self._live_entry(chat_id)
+
+    def is_unreachable(self, chat_id: int) -> bool:
+        return self.get(chat_id) is not None
+
+    def partition(self, chat_ids: Iterable[int]) -> Tuple[List[int], List[int]]:
+        """Split ids into (reachable, known_dead)."""
+        self._load()
+        alive, dead = [], []
+        for cid in chat_ids:
+            (dead if self._live_entry(cid) else alive).append(cid)
+        return alive, dead
+
+    def mark_unreachable(self, chat_id: int, reason: str, error: str = "", save: bool = True):
+        self._load()
+        now = int(time.time())
+        prev = self._entries.get(str(chat_id)) or {}
+        self._entries[str(chat_id)] = {
+            "reason": reason,
+            "error": (error or "")[:200],
+            "since": prev.get("since", now) if prev.get("reason") == reason else now,
+            "last_seen": now,
+            "expires_at": now + REASON_TTL.get(reason, REASON_TTL["forbidden"]),
+        }
+        self._dirty = True
+        if save:
+            self._save()
+
+    def mark_reachable(self, chat_id: int, save: bool = True) -> bool:
+        """Forget a recipient (it answered or a send succeeded). True if it was listed."""
+        self._load()
+        if self._entries.pop(str(chat_id), None) is None:
+            return False
+        self._dirty = True
+        if save:
+            self._save()
+        return True
+
+    def record_error(self, chat_id: int, error: BaseException, save: bool = True) -> Optional[str]:
+        reason = classify_error(error)
+        if reason:
+            self.mark_unreachable(chat_id, reason, str(error), save=save)
+        return reason
+
+    def flush(self):
+        """Drop expired entries and persist if anything changed."""
+        self._load()
+        now = time.time()
+        live = {k: v for k, v in self._entries.items() if v.get("expires_at", 0) > now}
+        if len(live) != len(self._entries):
+            self._entries = live
+            self._dirty = True
+        if self._dirty:
+            self._save()
+
+
+_registry: Optional[UnreachableRegistry] = None
+
+
+def get_unreachable_registry() -> UnreachableRegistry:
+    global _registry
+    if _registry is None:
+        _registry = UnreachableRegistry()
+    return _registry
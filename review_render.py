@@ -0,0 +1,176 @@
+"""
+REVIEW RENDERER
+
+Keeps rendered test reviews in memory and shows them one page at a time.
+
+- Rendered reviews live in a bounded LRU cache keyed by attempt_id;
+  after a restart (or eviction) they are rebuilt from the stored attempt
+- The review is sent as ONE message with ◀️ / ▶️ buttons; pages are
+  rendered on demand by editing that message
+- "📎 HTML" uploads the whole review as a document straight from memory
+  (once per content, see file_cache), nothing is written under data/
+
+Callback data (must fit in 64 bytes, so attempt ids are shortened):
+    rvp:<user_id>:<token>:<page>   – show page
+    rvf:<user_id>:<token>          – full review as a file
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+from aiogram import types
+
+from file_cache import send_cached_document
+from outbound import dispatch
+from telegram_html import split_html_preserving_codeblocks
+
+log = logging.getLogger("review_render")
+
+REVIEW_CACHE_SIZE = 256
+PAGE_MAX_LEN = 3600          # leaves room for the page header under Telegram's 4096
+
+
+class _Review:
+    __slots__ = ("attempt_id", "user_id", "html", "pages")
+
+    def __init__(self, attempt_id: str, user_id: int, html: str, pages: List[str]):
+        self.attempt_id = attempt_id
+        self.user_id = user_id
+        self.html = html
+        self.pages = pages
+
+
+_cache: "OrderedDict[str, _Review]" = OrderedDict()
+
+
+def attempt_token(attempt_id: str) -> str:
+    return hashlib.sha1(attempt_id.encode("utf-8")).hexdigest()[:10]
+
+
+def _paginate(html: str) -> List[str]:
+    return split_html_preserving_codeblocks(html, max_len=PAGE_MAX_LEN) or [html]
+
+
+def _user_of(attempt_id: str) -> int:
+    try:
+        return int(str(attempt_id).split("_", 1)[0])
+    except (ValueError, TypeError):
+        return 0
+
+
+def store_review(attempt_id: str, html: str, user_id: Optional[int] = None) -> _Review:
+    """Put a rendered review in the cache (most recent last)."""
+    review = _Review(attempt_id, user_id or _user_of(attempt_id), html, _paginate(html))
+    _cache[attempt_token(attempt_id)] = review
+    _cache.move_to_end(attempt_token(attempt_id))
+    while len(_cache) > REVIEW_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return review
+
+
+def get_review(attempt_id: str) -> Optional[_Review]:
+    return _lookup(_user_of(attempt_id), attempt_token(attempt_id))
+
+
+def _lookup(user_id: int, token: str) -> Optional[_Review]:
+    review = _cache.get(token)
+    if review is not None:
+        _cache.move_to_end(token)
+        return review
+
+    # Not cached: rebuild from the stored attempt of that student
+    try:
+        from activity_tracker import get_student_attempts
+        from admin_reports import build_attempt_review
+        for attempt in get_student_attempts(user_id):
+            attempt_id = attempt.get("attempt_id") or ""
+            if attempt_token(attempt_id) == token:
+                return store_review(attempt_id, build_attempt_review(attempt), user_id)
+    except Exception as e:
+        log.error(f"Could not rebuild review {user_id}:{token}: {e}")
+    return None
+
+
+def _page_text(review: _Review, page: int) -> str:
+    total = len(review.pages)
+    if total == 1:
+        return review.pages[0]
+    return f"📄 <b>Sahifa {page + 1}/{total}</b>\n\n{review.pages[page]}"
+
+
+def _page_keyboard(review: _Review, page: int) -> types.InlineKeyboardMarkup:
+    token = attempt_token(review.attempt_id)
+    total = len(review.pages)
+    kb = types.InlineKeyboardMarkup(row_width=3)
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"rvp:{review.user_id}:{token}:{page - 1}"))
+    if total > 1:
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"rvp:{review.user_id}:{token}:{page}"))
+    if page < total - 1:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"rvp:{review.user_id}:{token}:{page + 1}"))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("📎 HTML", callback_data=f"rvf:{review.user_id}:{token}"))
+    return kb
+
+
+async def send_review(bot, chat_id: int, attempt_id: str, html: Optional[str] = None,
+                      lane: str = "interactive"):
+    """Send page 1 of a review with navigation. `html` is rendered & cached if given."""
+    review = store_review(attempt_id, html) if html is not None else get_review(attempt_id)
+    if review is None:
+        raise LookupError(f"Review {attempt_id} not found")
+    await dispatch(lane, bot.send_message, chat_id, _page_text(review, 0),
+                   reply_markup=_page_keyboard(review, 0), disable_web_page_preview=True)
+
+
+def _can_view(viewer_id: int, review: _Review) -> bool:
+    if viewer_id == review.user_id:
+        return True
+    from utils import can_view_student_results
+    return can_view_student_results(viewer_id, review.user_id)
+
+
+async def cb_review_page(cb: types.CallbackQuery):
+    try:
+        _, uid, token, page = (cb.data or "").split(":")
+        uid, page = int(uid), int(page)
+    except ValueError:
+        return await cb.answer("Noto'g'ri so'rov")
+
+    review = _lookup(uid, token)
+    if review is None:
+        return await cb.answer("Natija topilmadi", show_alert=True)
+    if not _can_view(cb.from_user.id, review):
+        return await cb.answer("Ruxsat yo'q", show_alert=True)
+
+    page = max(0, min(page, len(review.pages) - 1))
+    try:
+        await dispatch("interactive", cb.message.edit_text, _page_text(review, page),
+                       reply_markup=_page_keyboard(review, page), disable_web_page_preview=True)
+    except Exception as e:
+        # MessageNotModified when the current page button is pressed
+        log.debug(f"Review page edit skipped: {e}")
+    await cb.answer()
+
+
+async def cb_review_file(cb: types.CallbackQuery):
+    try:
+        _, uid, token = (cb.data or "").split(":")
+        uid = int(uid)
+    except ValueError:
+        return await cb.answer("Noto'g'ri so'rov")
+
+    review = _lookup(uid, token)
+    if review is None:
+        return await cb.answer("Natija topilmadi", show_alert=True)
+    if not _can_view(cb.from_user.id, review):
+        return await cb.answer("Ruxsat yo'q", show_alert=True)
+
+    await cb.answer("⏳ Yuklanmoqda...")
+    await send_cached_document(cb.bot, cb.message.chat.id, review.html,
+                               f"review_{review.attempt_id}.html",
+                               caption="📎 To‘liq natijalar (HTML)")
@@ -0,0 +1,114 @@
+"""
+COMPACT SESSION ENCODING
+
+In memory (FSM data) a running attempt keeps three string-keyed dicts:
+
+    answers          {"1": "A", "3": "C"}
+    excluded_options {"3": ["A", "B"]}
+    wrong_attempts   {"3": 2}
+
+On disk (data/sessions/..., fsm_states.json) they are stored as three
+fixed-length strings, one character per question:
+
+    "a": "A-C"      answer letter, "-" = not answered
+    "x": "003"      hex digit, bit 0..3 = option A..D excluded
+    "w": "002"      wrong-attempt counter (0-9)
+    "_v": 1         SESSION_CODEC_VERSION
+
+so each save is a few short strings instead of a dict per question.
+Sessions without "_v" (written before this encoding) are decoded as-is and
+re-encoded on their next save. Data that does not fit the encoding (index
+out of range, unknown letter, counter > 9, or keys named like the encoded
+fields) is kept in the old dict form.
+"""
+
+from typing import Dict, List, Optional
+
+SESSION_CODEC_VERSION = 1
+
+_LETTERS = "ABCD"
+_EMPTY = "-"
+_DICT_FIELDS = ("answers", "excluded_options", "wrong_attempts")
+_CODE_FIELDS = ("a", "x", "w")
+
+
+def _length(data: dict) -> Optional[int]:
+    keys = set()
+    for field in _DICT_FIELDS:
+        keys.update((data.get(field) or {}).keys())
+    try:
+        indices = [int(k) for k in keys]
+    except (TypeError, ValueError):
+        return None
+    if any(i < 1 for i in indices):
+        return None
+    try:
+        total = int(data.get("total_q") or 0)
+    except (TypeError, ValueError):
+        total = 0
+    return max([total] + indices)
+
+
+def _encode_answers(answers: Dict[str, str], n: int) -> Optional[str]:
+    out = [_EMPTY] * n
+    for k, letter in answers.items():
+        if letter not in _LETTERS:
+            return None
+        out[int(k) - 1] = letter
+    return "".join(out)
+
+
+def _encode_excluded(excluded: Dict[str, List[str]], n: int) -> Optional[str]:
+    out = [0] * n
+    for k, letters in excluded.items():
+        for letter in letters or ():
+            if letter not in _LETTERS:
+                return None
+            out[int(k) - 1] |= 1 << _LETTERS.index(letter)
+    return "".join(format(m, "x") for m in out)
+
+
+def _encode_counters(counters: Dict[str, int], n: int) -> Optional[str]:
+    out = [0] * n
+    for k, count in counters.items():
+        if not isinstance(count, int) or not 0 <= count <= 9:
+            return None
+        out[int(k) - 1] = count
+    return "".join(map(str, out))
+
+
+def encode_session(data: dict) -> dict:
+    """Session dict for storage (a copy); the input is not modified."""
+    if not isinstance(data, dict) or not any(f in data for f in _DICT_FIELDS):
+        return data
+    if any(f in data for f in _CODE_FIELDS + ("_v",)):
+        return data         # would clash with the encoded fields
+    n = _length(data)
+    if n is None:
+        return data
+    encoded = (
+        _encode_answers(data.get("answers") or {}, n),
+        _encode_excluded(data.get("excluded_options") or {}, n),
+        _encode_counters(data.get("wrong_attempts") or {}, n),
+    )
+    if any(code is None for code in encoded):
+        return data
+
+    out = {k: v for k, v in data.items() if k not in _DICT_FIELDS}
+    out.update(zip(_CODE_FIELDS, encoded))
+    out["_v"] = SESSION_CODEC_VERSION
+    return out
+
+
+def decode_session(data: dict) -> dict:
+    """Stored session → in-memory form. Old (un-encoded) sessions pass through."""
+    if not isinstance(data, dict) or data.get("_v") != SESSION_CODEC_VERSION:
+        return data
+    out = {k: v for k, v in data.items() if k not in _CODE_FIELDS and k != "_v"}
+    out["answers"] = {str(i): c for i, c in enumerate(data.get("a") or "", 1) if c != _EMPTY}
+    out["excluded_options"] = {
+        str(i): [letter for bit, letter in enumerate(_LETTERS) if int(h, 16) & (1 << bit)]
+        for i, h in enumerate(data.get("x") or "", 1) if h != "0"
+    }
+    out["wrong_attempts"] = {str(i): int(c) for i, c in enumerate(data.get("w") or "", 1) if c != "0"}
+    return out
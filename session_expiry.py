@@ -0,0 +1,183 @@
+"""
+SESSION EXPIRY
+
+Every save through the session store (session_store.py) touches an
+in-memory index of last-activity times:
+
+    _last     {(uid, tid): last_activity}
+    _buckets  {minute: {(uid, tid), ...}}   + a min-heap of bucket numbers
+
+A touch moves the key to its new minute bucket (O(1)); expiry pops whole
+buckets older than the cutoff, so its cost is O(expired), not O(sessions),
+and nothing walks or stats the sessions directory after the one startup scan
+(shared with the live registry, live_sessions.py).
+
+An expired session that has answers is archived as an "incomplete attempt"
+(activity_tracker.save_incomplete_attempts) before its files are removed.
+Timed exams are left to exam_deadlines, which submits them itself.
+
+session_expiry_loop(dp) runs the expiry every SESSION_EXPIRY_INTERVAL
+seconds; /cleanup runs it on demand.
+"""
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from session_store import get_session_store, session_lock
+
+log = logging.getLogger("session_expiry")
+
+SESSION_MAX_AGE_HOURS = float(os.getenv("SESSION_MAX_AGE_HOURS", "24"))
+SESSION_EXPIRY_INTERVAL = int(os.getenv("SESSION_EXPIRY_INTERVAL", "900"))
+BUCKET_SECONDS = 60
+
+_Key = Tuple[int, str]
+
+
+class SessionIndex:
+    def __init__(self, bucket_seconds: int = BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self._last: Dict[_Key, float] = {}
+        self._buckets: Dict[int, Set[_Key]] = {}
+        self._bucket_heap: List[int] = []
+
+    def _bucket(self, ts: float) -> int:
+        return int(ts // self.bucket_seconds)
+
+    def touch(self, user_id: int, test_id: str, ts: Optional[float] = None):
+        key = (int(user_id), test_id)
+        ts = time.time() if ts is None else ts
+        old = self._last.get(key)
+        new_bucket = self._bucket(ts)
+        if old is not None:
+            old_bucket = self._bucket(old)
+            if old_bucket == new_bucket:
+                self._last[key] = max(old, ts)
+                return
+            self._unlink(key, old_bucket)
+        self._last[key] = ts
+        bucket = self._buckets.get(new_bucket)
+        if bucket is None:
+            bucket = self._buckets[new_bucket] = set()
+            heapq.heappush(self._bucket_heap, new_bucket)
+        bucket.add(key)
+
+    def discard(self, user_id: int, test_id: str):
+        key = (int(user_id), test_id)
+        ts = self._last.pop(key, None)
+        if ts is not None:
+            self._unlink(key, self._bucket(ts))
+
+    def _unlink(self, key: _Key, bucket_no: int):
+        bucket = self._buckets.get(bucket_no)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                # heap entry stays; popping a missing bucket is a no-op
+                del self._buckets[bucket_no]
+
+    def pop_expired(self, cutoff: float) -> List[Tuple[_Key, float]]:
+        """Remove and return every key last active before `cutoff` (to bucket precision)."""
+        out = []
+        limit = self._bucket(cutoff)
+        while self._bucket_heap and self._bucket_heap[0] < limit:
+            bucket_no = heapq.heappop(self._bucket_heap)
+            for key in self._buckets.pop(bucket_no, ()):
+                out.append((key, self._last.pop(key)))
+        return out
+
+    def __len__(self):
+        return len(self._last)
+
+    def load(self) -> int:
+        """Build the index at startup (from the live registry's one scan of the files)."""
+        from live_sessions import get_live_sessions
+        for entry in get_live_sessions().active():
+            self.touch(entry["user_id"], entry["test_id"], entry["last_activity"])
+        return len(self._last)
+
+
+_index: Optional[SessionIndex] = None
+
+
+def get_session_index() -> SessionIndex:
+    global _index
+    if _index is None:
+        _index = SessionIndex()
+        loaded = _index.load()
+        if loaded:
+            log.info(f"Session index: {loaded} session file(s)")
+    return _index
+
+
+def _incomplete_record(user_id: int, test_id: str, data: dict, last_activity: float) -> dict:
+    from utils import read_test
+    test = read_test(test_id) or {}
+    answers = data.get("answers") or {}
+    return {
+        "user_id": user_id,
+        "test_id": test_id,
+        "test_name": test.get("test_name"),
+        "student_name": data.get("student_name"),
+        "answered": len(answers),
+        "total_questions": data.get("total_q") or len(test.get("questions") or []),
+        "answers": answers,
+        "wrong_attempts": data.get("wrong_attempts") or {},
+        "started_at": data.get("started_at"),
+        "last_activity": last_activity,
+        "expired_at": time.time(),
+    }
+
+
+async def expire_sessions(max_age_hours: float = SESSION_MAX_AGE_HOURS, storage=None) -> Tuple[int, int]:
+    """
+    Remove sessions idle for longer than `max_age_hours`.
+    Returns (removed, archived as incomplete attempts).
+    """
+    from activity_tracker import save_incomplete_attempts
+    from exam_deadlines import is_expired
+
+    index, store = get_session_index(), get_session_store()
+    removed, archived = 0, []
+    for (user_id, test_id), last_activity in index.pop_expired(time.time() - max_age_hours * 3600):
+        async with session_lock(user_id, test_id):
+            data = store.read(user_id, test_id)
+            if data and data.get("deadline") and not is_expired(data):
+                index.touch(user_id, test_id)      # running timed exam: the deadline scheduler owns it
+                continue
+            store.remove(user_id, test_id)
+
+        if data and data.get("answers"):
+            archived.append(_incomplete_record(user_id, test_id, data, last_activity))
+        removed += 1
+
+        if storage is not None:
+            try:
+                fsm = await storage.get_data(chat=user_id, user=user_id)
+                if fsm.get("active_test_id") == test_id:
+                    await storage.finish(chat=user_id, user=user_id)
+            except Exception as e:
+                log.warning(f"Could not reset FSM of {user_id}: {e}")
+
+    if archived:
+        save_incomplete_attempts(archived)
+    if removed:
+        log.info(f"Expired {removed} session(s), {len(archived)} archived as incomplete")
+    return removed, len(archived)
+
+
+async def session_expiry_loop(dp):
+    get_session_store()         # migrates legacy files before the index is built
+    get_session_index()
+    while True:
+        try:
+            await expire_sessions(storage=dp.storage)
+            if hasattr(dp.storage, "cleanup_old_sessions"):
+                await dp.storage.cleanup_old_sessions(max_age_hours=SESSION_MAX_AGE_HOURS)
+        except Exception as e:
+            log.error(f"Session expiry run failed: {e}")
+        await asyncio.sleep(SESSION_EXPIRY_INTERVAL)
@@ -0,0 +1,240 @@
+"""
+SESSION STORE
+
+The one durable copy of a running attempt: data/sessions/<uid>/<tid>.json,
+compact-encoded (session_codec), written atomically under a per-session lock.
+
+    store = get_session_store()
+    await store.save(uid, tid, data)    # the one durable write per answer
+    await store.load(uid, tid)          # recovery, resume, FSM rehydration
+    await store.delete(uid, tid)
+    store.list_user(uid)                # [(tid, data), ...]
+
+FSM data (CustomJSONStorage) is a working copy: it is flushed lazily, and
+when it is loaded at startup the attempt fields of every running test are
+taken from this store.
+
+Legacy data/sessions/session_<uid>_<tid>.json files (the old utils writer)
+are moved into the per-user layout the first time the store is used; a
+stray legacy file found later is migrated when it is read.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from session_codec import decode_session, encode_session
+
+log = logging.getLogger("session_store")
+
+SESSIONS_DIR = Path("data/sessions")
+
+
+class _SessionLocks:
+    """
+    Per-session asyncio locks that exist only while someone holds or waits
+    for them: entries are reference-counted and removed by the last user.
+    Lookup is a plain dict access (the event loop is single-threaded, so no
+    registry-wide lock is needed) and the table size is bounded by the number
+    of sessions being saved/loaded right now, not by everyone who ever played.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}    # key -> [lock, refs]
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+_session_locks = _SessionLocks()
+
+
+def session_lock(user_id: int, test_id: str):
+    """`async with session_lock(uid, tid):` — exclusive access to one session file"""
+    return _session_locks.hold(f"{user_id}:{test_id}")
+
+
+def session_path(user_id: int, test_id: str) -> Path:
+    return SESSIONS_DIR / str(user_id) / f"{test_id}.json"
+
+
+def legacy_session_path(user_id: int, test_id: str) -> Path:
+    return SESSIONS_DIR / f"session_{user_id}_{test_id}.json"
+
+
+def _clean(data: dict) -> dict:
+    clean = dict(data)
+    clean["last_updated"] = int(time.time())
+    if "excluded_options" in clean:
+        clean["excluded_options"] = {
+            k: list(v) if isinstance(v, (set, list, tuple)) else []
+            for k, v in (clean["excluded_options"] or {}).items()
+        }
+    return clean
+
+
+def _read_file(path: Path) -> Optional[dict]:
+    try:
+        return decode_session(json.loads(path.read_text(encoding="utf-8")))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.error(f"Unreadable session file {path}: {e}")
+        return None
+
+
+def _write_file(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(encode_session(data), f, ensure_ascii=False, separators=(",", ":"))
+    tmp.replace(path)
+
+
+def _unlink(path: Path) -> bool:
+    try:
+        path.unlink()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class SessionStore:
+    # ----- sync core (callers hold the session lock, or run outside the loop) -----
+
+    def read(self, user_id: int, test_id: str) -> Optional[dict]:
+        data = _read_file(session_path(user_id, test_id))
+        if data is not None:
+            return data
+        legacy = legacy_session_path(user_id, test_id)
+        data = _read_file(legacy) if legacy.exists() else None
+        if data is not None:
+            self._migrate(user_id, test_id, data, legacy)
+        return data
+
+    def write(self, user_id: int, test_id: str, data: dict) -> bool:
+        from live_sessions import get_live_sessions
+        from session_expiry import get_session_index
+        clean = _clean(data)
+        try:
+            _write_file(session_path(user_id, test_id), clean)
+        except Exception as e:
+            log.error(f"Failed to save session for user {user_id}, test {test_id}: {e}")
+            return False
+        get_session_index().touch(user_id, test_id, clean["last_updated"])
+        get_live_sessions().update(user_id, test_id, clean)
+        return True
+
+    def remove(self, user_id: int, test_id: str) -> bool:
+        from live_sessions import get_live_sessions
+        from session_expiry import get_session_index
+        get_session_index().discard(user_id, test_id)
+        get_live_sessions().remove(user_id, test_id)
+        removed = False
+        for path in (session_path(user_id, test_id), legacy_session_path(user_id, test_id)):
+            try:
+                removed = _unlink(path) or removed
+            except OSError as e:
+                log.warning(f"Could not remove {path}: {e}")
+        try:
+            session_path(user_id, test_id).parent.rmdir()
+        except OSError:
+            pass        # other tests still there, or already gone
+        return removed
+
+    def list_user(self, user_id: int) -> List[Tuple[str, dict]]:
+        out = []
+        user_dir = SESSIONS_DIR / str(user_id)
+        for path in (user_dir.glob("*.json") if user_dir.exists() else ()):
+            data = _read_file(path)
+            if data is not None:
+                out.append((path.stem, data))
+        return out
+
+    def scan(self) -> Iterator[Tuple[Tuple[int, str], dict]]:
+        """Every stored session as ((uid, tid), data) — startup only."""
+        if not SESSIONS_DIR.exists():
+            return
+        for path in SESSIONS_DIR.glob("*/*.json"):
+            try:
+                user_id = int(path.parent.name)
+            except ValueError:
+                continue
+            data = _read_file(path)
+            if data is None:
+                continue
+            if not data.get("last_updated"):
+                try:
+                    data["last_updated"] = path.stat().st_mtime
+                except OSError:
+                    continue
+            yield (user_id, path.stem), data
+
+    def _migrate(self, user_id: int, test_id: str, data: dict, legacy: Path):
+        try:
+            current = session_path(user_id, test_id)
+            if not current.exists():
+                _write_file(current, data)
+            legacy.unlink()
+        except OSError as e:
+            log.warning(f"Could not migrate legacy session {legacy}: {e}")
+
+    def migrate_legacy(self) -> int:
+        """Move every session_<uid>_<tid>.json into data/sessions/<uid>/<tid>.json."""
+        moved = 0
+        for legacy in SESSIONS_DIR.glob("session_*.json") if SESSIONS_DIR.exists() else ():
+            try:
+                uid, tid = legacy.stem[len("session_"):].split("_", 1)
+                data = _read_file(legacy)
+                if data is None:
+                    continue
+                self._migrate(int(uid), tid, data, legacy)
+                moved += 1
+            except ValueError:
+                log.debug(f"Skipping unrecognized session file {legacy}")
+        return moved
+
+    # ----- async API -----
+
+    async def save(self, user_id: int, test_id: str, data: dict) -> bool:
+        async with session_lock(user_id, test_id):
+            return self.write(user_id, test_id, data)
+
+    async def load(self, user_id: int, test_id: str) -> Optional[dict]:
+        async with session_lock(user_id, test_id):
+            return self.read(user_id, test_id)
+
+    async def delete(self, user_id: int, test_id: str) -> bool:
+        async with session_lock(user_id, test_id):
+            return self.remove(user_id, test_id)
+
+
+_store: Optional[SessionStore] = None
+
+
+def get_session_store() -> SessionStore:
+    global _store
+    if _store is None:
+        _store = SessionStore()
+        moved = _store.migrate_legacy()
+        if moved:
+            log.info(f"Migrated {moved} legacy session file(s)")
+    return _store
@@ -0,0 +1,99 @@
+"""
+PER-ATTEMPT SHUFFLING
+
+Tests with test["shuffle"] = True show every attempt its own question order
+and option letters, so answers passed around a group chat are useless.
+
+Only a 32-bit seed is stored in the session ("shuffle_seed"); the question
+permutation and each question's option permutation are derived from it on
+demand (random.Random with a string seed is stable across runs and Python
+versions) and memoized in bounded LRU caches. Session size does not depend
+on test length, and the test itself is never copied.
+
+Coordinates:
+    position / displayed letter  – what the student sees and presses
+    qidx / canonical letter      – the test file; answers, attempts and
+                                   analytics are always stored canonical
+"""
+
+import random
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from question_compiler import OPTION_KEYS, get_compiled
+
+SHUFFLE_CACHE_SIZE = 1024
+
+
+def new_seed() -> int:
+    return random.SystemRandom().getrandbits(32)
+
+
+@lru_cache(maxsize=SHUFFLE_CACHE_SIZE)
+def _question_order(seed: int, indices: Tuple[int, ...]) -> Tuple[int, ...]:
+    order = list(indices)
+    random.Random(f"q:{seed}").shuffle(order)
+    return tuple(order)
+
+
+@lru_cache(maxsize=SHUFFLE_CACHE_SIZE * 8)
+def _option_order(seed: int, qidx: int, keys: Tuple[str, ...]) -> Tuple[str, ...]:
+    order = list(keys)
+    random.Random(f"o:{seed}:{qidx}").shuffle(order)
+    return tuple(order)
+
+
+class AttemptShuffle:
+    """Position/letter mapping of one attempt (cheap to build, nothing stored)."""
+
+    __slots__ = ("seed", "_questions", "_order")
+
+    def __init__(self, seed: int, test: dict):
+        self.seed = int(seed)
+        self._questions = get_compiled(test)["questions"]
+        self._order = _question_order(self.seed, tuple(sorted(int(k) for k in self._questions)))
+
+    def question(self, position: int) -> int:
+        """Canonical index of the question shown at `position` (1-based)."""
+        if 1 <= position <= len(self._order):
+            return self._order[position - 1]
+        return position
+
+    def position(self, qidx: int) -> int:
+        try:
+            return self._order.index(int(qidx)) + 1
+        except ValueError:
+            return int(qidx)
+
+    def option_order(self, qidx: int) -> Tuple[str, ...]:
+        """Canonical option keys in displayed order (displayed letters are A, B, ...)."""
+        cq = self._questions.get(str(qidx)) or {}
+        keys = tuple(key for key in OPTION_KEYS if key in (cq.get("options") or {}))
+        return _option_order(self.seed, int(qidx), keys)
+
+    def to_canonical(self, qidx: int, letter: str) -> Optional[str]:
+        order = self.option_order(qidx)
+        try:
+            return order[OPTION_KEYS.index(letter)]
+        except (ValueError, IndexError):
+            return None
+
+    def to_display(self, qidx: int, letter: str) -> Optional[str]:
+        order = self.option_order(qidx)
+        return OPTION_KEYS[order.index(letter)] if letter in order else None
+
+    def marks_to_display(self, answers: Dict[str, str]) -> Dict[str, str]:
+        """Canonical answers → {position: displayed letter} (answer sheet)."""
+        out = {}
+        for q, letter in (answers or {}).items():
+            shown = self.to_display(int(q), letter)
+            if shown:
+                out[str(self.position(int(q)))] = shown
+        return out
+
+
+def get_attempt_shuffle(session: dict, test: dict) -> Optional[AttemptShuffle]:
+    seed = (session or {}).get("shuffle_seed")
+    if seed is None or not test:
+        return None
+    return AttemptShuffle(seed, test)
@@ -5,9 +5,10 @@ import re
 import json
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
-from functools import wraps
+from functools import lru_cache
 from aiogram import types
 from aiogram.dispatcher import FSMContext
+from aiogram.utils.exceptions import MessageNotModified
 from states import StudentStates
 from utils import (
     available_tests_for_user,
@@ -19,9 +20,6 @@ from utils import (
     load_group_members,
     add_user_to_group,
     load_group_ids,
-    save_test_session,
-    load_test_session,
-    delete_test_session,
     get_user_sessions,
     get_user_admin_groups,
     remove_user_admin_privileges, 
@@ -29,289 +27,52 @@ from utils import (
 )
 import html
 import re
-log = logging.getLogger("student_handlers")
-
-
-# --- Markdown fenced code  ```lang ... ```  →  HTML <pre><code> normalizer ---
-
-_FENCE_RE = re.compile(
-    r"```([A-Za-z0-9_+\-]*)[ \t]*\n?([\s\S]*?)\n?```",
-    re.MULTILINE
+from outbound import dispatch
+from file_cache import send_cached_document
+# HTML sanitizer (single-pass tokenizer, memoized) lives in telegram_html
+from question_compiler import render_question, compiled_reference, quiz_poll
+from delivery_modes import get_delivery_mode
+from shuffle import AttemptShuffle, get_attempt_shuffle, new_seed
+from session_store import get_session_store
+from exam_deadlines import compute_deadline, finish_expired, get_deadline_scheduler, is_expired, window_error
+from telegram_html import (
+    MAX_TG_CHUNK as _MAX_TG_CHUNK,
+    split_html_preserving_codeblocks as _split_html_preserving_codeblocks,
 )
+log = logging.getLogger("student_handlers")
 
-_CODEBLOCK_RE = re.compile(r'(<pre><code[^>]*>.*?</code></pre>)', re.IGNORECASE | re.DOTALL)
-# --- HTML chunking helpers (kod bloklarini buzmasdan) ---
-
-_MAX_TG_CHUNK = 3900  # 4096 limitdan xavfsiz zaxira bilan
-
-def _split_plain_text_preserving_paragraphs(text: str, max_len: int = _MAX_TG_CHUNK) -> list:
-    """Oddiy tekst bo'lagini (HTML TAGsiz) paragraflar bo'yicha bo'lib chiqarish."""
-    parts = []
-    for para in text.split("\n\n"):
-        para = para.strip()
-        if not para:
-            continue
-        if len(para) <= max_len:
-            parts.append(para)
-        else:
-            # Juda uzun bo'lsa satrlar bo'yicha bo'lamiz
-            lines = para.splitlines()
-            buf, cur = [], 0
-            for ln in lines:
-                add = (len(ln) + 1)
-                if cur + add > max_len and buf:
-                    parts.append("\n".join(buf))
-                    buf, cur = [ln], len(ln) + 1
-                else:
-                    buf.append(ln); cur += add
-            if buf:
-                parts.append("\n".join(buf))
-    return parts
-
-def _split_codeblock_into_chunks(code_html: str, max_len: int = _MAX_TG_CHUNK) -> list:
-    """
-    <pre><code ...> ... </code></pre> blokini hajmga qarab bo'lish.
-    Kod ichini satr bo'yicha bo'lib, har bo'lakni alohida <pre><code>...</code></pre> qilib qaytaramiz.
-    """
-    # code_html: to'liq <pre><code ...>...</code></pre>
-    m = re.match(r'(?is)<pre><code([^>]*)>(.*)</code></pre>', code_html)
-    if not m:
-        # Format kutilgandek bo'lmasa, o'zi bo'lib yuboramiz (lekin bu kam uchraydi)
-        return _split_plain_text_preserving_paragraphs(code_html, max_len=max_len)
-
-    code_attrs = m.group(1) or ""
-    inner = m.group(2) or ""
-    if len(code_html) <= max_len:
-        return [code_html]
-
-    # Kodni satrlar bo'yicha bo'limiz
-    lines = inner.splitlines()
-    chunks, buf, cur = [], [], 0
-    # 50 belgi zaxira: <pre><code ...></code></pre> teglari uchun
-    inner_limit = max(200, max_len - 50)
-
-    for ln in lines:
-        add = len(ln) + 1
-        if cur + add > inner_limit and buf:
-            piece = "\n".join(buf)
-            chunks.append(f"<pre><code{code_attrs}>{piece}</code></pre>")
-            buf, cur = [ln], len(ln) + 1
-        else:
-            buf.append(ln); cur += add
-    if buf:
-        piece = "\n".join(buf)
-        chunks.append(f"<pre><code{code_attrs}>{piece}</code></pre>")
-    return chunks
-
-def _split_html_preserving_codeblocks(text: str, max_len: int = _MAX_TG_CHUNK) -> list:
-    """
-    Matnni kod bloklarini atom sifatida ko'rib bo'lish:
-      - Kod bloklarini (_CODEBLOCK_RE) topamiz, ularni bo'lak sifatida olamiz
-      - Kod bloklari orasidagi oddiy tekstni paragraflar/satrlar bo'yicha bo'lamiz
-      - Juda katta kod bloklarni ham alohida bo'lamiz
-    """
-    parts = []
-    pos = 0
-    for m in _CODEBLOCK_RE.finditer(text):
-        pre_text = text[pos:m.start()]
-        if pre_text:
-            parts.extend(_split_plain_text_preserving_paragraphs(pre_text, max_len=max_len))
-
-        code_html = m.group(1)
-        if len(code_html) <= max_len:
-            parts.append(code_html)
-        else:
-            parts.extend(_split_codeblock_into_chunks(code_html, max_len=max_len))
-
-        pos = m.end()
-
-    tail = text[pos:]
-    if tail:
-        parts.extend(_split_plain_text_preserving_paragraphs(tail, max_len=max_len))
-
-    # Endi parts bo'laklarini _MAX_TG_CHUNK ga "paketlab" birlashtiramiz
-    chunks, buf, cur = [], [], 0
-    for p in parts:
-        add = len(p) + 1
-        if cur + add > max_len and buf:
-            chunks.append("\n\n".join(buf).strip())
-            buf, cur = [p], len(p) + 1
-        else:
-            buf.append(p); cur += add
-    if buf:
-        chunks.append("\n\n".join(buf).strip())
-
-    return [c for c in chunks if c]
 
-async def _send_html_chunked(bot, chat_id: int, text: str, max_len: int = _MAX_TG_CHUNK):
+async def _send_html_chunked(bot, chat_id: int, text: str, max_len: int = _MAX_TG_CHUNK,
+                             lane: str = "interactive"):
     """
     HTML matnni (Telegram HTML qoidalari bo'yicha) xavfsiz bo'laklab jo'natish.
     Kod bloklari buzilmaydi. Juda ko'p bo'lak bo'lsa, fayl sifatida jo'natishga ham tushamiz.
+    `lane` — outbound navbati (talabaga: interactive, adminlarga: notification).
     """
     chunks = _split_html_preserving_codeblocks(text, max_len=max_len)
 
     # Juda ko'p bo'lak bo'lib ketgan bo'lsa (masalan, >6), xabar o'rniga fayl sifatida yuboramiz
     if len(chunks) > 6:
-        # HTML fayl sifatida saqlab, jo'natamiz
-        ts = int(time.time())
-        out_dir = Path("data/reviews")
-        out_dir.mkdir(parents=True, exist_ok=True)
-        file_path = out_dir / f"review_{chat_id}_{ts}.html"
-        file_path.write_text(text, encoding="utf-8")
         try:
-            await bot.send_document(chat_id, types.InputFile(str(file_path)), caption="📎 To‘liq natijalar ilovada (HTML).")
+            await send_cached_document(bot, chat_id, text, f"review_{chat_id}.html", lane=lane,
+                                       caption="📎 To‘liq natijalar ilovada (HTML).")
         except Exception as e:
             # Zaxira varianti sifatida qisqa xabar yuboramiz
             short = "Natijalar juda uzun. Ilovani ochishda muammo bo'lsa, admin bilan bog'laning."
-            await bot.send_message(chat_id, short, disable_web_page_preview=True)
+            await dispatch(lane, bot.send_message, chat_id, short, disable_web_page_preview=True)
         return
 
     # Oddiy holat: bo'laklab yuboramiz
     for i, ch in enumerate(chunks, 1):
         try:
-            await bot.send_message(chat_id, ch, disable_web_page_preview=True)
+            await dispatch(lane, bot.send_message, chat_id, ch, disable_web_page_preview=True)
         except Exception:
             # Agar baribir xatolik bo'lsa, qolganini fayl qilib jo'natamiz
-            ts = int(time.time())
-            out_dir = Path("data/reviews"); out_dir.mkdir(parents=True, exist_ok=True)
-            file_path = out_dir / f"review_{chat_id}_{ts}.html"
-            file_path.write_text(text, encoding="utf-8")
-            await bot.send_document(chat_id, types.InputFile(str(file_path)), caption="📎 To‘liq natijalar ilovada (HTML).")
+            await send_cached_document(bot, chat_id, text, f"review_{chat_id}.html", lane=lane,
+                                       caption="📎 To‘liq natijalar ilovada (HTML).")
             return
 
 
-def _normalize_fenced_code_to_html(text: str) -> str:
-    """
-    Convert Markdown-style fenced blocks into Telegram-safe HTML:
-        ```js console.log('hi') ```
-        ```python
-        print('x')
-        ```
-    becomes:
-        <pre><code class="language-js">console.log('hi')</code></pre>
-        <pre><code class="language-python">print(&#x27;x&#x27;)</code></pre>
-    """
-    if not text:
-        return ""
-
-    def _repl(m: re.Match) -> str:
-        lang = (m.group(1) or "").strip()
-        code = (m.group(2) or "")
-        # Ensure code is on its own lines (handles one-line ```js console.log(...) ```)
-        code = code.strip("\n")
-        # Escape code content so it’s safe when we later skip re-escaping placeholders
-        escaped = html.escape(code, quote=False)
-        class_attr = f' class="language-{lang}"' if lang else ""
-        return f"<pre><code{class_attr}>{escaped}</code></pre>"
-
-    return _FENCE_RE.sub(_repl, text)
-
-
-def sanitize_html_for_telegram(text: str) -> str:
-    """
-    Sanitize text for Telegram's HTML parser while preserving code blocks.
-    - Normalizes ```lang fences → <pre><code class="language-...">...</code></pre>
-    - Escapes dangerous chars outside allowed tags
-    - Preserves whitespace/newlines inside code blocks
-    Allowed tags: b, i, u, s, code, pre, a, tg-spoiler
-    """
-    if not text:
-        return ""
-
-    # 0) Normalize Markdown fences first (handles same-line code after ```lang and lone closing ```)
-    text = _normalize_fenced_code_to_html(text)
-
-    # 1) Temporarily extract code blocks to protect their content/whitespace
-    code_blocks = {}
-    def _stash_codeblock(m: re.Match) -> str:
-        idx = len(code_blocks)
-        key = f"__CODEBLOCK_{idx}__"
-        code_blocks[key] = m.group(1)
-        return key
-    text = _CODEBLOCK_RE.sub(_stash_codeblock, text)
-
-    # 2) Decode HTML entities
-    text = html.unescape(text)
-
-    # 3) Strip disallowed containers entirely
-    text = re.sub(r'<script[^>]*>.*?</script>', '', text, flags=re.IGNORECASE | re.DOTALL)
-    text = re.sub(r'<style[^>]*>.*?</style>', '', text, flags=re.IGNORECASE | re.DOTALL)
-    text = re.sub(r'</?(?:html|head|body|meta|link)[^>]*>', '', text, flags=re.IGNORECASE)
-
-    # 4) Keep only Telegram-supported tags (keep attributes as-is)
-    allowed_tags = ['b', 'i', 'u', 's', 'code', 'pre', 'a', 'tg-spoiler']  # matches your previous allow-list :contentReference[oaicite:3]{index=3}
-    def _strip_unallowed_tags(m: re.Match) -> str:
-        tag = m.group(1).lower()
-        return m.group(0) if tag in allowed_tags else ''
-    text = re.sub(r'</?([a-zA-Z][a-zA-Z0-9]*)[^>]*>', _strip_unallowed_tags, text)
-
-    # 5) Escape &, <, > outside allowed tags
-    #    (Protect allowed tags with placeholders while escaping)
-    tag_placeholders = {}
-    ph_counter = 0
-    for tag in allowed_tags:
-        # opening
-        for m in re.finditer(fr'<{tag}[^>]*>', text, flags=re.IGNORECASE):
-            ph = f'__TAGPH_{ph_counter}__'; ph_counter += 1
-            tag_placeholders[ph] = m.group(0)
-            text = text.replace(m.group(0), ph, 1)
-        # closing
-        for m in re.finditer(fr'</{tag}>', text, flags=re.IGNORECASE):
-            ph = f'__TAGPH_{ph_counter}__'; ph_counter += 1
-            tag_placeholders[ph] = m.group(0)
-            text = text.replace(m.group(0), ph, 1)
-
-    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-
-    # Restore allowed tags
-    for ph, original in tag_placeholders.items():
-        text = text.replace(ph, original)
-
-    # 6) Light whitespace normalization OUTSIDE code blocks (preserve newlines)
-    #    - collapse runs of spaces/tabs
-    text = re.sub(r'[ \t\f\v]+', ' ', text)
-    #    - collapse 3+ blank lines to max 2
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = text.strip()
-
-    # 7) Restore code blocks (already escaped inside)
-    for ph, block in code_blocks.items():
-        text = text.replace(ph, block)
-
-    return text
-
-
-
-# Rate limiting
-_user_rate_limits = {}
-
-def rate_limit(max_calls=5, window_seconds=30):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(message_or_cb, *args, **kwargs):
-            user_id = (message_or_cb.from_user.id if hasattr(message_or_cb, 'from_user') 
-                      else message_or_cb.message.from_user.id)
-            
-            now = time.time()
-            user_calls = _user_rate_limits.get(user_id, [])
-            
-            # Remove old calls outside window
-            user_calls = [call_time for call_time in user_calls if now - call_time < window_seconds]
-            
-            if len(user_calls) >= max_calls:
-                if hasattr(message_or_cb, 'answer'):
-                    await message_or_cb.answer("Test savollarini yaxshilab o'qib javob beramiz", show_alert=True)
-                else:
-                    await message_or_cb.reply("Test savollarini yaxshilab o'qib javob beramiz")
-                return
-            
-            user_calls.append(now)
-            _user_rate_limits[user_id] = user_calls
-            
-            return await func(message_or_cb, *args, **kwargs)
-        return wrapper
-    return decorator
-
 # Enhanced error handling
 async def safe_student_operation(operation, cb_or_msg, *args, **kwargs):
     """Wrapper for safe student operations with comprehensive error handling"""
@@ -325,11 +86,11 @@ async def safe_student_operation(operation, cb_or_msg, *args, **kwargs):
             log.info(f"Callback query expired for user - this is normal after reconnection")
             try:
                 if hasattr(cb_or_msg, 'message'):
-                    await cb_or_msg.message.answer(
+                    await dispatch("interactive", cb_or_msg.message.answer,
                         "Ulanish tiklandi. Iltimos /start yuboring yoki testni davom ettiring."
                     )
                 else:
-                    await cb_or_msg.reply(
+                    await dispatch("interactive", cb_or_msg.reply,
                         "Ulanish tiklandi. Iltimos /start yuboring yoki testni davom ettiring."
                     )
             except Exception as notify_error:
@@ -352,49 +113,12 @@ async def safe_student_operation(operation, cb_or_msg, *args, **kwargs):
         
         try:
             if hasattr(cb_or_msg, 'message'):  # CallbackQuery
-                await cb_or_msg.message.answer(user_message)
+                await dispatch("interactive", cb_or_msg.message.answer, user_message)
             else:  # Message
-                await cb_or_msg.reply(user_message)
+                await dispatch("interactive", cb_or_msg.reply, user_message)
         except Exception as notify_error:
             log.error(f"Failed to notify user of error: {notify_error}")
 
-# Improved session management
-def get_user_session_dir(user_id: int) -> Path:
-    """Get session directory for a specific user"""
-    session_dir = Path("data/sessions") / str(user_id)
-    session_dir.mkdir(parents=True, exist_ok=True)
-    return session_dir
-
-def get_session_file_path(user_id: int, test_id: str) -> Path:
-    """Get session file path for user and test"""
-    return get_user_session_dir(user_id) / f"{test_id}.json"
-
-async def write_json_atomic(file_path: Path, data: dict) -> bool:
-    """Write JSON data atomically to prevent corruption"""
-    try:
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        temp_path = file_path.with_suffix('.tmp')
-        with open(temp_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        temp_path.replace(file_path)
-        return True
-    except Exception as e:
-        log.error(f"Failed to write JSON to {file_path}: {e}")
-        if temp_path.exists():
-            temp_path.unlink()
-        return False
-
-async def read_json_safe(file_path: Path, default=None) -> dict:
-    """Read JSON with error handling"""
-    try:
-        if not file_path.exists():
-            return default or {}
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        log.error(f"Failed to read JSON from {file_path}: {e}")
-        return default or {}
-
 # Input validation
 def validate_question_index(qidx_str: str, max_questions: int = 1000) -> tuple:
     """Validate question index input"""
@@ -416,82 +140,66 @@ def validate_test_id(test_id: str) -> bool:
 # Helpers
 # ------------------------------------------------------------------------------
 
-def _format_question(q: dict, excluded_options: List[str] = None) -> str:
-    """Format question with options, excluding specified ones — with HTML sanitization."""
-    idx = q.get("index")
-    text = q.get("text") or ""
-    opts = q.get("options") or {}
-    excluded_options = excluded_options or []
-
-    # Sanitize question text (this will also normalize ``` fences to <pre><code>…</code></pre>)
-    text = sanitize_html_for_telegram(text)
-
-    # Put header on its own line to avoid jamming with a leading code block
-    lines = [f"<b>Savol {idx}.</b>"]
-    if text:
-        lines.append(text)
-
-    for key in ("A", "B", "C", "D"):
-        if key in opts:
-            option_text = sanitize_html_for_telegram(opts[key])
-            if key not in excluded_options:
-                lines.append(f"{key}) {option_text}")
-            else:
-                lines.append(f"<s>{key}) ❌ Noto'g'ri</s>")
+# Reply markups are built once and reused as serialized JSON (Bot API accepts
+# reply_markup as a string): only qidx × 16 exclusion masks exist per test.
+_OPTION_BITS = {"A": 1, "B": 2, "C": 4, "D": 8}
+KEYBOARD_CACHE_SIZE = 2048
 
-    return "\n".join(lines)
 
+def _exclusion_mask(excluded_options: Optional[List[str]]) -> int:
+    mask = 0
+    for opt in (excluded_options or []):
+        mask |= _OPTION_BITS.get(opt, 0)
+    return mask
 
-def _get_question(test: dict, qidx: int) -> Optional[dict]:
-    for q in (test.get("questions") or []):
-        if int(q.get("index", 0)) == int(qidx):
-            return q
-    return None
 
-def _create_answer_keyboard(qidx: int, excluded_options: List[str] = None) -> types.InlineKeyboardMarkup:
-    """Create keyboard for answers, excluding specified options"""
-    excluded_options = excluded_options or []
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _answer_keyboard_json(qidx: int, mask: int) -> str:
     kb = types.InlineKeyboardMarkup(row_width=2)
     
     available_options = []
-    for opt in ["A", "B", "C", "D"]:
-        if opt not in excluded_options:
+    for opt, bit in _OPTION_BITS.items():
+        if not mask & bit:
             available_options.append(
                 types.InlineKeyboardButton(opt, callback_data=f"ans:{qidx}:{opt}")
             )
     
     for i in range(0, len(available_options), 2):
-        if i + 1 < len(available_options):
-            kb.row(available_options[i], available_options[i+1])
-        else:
-            kb.row(available_options[i])
+        kb.row(*available_options[i:i + 2])
     
-    return kb
+    return kb.as_json()
+
+def _create_answer_keyboard(qidx: int, excluded_options: List[str] = None) -> str:
+    """Answer keyboard (serialized, cached), excluding specified options"""
+    return _answer_keyboard_json(int(qidx), _exclusion_mask(excluded_options))
 
-def _create_understanding_keyboard() -> types.InlineKeyboardMarkup:
-    """Create yes/no keyboard for understanding confirmation"""
+@lru_cache(maxsize=1)
+def _create_understanding_keyboard() -> str:
+    """Yes/no keyboard for understanding confirmation (serialized, built once)"""
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
         types.InlineKeyboardButton("✅ Ha, tushundim", callback_data="understand:yes"),
         types.InlineKeyboardButton("❌ Yo'q, qayta", callback_data="understand:no")
     )
-    return kb
+    return kb.as_json()
 
-def _create_tests_keyboard(tests: List[dict]) -> types.InlineKeyboardMarkup:
-    """Create inline keyboard with clickable test buttons"""
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _tests_keyboard_json(entries: Tuple[Tuple[str, str], ...]) -> str:
     keyboard = types.InlineKeyboardMarkup(row_width=1)
-    for test in tests:
-        test_id = test.get("test_id", "")
-        test_name = test.get("test_name", "Test")
+    for test_id, test_name in entries:
         display_name = test_name[:50] + "..." if len(test_name) > 50 else test_name
         button = types.InlineKeyboardButton(
             text=f"🧪 {display_name}",
             callback_data=f"select_test:{test_id}"
         )
         keyboard.add(button)
-    return keyboard
-
+    return keyboard.as_json()
 
+def _create_tests_keyboard(tests: List[dict]) -> str:
+    """Keyboard with clickable test buttons; students of one group share the cached markup"""
+    return _tests_keyboard_json(tuple(
+        (test.get("test_id", ""), test.get("test_name", "Test")) for test in tests
+    ))
 
 def _user_is_in_test_groups(user_id: int, test: dict) -> bool:
     """Check if user can access the test based on group membership"""
@@ -551,8 +259,8 @@ def _user_is_in_test_groups(user_id: int, test: dict) -> bool:
     
     return False
 
-def _review_lines(answers: Dict[str,str], test: dict) -> Tuple[List[str], Tuple[int,int]]:
-    """Generate review with detailed results - WITH HTML SANITIZATION"""
+def _review_lines(answers: Dict[str,str], test: dict, shuffled: bool = False) -> Tuple[List[str], Tuple[int,int]]:
+    """Generate review with detailed results (canonical question numbers and letters)"""
     correct = test.get("answers") or {}
     refs = test.get("references") or {}
     ok, total = score_user_answers(answers, correct)
@@ -580,6 +288,8 @@ def _review_lines(answers: Dict[str,str], test: dict) -> Tuple[List[str], Tuple[
     
     lines.append("")
     lines.append("<b>📋 Tafsilotlar:</b>")
+    if shuffled:
+        lines.append("<i>🔀 Savollar aralashtirilgan edi — quyida asl tartib va harflar.</i>")
     
     for i in range(1, total + 1):
         i_s = str(i)
@@ -590,100 +300,144 @@ def _review_lines(answers: Dict[str,str], test: dict) -> Tuple[List[str], Tuple[
         line = f"{i}. Sizning javobingiz: <b>{user_answer}</b> | To'g'ri javob: <b>{correct_answer}</b> {mark}"
         
         if user_answer != correct_answer and refs.get(i_s):
-            # SANITIZE reference text
-            ref_text = sanitize_html_for_telegram(refs[i_s])
+            ref_text = compiled_reference(test, i_s)
             line += f"\n   💡 <i>{ref_text}</i>"
         
         lines.append(line)
     
     return lines, (ok, total)
 
-async def _send_question(sender, test: dict, qidx: int, excluded_options: List[str] = None):
-    """Send question with excluded options"""
-    q = _get_question(test, qidx)
-    if not q:
+_TG_MESSAGE_LIMIT = 4096
+
+async def _edit_in_place(cb: types.CallbackQuery, text: str, reply_markup=None) -> bool:
+    """
+    "edit" delivery mode: replace the text and keyboard of the pressed message.
+    Returns False when the caller should send a new message instead.
+    """
+    if len(text) > _TG_MESSAGE_LIMIT:
+        return False
+    try:
+        await dispatch("interactive", cb.message.edit_text, text, reply_markup=reply_markup)
+        return True
+    except MessageNotModified:
+        return True
+    except Exception as e:
+        log.info(f"In-place edit failed, sending a new message: {e}")
+        return False
+
+def _sender_user(sender) -> types.User:
+    if isinstance(sender, types.User):
+        return sender
+    return sender.user if isinstance(sender, types.PollAnswer) else sender.from_user
+
+def _sender_chat_id(sender) -> int:
+    """
+    Private chat of the student for a CallbackQuery, Message, PollAnswer,
+    or a bare User (attempts auto-submitted by the deadline scheduler).
+    """
+    if isinstance(sender, types.CallbackQuery):
+        return sender.message.chat.id
+    if isinstance(sender, (types.PollAnswer, types.User)):
+        return _sender_user(sender).id
+    return sender.chat.id
+
+async def _send_quiz_poll(sender, state: FSMContext, test: dict, qidx: int,
+                          shuffle: Optional[AttemptShuffle] = None) -> bool:
+    """
+    "poll" delivery mode: send question at position `qidx` as a native quiz poll.
+    Returns False when the question needs the inline-keyboard flow instead.
+    """
+    from config import bot
+    if shuffle:
+        canon = shuffle.question(qidx)
+        poll = quiz_poll(test, canon, number=qidx, option_order=shuffle.option_order(canon))
+    else:
+        poll = quiz_poll(test, qidx)
+    if poll is None:
+        return False
+    try:
+        msg = await dispatch(
+            "interactive", bot.send_poll, _sender_chat_id(sender), poll["question"], poll["options"],
+            type="quiz", correct_option_id=poll["correct_option_id"], is_anonymous=False,
+            explanation=poll["explanation"],
+        )
+    except Exception as e:
+        log.warning(f"Quiz poll for question {qidx} failed, using buttons: {e}")
+        return False
+    await state.update_data(active_poll={"id": msg.poll.id, "qidx": qidx, "keys": poll["keys"]})
+    return True
+
+async def _send_question(sender, test: dict, qidx: int, excluded_options: List[str] = None,
+                         in_place: bool = False, notice: str = None, state: FSMContext = None):
+    """
+    Send the question at position `qidx` with excluded (displayed) options.
+    in_place: edit the callback's message instead (unless the question needs several messages).
+    notice: short line shown above the question (a separate message when not editing).
+    state: the attempt's FSM context — applies its shuffle and lets "poll" mode
+           send a fresh question as a quiz poll.
+    """
+    from config import bot
+    s = (await state.get_data()) if state is not None else {}
+    shuffle = get_attempt_shuffle(s, test)
+    if shuffle:
+        canon = shuffle.question(qidx)
+        rendered = render_question(test, canon, excluded_options, number=qidx,
+                                   option_order=shuffle.option_order(canon))
+    else:
+        rendered = render_question(test, qidx, excluded_options)
+    if rendered is None:
         log.error(f"Question {qidx} not found in test")
         return
     
-    txt = _format_question(q, excluded_options)
+    lead_chunks, txt = rendered
     kb = _create_answer_keyboard(qidx, excluded_options)
     
+    if in_place and not lead_chunks and isinstance(sender, types.CallbackQuery):
+        if await _edit_in_place(sender, f"{notice}\n\n{txt}" if notice else txt, kb):
+            return
+    
     try:
-        if isinstance(sender, types.CallbackQuery):
-            await sender.message.answer(txt, reply_markup=kb)
-        else:
-            await sender.answer(txt, reply_markup=kb)
+        chat_id = _sender_chat_id(sender)
+        if notice:
+            await dispatch("interactive", bot.send_message, chat_id, notice)
+        if (not excluded_options and s.get("delivery_mode") == "poll"
+                and await _send_quiz_poll(sender, state, test, qidx, shuffle)):
+            return
+        # Long code questions: pre-split parts first, options + keyboard last
+        for chunk in lead_chunks:
+            await dispatch("interactive", bot.send_message, chat_id, chunk)
+        await dispatch("interactive", bot.send_message, chat_id, txt, reply_markup=kb)
     except Exception as e:
         log.error(f"Failed to send question {qidx}: {e}")
 
 async def _save_session(user_id: int, test_id: str, session_data: dict):
-    """Save test session to persistent storage with improved error handling"""
-    try:
-        clean_data = session_data.copy()
-        clean_data['last_updated'] = int(time.time())
-        
-        if 'excluded_options' in clean_data:
-            clean_excluded = {}
-            for k, v in clean_data['excluded_options'].items():
-                if isinstance(v, set):
-                    clean_excluded[k] = list(v)
-                elif isinstance(v, list):
-                    clean_excluded[k] = v
-                else:
-                    clean_excluded[k] = []
-            clean_data['excluded_options'] = clean_excluded
-        
-        session_path = get_session_file_path(user_id, test_id)
-        success = await write_json_atomic(session_path, clean_data)
-        
-        if not success:
-            log.warning(f"Failed to save session for user {user_id}, test {test_id}")
-            # Fallback to old method
-            save_test_session(user_id, test_id, clean_data)
-            
-    except Exception as e:
-        log.error(f"Session save error for user {user_id}, test {test_id}: {e}")
-        # Fallback to old method
-        try:
-            save_test_session(user_id, test_id, session_data)
-        except Exception as fallback_error:
-            log.error(f"Fallback session save also failed: {fallback_error}")
+    """Persist the attempt — the one durable write per answer (session store)"""
+    if not await get_session_store().save(user_id, test_id, session_data):
+        log.warning(f"Failed to save session for user {user_id}, test {test_id}")
 
 async def _load_session(user_id: int, test_id: str) -> Optional[dict]:
-    """Load test session from persistent storage with improved error handling"""
+    """Load the attempt from the session store (legacy files are migrated on read)"""
     try:
-        session_path = get_session_file_path(user_id, test_id)
-        session_data = await read_json_safe(session_path)
-        
-        if session_data:
-            # Convert excluded_options back to expected format
-            if 'excluded_options' in session_data:
-                for k, v in session_data['excluded_options'].items():
-                    if isinstance(v, list):
-                        session_data['excluded_options'][k] = v
-            return session_data
-        
-        # Fallback to old method
-        return load_test_session(user_id, test_id)
-        
+        return await get_session_store().load(user_id, test_id)
     except Exception as e:
         log.error(f"Session load error for user {user_id}, test {test_id}: {e}")
-        # Fallback to old method
-        try:
-            return load_test_session(user_id, test_id)
-        except Exception as fallback_error:
-            log.error(f"Fallback session load also failed: {fallback_error}")
-            return None
+        return None
 
-async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
-    """Finish test and show results — SAFE CHUNKED SENDING"""
+async def _finish_test(cb, state: FSMContext, test: dict):
+    """
+    Finish test and show results — SAFE CHUNKED SENDING.
+    `cb` is the CallbackQuery (or PollAnswer in quiz-poll mode) that ended the test.
+    """
+    from config import bot
     s = await state.get_data()
+    user = _sender_user(cb)
+    chat_id = _sender_chat_id(cb)
     answers = s.get("answers", {})
     wrong_attempts = s.get("wrong_attempts", {})
     test_id = s.get("active_test_id")
 
     # 1) Review chiziqlarini tayyorlaymiz
-    review_lines, (ok, total) = _review_lines(answers, test)
+    review_lines, (ok, total) = _review_lines(answers, test, shuffled=s.get("shuffle_seed") is not None)
 
     # Urinishlar statistikasi
     review_lines.append("")
@@ -695,7 +449,7 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
 
     # 2) Talabaning profilini saqlash (har holda)
     try:
-        save_student_data(cb.from_user.id, {
+        save_student_data(user.id, {
             "full_name": s.get("student_name"),
             "last_test_id": test_id,
             "last_score": {"ok": ok, "total": total},
@@ -707,6 +461,7 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
         log.error(f"save_student_data failed: {e}")
 
     # NEW: Comprehensive activity tracking - save ALL test attempts
+    attempt_id = None
     try:
         from activity_tracker import save_test_attempt
         pct = round((ok / total) * 100, 2) if total else 0
@@ -716,11 +471,11 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
 
         # Get group_id from user groups
         from utils import get_user_groups
-        user_groups = get_user_groups(cb.from_user.id)
+        user_groups = get_user_groups(user.id)
         group_id = user_groups[0] if user_groups else None
 
-        save_test_attempt(
-            user_id=cb.from_user.id,
+        attempt_id = save_test_attempt(
+            user_id=user.id,
             test_id=test_id,
             test_name=test.get('test_name', 'Unknown Test'),
             student_name=s.get("student_name", "Unknown"),
@@ -735,37 +490,38 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
             started_at=started_at,
             finished_at=finished_at
         )
-        log.info(f"Saved comprehensive test attempt for user {cb.from_user.id}")
+        log.info(f"Saved comprehensive test attempt for user {user.id}")
     except Exception as e:
         log.error(f"Failed to save comprehensive test attempt: {e}")
 
-    # 3) Talabaga natijani yuborish — HTMLni xavfsiz bo'laklab yuboramiz
+    # 3) Talabaga natijani yuborish — bitta xabar, sahifalar ◀️/▶️ bilan (review_render)
     try:
-        from config import bot
-        await _send_html_chunked(bot, cb.message.chat.id, full_review_html, max_len=_MAX_TG_CHUNK)
+        from review_render import send_review
+        review_id = attempt_id or f"{user.id}_{test_id}_{int(time.time())}"
+        await send_review(bot, chat_id, review_id, full_review_html)
     except Exception as e:
         log.error(f"Student review send failed: {e}")
-        # Zaxira: qisqa sarlavha + to‘liq HTML fayl
+        # Zaxira: qisqa sarlavha + to‘liq HTML fayl (xotiradan)
         try:
             header = f"📊 <b>Yakuniy natija:</b> {ok}/{total}\n\nTo‘liq tafsilotlar ilovada."
-            await cb.message.answer(header)
-            ts = int(time.time())
-            out_dir = Path("data/reviews"); out_dir.mkdir(parents=True, exist_ok=True)
-            file_path = out_dir / f"review_{cb.from_user.id}_{test_id}_{ts}.html"
-            file_path.write_text(full_review_html, encoding="utf-8")
-            await cb.message.answer_document(types.InputFile(str(file_path)), caption="📎 To‘liq natijalar (HTML)")
+            await dispatch("interactive", bot.send_message, chat_id, header)
+            await send_cached_document(
+                bot, chat_id, full_review_html,
+                f"review_{user.id}_{test_id}.html",
+                caption="📎 To‘liq natijalar (HTML)",
+            )
         except Exception as e2:
             log.error(f"Fallback document send failed: {e2}")
 
     # 4) Admin/Ownerlarga xabar — xavfsiz bo‘laklash bilan
     try:
-        from config import bot, OWNER_ID
+        from config import OWNER_ID
         pct = round((ok / total) * 100, 1) if total else 0
         duration_min = int((time.time() - s.get('started_at', 0)) / 60)
 
         header = (
             "📊 <b>Test yakunlandi</b>\n\n"
-            f"👤 Talaba: {s.get('student_name')} (@{cb.from_user.username or 'username_yoq'})\n"
+            f"👤 Talaba: {s.get('student_name')} (@{user.username or 'username_yoq'})\n"
             f"🧪 Test: {test.get('test_name')}\n"
             f"📈 Natija: {ok}/{total} ({pct}%)\n"
             f"⏱ Vaqt: {duration_min} daqiqa\n\n"
@@ -773,13 +529,48 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
         )
         admin_payload = header + full_review_html
 
-        admin_ids = set(get_student_admins(cb.from_user.id) or [])
+        admin_ids = set(get_student_admins(user.id) or [])
         admin_ids.add(int(OWNER_ID))
-        admin_ids.discard(cb.from_user.id)
-
+        admin_ids.discard(user.id)
+
+        # Hisobotlar outbox orqali: Bot API ishlamay qolsa ham yo'qolmaydi,
+        # aloqa tiklanganda watchdog yetkazib beradi
+        from outbox import deliver
+        from admin_reports import get_report_mode, queue_completion
+        chunks = None
+        report_key = f"report:{user.id}:{test_id}:{int(s.get('started_at', 0))}"
+        completion = {
+            "attempt_id": attempt_id,
+            "user_id": user.id,
+            "username": user.username,
+            "student_name": s.get("student_name"),
+            "test_id": test_id,
+            "test_name": test.get("test_name"),
+            "ok": ok,
+            "total": total,
+            "pct": pct,
+            "duration_min": duration_min,
+            "finished_at": int(time.time()),
+        }
         for admin_id in admin_ids:
             try:
-                await _send_html_chunked(bot, admin_id, admin_payload, max_len=_MAX_TG_CHUNK)
+                # Digest/summary rejimidagi adminlarga faqat navbatga qo'shamiz
+                if get_report_mode(admin_id) != "immediate":
+                    await queue_completion(admin_id, completion)
+                    continue
+                if chunks is None:
+                    chunks = _split_html_preserving_codeblocks(admin_payload, max_len=_MAX_TG_CHUNK)
+                if len(chunks) > 6:
+                    await deliver(
+                        f"{report_key}:{admin_id}", admin_id,
+                        document={
+                            "filename": f"review_{user.id}_{test_id}.html",
+                            "content": admin_payload,
+                            "caption": "📎 To‘liq natijalar ilovada (HTML).",
+                        },
+                    )
+                else:
+                    await deliver(f"{report_key}:{admin_id}", admin_id, chunks=chunks)
             except Exception as e:
                 log.warning(f"Admin notify failed for {admin_id}: {e}")
     except Exception as e:
@@ -787,20 +578,15 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
 
     # 5) Sessiyani tozalash (har qanday holatda)
     if test_id:
+        await get_session_store().delete(user.id, test_id)
+
+    # 6) Final javob va state yakunlash
+    if isinstance(cb, types.CallbackQuery):
         try:
-            session_path = get_session_file_path(cb.from_user.id, test_id)
-            if session_path.exists():
-                session_path.unlink()
+            await dispatch("interactive", cb.answer, "Test yakunlandi!")
         except Exception:
+            # Agar callback allaqachon kech bo'lsa, jim
             pass
-        delete_test_session(cb.from_user.id, test_id)
-
-    # 6) Final javob va state yakunlash
-    try:
-        await cb.answer("Test yakunlandi!")
-    except Exception:
-        # Agar callback allaqachon kech bo'lsa, jim
-        pass
     await state.finish()
 
 
@@ -808,12 +594,12 @@ async def _finish_test(cb: types.CallbackQuery, state: FSMContext, test: dict):
 # Main handlers
 # ------------------------------------------------------------------------------
 
-def safe_callback_answer(cb: types.CallbackQuery, message: str = None, show_alert: bool = False):
+async def safe_callback_answer(cb: types.CallbackQuery, message: str = None, show_alert: bool = False):
     """
     Safely answer callback query, ignoring InvalidQueryID errors
     """
     try:
-        return cb.answer(message, show_alert=show_alert)
+        return await dispatch("interactive", cb.answer, message, show_alert=show_alert)
     except Exception as e:
         if "Query is too old" in str(e) or "invalid" in str(e).lower():
             log.debug(f"Callback query expired for user {cb.from_user.id}")
@@ -824,6 +610,13 @@ async def student_start(message: types.Message, state: FSMContext):
     """Entry point with enhanced new user detection and sync"""
     user_id = message.from_user.id
     
+    # Foydalanuvchi botga yozdi — endi unga xabar yuborish mumkin
+    try:
+        from recipients import get_unreachable_registry
+        get_unreachable_registry().mark_reachable(user_id)
+    except Exception:
+        pass
+    
     try:
         # Check if owner
         from utils import is_owner
@@ -838,7 +631,7 @@ async def student_start(message: types.Message, state: FSMContext):
             return await admin_panel(message, current_admin_groups)
         
         # For regular users, show loading and validate
-        loading_msg = await message.answer("🔍 Guruhlaringizni tekshiryapman...")
+        loading_msg = await dispatch("interactive", message.answer, "🔍 Guruhlaringizni tekshiryapman...")
         
         try:
             # Use the new validation function that syncs for new users
@@ -847,13 +640,13 @@ async def student_start(message: types.Message, state: FSMContext):
             
             # Delete loading message
             try:
-                await loading_msg.delete()
+                await dispatch("interactive", loading_msg.delete)
             except:
                 pass
             
             if not has_valid_groups:
                 # User is not in any groups
-                return await message.answer(
+                return await dispatch("interactive", message.answer,
                     "❌ Kechirasiz, siz hech qanday guruhimizning a'zosi emassiz.\n\n"
                     "Test olish uchun:\n"
                     "1. Bizning guruhlarimizdan biriga qo'shiling\n"
@@ -871,7 +664,7 @@ async def student_start(message: types.Message, state: FSMContext):
                 group_titles = load_group_titles()
                 group_names = [group_titles.get(gid, f"Guruh {gid}") for gid in valid_groups]
                 
-                return await message.answer(
+                return await dispatch("interactive", message.answer,
                     f"✅ Tabriklaymiz! Siz quyidagi guruhlarning a'zosisiz:\n"
                     + "\n".join([f"• {name}" for name in group_names]) + "\n\n"
                     f"📚 Ammo hozircha faol testlar yo'q.\n"
@@ -883,19 +676,19 @@ async def student_start(message: types.Message, state: FSMContext):
             
         except Exception as e:
             try:
-                await loading_msg.delete()
+                await dispatch("interactive", loading_msg.delete)
             except:
                 pass
             log.error(f"Validation failed for user {user_id}: {e}")
             
-            return await message.answer(
+            return await dispatch("interactive", message.answer,
                 "❌ Xatolik yuz berdi.\n"
                 "Iltimos, keyinroq qaytadan urinib ko'ring."
             )
             
     except Exception as e:
         log.error(f"Error in student_start: {e}")
-        await message.reply("Xatolik yuz berdi. Qaytadan /start buyrug'ini yuboring.")
+        await dispatch("interactive", message.reply, "Xatolik yuz berdi. Qaytadan /start buyrug'ini yuboring.")
 
         
 # ADD this function to student_handlers.py (it was referenced but missing):
@@ -990,25 +783,25 @@ async def show_available_tests(message: types.Message, state: FSMContext):
             # Provide more helpful message
             total_groups = len(user_groups + groups_from_membership)
             if total_groups > 0:
-                await message.answer(
+                await dispatch("interactive", message.answer,
                     f"📚 Siz {total_groups} ta guruhning a'zosisiz, lekin hozircha faol testlar yo'q.\n\n"
                     "Testlar faollashtirilganida sizga xabar beriladi."
                 )
             else:
-                await message.answer(
+                await dispatch("interactive", message.answer,
                     "❌ Sizga tayinlangan testlar topilmadi.\n\n"
                     "Agar guruhimizga yangi qo'shilgan bo'lsangiz, guruhda xabar yuboring va /start ni qayta bosing."
                 )
         else:
             keyboard = _create_tests_keyboard(tests)
-            await message.answer(
+            await dispatch("interactive", message.answer,
                 "<b>📚 Mavjud testlar:</b>\n"
                 "Testni boshlash uchun quyidagi tugmalardan birini bosing:",
                 reply_markup=keyboard
             )
     except Exception as e:
         log.error(f"Error in show_available_tests: {e}")
-        await message.answer(f"Xatolik yuz berdi: {e}")
+        await dispatch("interactive", message.answer, f"Xatolik yuz berdi: {e}")
 
 
 async def validate_user_access(user_id: int, test_id: str) -> Tuple[bool, str]:
@@ -1054,31 +847,25 @@ async def validate_user_access(user_id: int, test_id: str) -> Tuple[bool, str]:
 async def handle_new_test(cb: types.CallbackQuery, state: FSMContext):
     """Handle new test selection when user has unfinished sessions"""
     await show_available_tests(cb.message, state)
-    await cb.answer()
+    await dispatch("interactive", cb.answer)
 
 async def handle_resume(cb: types.CallbackQuery, state: FSMContext):
     """Handle test resume with improved recovery"""
     if not cb.data or not cb.data.startswith("resume:"):
-        return await cb.answer("Noto'g'ri format")
+        return await dispatch("interactive", cb.answer, "Noto'g'ri format")
     
     test_id = cb.data.replace("resume:", "")
     user_id = cb.from_user.id
     
     if not validate_test_id(test_id):
-        return await cb.answer("Noto'g'ri test ID", show_alert=True)
+        return await dispatch("interactive", cb.answer, "Noto'g'ri test ID", show_alert=True)
     
     try:
         # Attempt session recovery
         if not await recover_session_state(user_id, test_id, state):
-            await cb.answer("❌ Sessiya topilmadi yoki buzilgan", show_alert=True)
+            await dispatch("interactive", cb.answer, "❌ Sessiya topilmadi yoki buzilgan", show_alert=True)
             # Clean up corrupted session
-            try:
-                session_path = get_session_file_path(user_id, test_id)
-                if session_path.exists():
-                    session_path.unlink()
-            except:
-                pass
-            delete_test_session(user_id, test_id)
+            await get_session_store().delete(user_id, test_id)
             return await show_available_tests(cb.message, state)
         
         # Get recovered data
@@ -1086,32 +873,32 @@ async def handle_resume(cb: types.CallbackQuery, state: FSMContext):
         test = read_test(test_id)
         
         if not test:
-            await cb.answer("Test topilmadi yoki o'chirilgan", show_alert=True)
+            await dispatch("interactive", cb.answer, "Test topilmadi yoki o'chirilgan", show_alert=True)
             await state.finish()
             return await show_available_tests(cb.message, state)
         
         # Validate test access
         can_access, reason = await validate_user_access(user_id, test_id)
         if not can_access:
-            await cb.answer(f"❌ {reason}", show_alert=True)
+            await dispatch("interactive", cb.answer, f"❌ {reason}", show_alert=True)
             await state.finish()
             return await show_available_tests(cb.message, state)
         
         current_q = s.get("current_q", 1)
         total_q = s.get("total_q", 0)
         
-        await cb.message.answer(
+        await dispatch("interactive", cb.message.answer,
             f"✅ Test davom ettirilmoqda: <b>{test.get('test_name')}</b>\n"
             f"📊 Progress: {current_q}/{total_q}"
         )
         
         # Send current question with recovery support
         await safe_send_question_with_recovery(cb, user_id, test_id, state)
-        await cb.answer()
+        await dispatch("interactive", cb.answer)
         
     except Exception as e:
         log.error(f"Error in handle_resume: {e}", exc_info=True)
-        await cb.answer(
+        await dispatch("interactive", cb.answer,
             "❌ Xatolik yuz berdi. Yangi test boshlang.",
             show_alert=True
         )
@@ -1121,18 +908,18 @@ async def handle_resume(cb: types.CallbackQuery, state: FSMContext):
 async def handle_test_selection(cb: types.CallbackQuery, state: FSMContext):
     """Handle test selection with enhanced validation"""
     if not cb.data or not cb.data.startswith("select_test:"):
-        return await cb.answer("Noto'g'ri format")
+        return await dispatch("interactive", cb.answer, "Noto'g'ri format")
     
     tid = cb.data.replace("select_test:", "")
     user_id = cb.from_user.id
     
     if not validate_test_id(tid):
-        return await cb.answer("Noto'g'ri test ID", show_alert=True)
+        return await dispatch("interactive", cb.answer, "Noto'g'ri test ID", show_alert=True)
     
     # Enhanced validation
     can_access, reason = await validate_user_access(user_id, tid)
     if not can_access:
-        return await cb.answer(reason, show_alert=True)
+        return await dispatch("interactive", cb.answer, reason, show_alert=True)
     
     existing_session = await _load_session(user_id, tid)
     if existing_session:
@@ -1146,62 +933,56 @@ async def handle_test_selection(cb: types.CallbackQuery, state: FSMContext):
         total_q = existing_session.get("total_q", 0)
         progress = f"{current_q}/{total_q}"
         
-        await cb.message.answer(
+        await dispatch("interactive", cb.message.answer,
             f"Bu test uchun tugallanmagan sessiyangiz bor ({progress}).\nNima qilmoqchisiz?",
             reply_markup=kb
         )
-        return await cb.answer()
+        return await dispatch("interactive", cb.answer)
     
     log.info(f"User {user_id} selected test {tid}")
     
     try:
         test = read_test(tid)
         if not test or not test.get("questions"):
-            return await cb.answer("Test topilmadi yoki noto'g'ri fayl.", show_alert=True)
+            return await dispatch("interactive", cb.answer, "Test topilmadi yoki noto'g'ri fayl.", show_alert=True)
         
         await state.update_data(active_test_id=tid)
-        await cb.message.answer("Iltimos, to'liq ismingizni kiriting:")
+        await dispatch("interactive", cb.message.answer, "Iltimos, to'liq ismingizni kiriting:")
         await StudentStates.EnteringName.set()
-        await cb.answer()
+        await dispatch("interactive", cb.answer)
     except Exception as e:
         log.error(f"Error in handle_test_selection: {e}")
-        await cb.answer(f"Xatolik: {e}", show_alert=True)
+        await dispatch("interactive", cb.answer, f"Xatolik: {e}", show_alert=True)
 
 async def handle_restart(cb: types.CallbackQuery, state: FSMContext):
     """Handle test restart"""
     if not cb.data or not cb.data.startswith("restart:"):
-        return await cb.answer("Noto'g'ri format")
+        return await dispatch("interactive", cb.answer, "Noto'g'ri format")
     
     test_id = cb.data.replace("restart:", "")
     user_id = cb.from_user.id
     
     if not validate_test_id(test_id):
-        return await cb.answer("Noto'g'ri test ID", show_alert=True)
+        return await dispatch("interactive", cb.answer, "Noto'g'ri test ID", show_alert=True)
     
     # Clean up existing session
-    try:
-        session_path = get_session_file_path(user_id, test_id)
-        if session_path.exists():
-            session_path.unlink()
-    except:
-        pass
-    delete_test_session(user_id, test_id)
+    await get_session_store().delete(user_id, test_id)
     
     try:
         test = read_test(test_id)
         if not test or not test.get("questions"):
-            return await cb.answer("Test topilmadi yoki noto'g'ri fayl.", show_alert=True)
+            return await dispatch("interactive", cb.answer, "Test topilmadi yoki noto'g'ri fayl.", show_alert=True)
         
         if not _user_is_in_test_groups(cb.from_user.id, test):
-            return await cb.answer("Siz ushbu test uchun ro'yxatdan o'tmaganga o'xshaysiz.", show_alert=True)
+            return await dispatch("interactive", cb.answer, "Siz ushbu test uchun ro'yxatdan o'tmaganga o'xshaysiz.", show_alert=True)
         
         await state.update_data(active_test_id=test_id)
-        await cb.message.answer("Iltimos, to'liq ismingizni kiriting:")
+        await dispatch("interactive", cb.message.answer, "Iltimos, to'liq ismingizni kiriting:")
         await StudentStates.EnteringName.set()
-        await cb.answer()
+        await dispatch("interactive", cb.answer)
     except Exception as e:
         log.error(f"Error in handle_restart: {e}")
-        await cb.answer(f"Xatolik: {e}", show_alert=True)
+        await dispatch("interactive", cb.answer, f"Xatolik: {e}", show_alert=True)
 
 async def student_entering_name(message: types.Message, state: FSMContext):
     """Handle name input with validation"""
@@ -1210,17 +991,17 @@ async def student_entering_name(message: types.Message, state: FSMContext):
         
         # Input validation
         if not full_name:
-            return await message.reply("Iltimos, ismingizni kiriting.")
+            return await dispatch("interactive", message.reply, "Iltimos, ismingizni kiriting.")
         
         if len(full_name) < 2:
-            return await message.reply("Ism juda qisqa. Kamida 2 ta harf kiriting.")
+            return await dispatch("interactive", message.reply, "Ism juda qisqa. Kamida 2 ta harf kiriting.")
         
         if len(full_name) > 100:
-            return await message.reply("Ism juda uzun. 100 ta harfdan kam kiriting.")
+            return await dispatch("interactive", message.reply, "Ism juda uzun. 100 ta harfdan kam kiriting.")
         
         # Basic sanitization
         if not re.match(r'^[a-zA-ZА-Яа-яЁё\s\-\'\.]+$', full_name, re.UNICODE):
-            return await message.reply("Iltimos, faqat harflar va bo'sh joylardan foydalaning.")
+            return await dispatch("interactive", message.reply, "Iltimos, faqat harflar va bo'sh joylardan foydalaning.")
         
         await state.update_data(student_name=full_name)
         
@@ -1229,12 +1010,12 @@ async def student_entering_name(message: types.Message, state: FSMContext):
             types.InlineKeyboardButton("✅ Tasdiqlash", callback_data="st:name_ok"),
             types.InlineKeyboardButton("🔄 Qayta kiritish", callback_data="st:name_re"),
         )
-        await message.answer(f"Sizning ismingiz: <b>{full_name}</b>\nTasdiqlaysizmi?", reply_markup=kb)
+        await dispatch("interactive", message.answer, f"Sizning ismingiz: <b>{full_name}</b>\nTasdiqlaysizmi?", reply_markup=kb)
         await StudentStates.ConfirmingName.set()
         
     except Exception as e:
         log.error(f"Error in student_entering_name: {e}")
-        await message.reply("Xatolik yuz berdi. Qaytadan ismingizni kiriting.")
+        await dispatch("interactive", message.reply, "Xatolik yuz berdi. Qaytadan ismingizni kiriting.")
 
 async def student_confirming_name(cb: types.CallbackQuery, state: FSMContext):
     """Handle name confirmation"""
@@ -1242,9 +1023,9 @@ async def student_confirming_name(cb: types.CallbackQuery, state: FSMContext):
     
     try:
         if data == "st:name_re":
-            await cb.message.answer("Iltimos, to'liq ismingizni qayta kiriting:")
+            await dispatch("interactive", cb.message.answer, "Iltimos, to'liq ismingizni qayta kiriting:")
             await StudentStates.EnteringName.set()
-            return await cb.answer()
+            return await dispatch("interactive", cb.answer)
         
         if data == "st:name_ok":
             rules = (
@@ -1260,14 +1041,14 @@ async def student_confirming_name(cb: types.CallbackQuery, state: FSMContext):
             kb.add(
                 types.InlineKeyboardButton("🚀 Boshlaymiz", callback_data="st:understood")
             )
-            await cb.message.answer(rules, reply_markup=kb)
+            await dispatch("interactive", cb.message.answer, rules, reply_markup=kb)
             await StudentStates.Understanding.set()
-            return await cb.answer()
+            return await dispatch("interactive", cb.answer)
         
-        await cb.answer("Noma'lum tanlov")
+        await dispatch("interactive", cb.answer, "Noma'lum tanlov")
     except Exception as e:
         log.error(f"Error in student_confirming_name: {e}")
-        await cb.answer("Xatolik yuz berdi")
+        await dispatch("interactive", cb.answer, "Xatolik yuz berdi")
 
 
 async def recover_session_state(user_id: int, test_id: str, state: FSMContext) -> bool:
@@ -1329,13 +1110,17 @@ async def safe_send_question_with_recovery(sender, user_id: int, test_id: str, s
         if not test:
             raise Exception("Test not found")
         
+        if s.get("delivery_mode") == "sheet":
+            from answer_sheet import send_sheet
+            return await send_sheet(sender, state, test)
+        
         current_q = int(s.get("current_q", 1))
         excluded_options = s.get("excluded_options", {})
         q_key = str(current_q)
         excluded_for_q = excluded_options.get(q_key, [])
         
         # Send question
-        await _send_question(sender, test, current_q, excluded_for_q)
+        await _send_question(sender, test, current_q, excluded_for_q, state=state)
         
     except Exception as e:
         log.error(f"Failed to send question for user {user_id}: {e}")
@@ -1347,22 +1132,29 @@ async def safe_send_question_with_recovery(sender, user_id: int, test_id: str, s
 async def process_understanding(cb: types.CallbackQuery, state: FSMContext):
     """Start the test with improved error handling"""
     if (cb.data or "") != "st:understood":
-        return await cb.answer("Noma'lum tanlov")
+        return await dispatch("interactive", cb.answer, "Noma'lum tanlov")
     
     try:
         s = await state.get_data()
         tid = s.get("active_test_id")
         if not tid:
             await state.finish()
-            return await cb.answer("Sessiya topilmadi")
+            return await dispatch("interactive", cb.answer, "Sessiya topilmadi")
         
         test = read_test(tid)
         if not test or not test.get("questions"):
             await state.finish()
-            return await cb.message.answer("Test topilmadi.")
+            return await dispatch("interactive", cb.message.answer, "Test topilmadi.")
+        
+        closed = window_error(test)
+        if closed:
+            await dispatch("interactive", cb.message.answer, closed)
+            return await dispatch("interactive", cb.answer)
         
+        started_at = int(time.time())
+        deadline = compute_deadline(test, started_at)
         session_data = {
-            "started_at": int(time.time()),
+            "started_at": started_at,
             "answers": {},
             "current_q": 1,
             "total_q": len(test.get("questions") or []),
@@ -1370,6 +1162,10 @@ async def process_understanding(cb: types.CallbackQuery, state: FSMContext):
             "excluded_options": {},
             "student_name": s.get("student_name"),
             "active_test_id": tid,
+            "delivery_mode": get_delivery_mode(test),
+            "shuffle_seed": new_seed() if test.get("shuffle") else None,
+            "deadline": deadline,
+            "username": cb.from_user.username,
         }
         
         await state.update_data(**session_data)
@@ -1377,12 +1173,23 @@ async def process_understanding(cb: types.CallbackQuery, state: FSMContext):
         
         await _save_session(cb.from_user.id, tid, session_data)
         
-        await cb.message.answer(f"Test boshlandi: <b>{test.get('test_name') or 'Test'}</b>\n\n")
-        await _send_question(cb, test, 1)
-        await cb.answer()
+        started = f"Test boshlandi: <b>{test.get('test_name') or 'Test'}</b>"
+        if deadline:
+            get_deadline_scheduler().schedule(cb.from_user.id, tid, deadline)
+            started += f"\n⏱ Tugash vaqti: <b>{time.strftime('%H:%M', time.localtime(deadline))}</b>"
+        
+        if session_data["delivery_mode"] == "sheet":
+            from answer_sheet import send_sheet
+            await dispatch("interactive", cb.message.answer, started)
+            await send_sheet(cb, state, test)
+            return await dispatch("interactive", cb.answer)
+        
+        # Always a new message; in "edit" mode it then becomes the test message
+        await _send_question(cb, test, 1, notice=started, state=state)
+        await dispatch("interactive", cb.answer)
     except Exception as e:
         log.error(f"Error in process_understanding: {e}")
-        await cb.answer("Xatolik yuz berdi")
+        await dispatch("interactive", cb.answer, "Xatolik yuz berdi")
 
 async def on_answer(cb: types.CallbackQuery, state: FSMContext):
     """
@@ -1395,16 +1202,16 @@ async def on_answer(cb: types.CallbackQuery, state: FSMContext):
     parts = data.split(":")
     if len(parts) != 3:
         log.warning(f"Invalid answer format: {data}")
-        return await cb.answer("Noto'g'ri format. /start ni bosing.", show_alert=True)
+        return await dispatch("interactive", cb.answer, "Noto'g'ri format. /start ni bosing.", show_alert=True)
     
     # Input validation
     valid, qidx = validate_question_index(parts[1])
     if not valid:
-        return await cb.answer("Noto'g'ri savol raqami. /start ni bosing.", show_alert=True)
+        return await dispatch("interactive", cb.answer, "Noto'g'ri savol raqami. /start ni bosing.", show_alert=True)
     
     opt = parts[2].upper()
     if opt not in ["A", "B", "C", "D"]:
-        return await cb.answer("Noto'g'ri javob varianti", show_alert=True)
+        return await dispatch("interactive", cb.answer, "Noto'g'ri javob varianti", show_alert=True)
     
     user_id = cb.from_user.id
     
@@ -1426,16 +1233,16 @@ async def on_answer(cb: types.CallbackQuery, state: FSMContext):
                     s = await state.get_data()
                     tid = s.get("active_test_id")
                     
-                    await cb.message.answer(
+                    await dispatch("interactive", cb.message.answer,
                         "✅ Sessiya tiklandi. Testni davom ettirishingiz mumkin."
                     )
                 else:
-                    return await cb.answer(
+                    return await dispatch("interactive", cb.answer,
                         "❌ Sessiyani tiklashda xatolik. /start ni bosib qaytadan boshlang.",
                         show_alert=True
                     )
             else:
-                return await cb.answer(
+                return await dispatch("interactive", cb.answer,
                     "Sessiya topilmadi. /start ni bosib yangi test boshlang.",
                     show_alert=True
                 )
@@ -1457,23 +1264,23 @@ async def on_answer(cb: types.CallbackQuery, state: FSMContext):
                 
                 # Try to recover and continue
                 if await recover_session_state(user_id, tid, state):
-                    await cb.message.answer(
+                    await dispatch("interactive", cb.message.answer,
                         "⚠️ Xatolik yuz berdi, lekin sessiya saqlandi.\n"
                         "Testni davom ettirish uchun /start ni bosing."
                     )
                 else:
-                    await cb.message.answer(
+                    await dispatch("interactive", cb.message.answer,
                         "❌ Xatolik yuz berdi. Sessiya saqlanmagan.\n"
                         "/start ni bosib qaytadan urinib ko'ring."
                     )
             else:
-                await cb.message.answer(
+                await dispatch("interactive", cb.message.answer,
                     "❌ Xatolik yuz berdi. /start ni bosib qaytadan boshlang."
                 )
                 
         except Exception as recovery_error:
             log.error(f"Recovery also failed: {recovery_error}")
-            await cb.message.answer(
+            await dispatch("interactive", cb.message.answer,
                 "❌ Jiddiy xatolik yuz berdi. /start ni bosing."
             )
 
@@ -1495,6 +1302,9 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
             await state.finish()
             return await safe_callback_answer(cb, "Test topilmadi yoki o'chirilgan.", show_alert=True)
 
+        if is_expired(s):
+            return await finish_expired(cb, state, test)
+
         current_q = int(s.get("current_q", 1))
         total_q = int(s.get("total_q", len(test.get("questions") or [])))
 
@@ -1505,24 +1315,33 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
         excluded_options: Dict[str, List[str]] = s.get("excluded_options", {})
         wrong_attempts: Dict[str, int] = s.get("wrong_attempts", {})
 
+        in_place = s.get("delivery_mode") == "edit"
+
+        # Shuffled attempt: the button carries position + displayed letter;
+        # answers, wrong_attempts and the answer key are canonical
+        shuffle = get_attempt_shuffle(s, test)
+        canon_q = shuffle.question(qidx) if shuffle else qidx
+        canon_opt = (shuffle.to_canonical(canon_q, opt) if shuffle else None) or opt
+        canon_key = str(canon_q)
+
         correct_answers = test.get("answers") or {}
-        correct_answer = correct_answers.get(str(qidx))
+        correct_answer = correct_answers.get(canon_key)
 
         refs = test.get("references") or {}
-        reference_raw = refs.get(str(qidx), "Izoh mavjud emas")
-        # 🔒 Sanitize reference to avoid "Can't parse entities" errors
-        reference_sanitized = sanitize_html_for_telegram(reference_raw)
+        reference_raw = refs.get(canon_key, "Izoh mavjud emas")
+        # 🔒 Sanitized at import time to avoid "Can't parse entities" errors
+        reference_sanitized = compiled_reference(test, canon_q, reference_raw)
 
         q_key = str(qidx)
         if q_key not in excluded_options:
             excluded_options[q_key] = []
-        if q_key not in answers:
-            answers[q_key] = opt
+        if canon_key not in answers:
+            answers[canon_key] = canon_opt
 
         # ✅ Correct answer
-        if opt == correct_answer:
+        if canon_opt == correct_answer:
             try:
-                await cb.answer("✅ To'g'ri javob!")
+                await dispatch("interactive", cb.answer, "✅ To'g'ri javob!")
             except Exception as e:
                 if "Query is too old" not in str(e):
                     log.error(f"Callback answer error: {e}")
@@ -1538,16 +1357,20 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
                 )
                 await _save_session(cb.from_user.id, tid, await state.get_data())
 
-                await cb.message.answer("── * 30")
-                await _send_question(cb, test, next_q)
+                if not in_place:
+                    await dispatch("interactive", cb.message.answer, "── * 30")
+                await _send_question(cb, test, next_q, in_place=in_place, state=state)
             else:
+                if in_place:
+                    # Drop the answer keyboard from the test message
+                    await _edit_in_place(cb, "🏁 Test yakunlandi. Natijalar quyida.")
                 await _finish_test(cb, state, test)
             return
 
         # ❌ Wrong answer
         if opt not in excluded_options[q_key]:
             excluded_options[q_key].append(opt)
-        wrong_attempts[q_key] = wrong_attempts.get(q_key, 0) + 1
+        wrong_attempts[canon_key] = wrong_attempts.get(canon_key, 0) + 1
 
         await state.update_data(
             excluded_options=excluded_options,
@@ -1559,7 +1382,7 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
         await _save_session(cb.from_user.id, tid, await state.get_data())
 
         try:
-            await cb.answer("❌ Noto'g'ri javob")
+            await dispatch("interactive", cb.answer, "❌ Noto'g'ri javob")
         except Exception as e:
             if "Query is too old" not in str(e):
                 log.error(f"Callback answer error: {e}")
@@ -1569,8 +1392,10 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
             f"📖 <b>Izoh:</b>\n{reference_sanitized}\n\n"
             f"Tushundingizmi?"
         )
+        if in_place and await _edit_in_place(cb, msg_html, _create_understanding_keyboard()):
+            return
         try:
-            await cb.message.answer(msg_html, reply_markup=_create_understanding_keyboard())
+            await dispatch("interactive", cb.message.answer, msg_html, reply_markup=_create_understanding_keyboard())
         except Exception as send_err:
             # Final fallback: send as plain text (no HTML parsing)
             log.warning(f"HTML send failed, falling back to plain text: {send_err}")
@@ -1579,7 +1404,7 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
                 "📖 Izoh:\n" + reference_raw + "\n\n"
                 "Tushundingizmi?"
             )
-            await cb.message.answer(
+            await dispatch("interactive", cb.message.answer,
                 msg_plain,
                 reply_markup=_create_understanding_keyboard(),
                 parse_mode=None
@@ -1588,10 +1413,63 @@ async def _process_answer(cb: types.CallbackQuery, state: FSMContext, qidx: int,
     except Exception as e:
         log.error(f"Error in _process_answer: {e}", exc_info=True)
         try:
-            await cb.message.answer("Xatolik yuz berdi. Iltimos /start yuboring.")
+            await dispatch("interactive", cb.message.answer, "Xatolik yuz berdi. Iltimos /start yuboring.")
         except Exception as msg_error:
             log.error(f"Failed to send error message: {msg_error}")
 
+async def on_poll_answer(poll_answer: types.PollAnswer, state: FSMContext):
+    """
+    Quiz-poll delivery mode: the student voted in the poll of the current question.
+    Telegram already showed right/wrong and the explanation, so the first vote is
+    recorded and the test moves on (there is no retry step for polls).
+    """
+    s = await state.get_data()
+    poll = s.get("active_poll") or {}
+    if not poll or poll.get("id") != poll_answer.poll_id or not poll_answer.option_ids:
+        return  # old poll, or a vote in somebody else's test
+
+    tid = s.get("active_test_id")
+    test = read_test(tid) if tid else None
+    if not test or not test.get("questions"):
+        await state.finish()
+        return
+
+    if is_expired(s):
+        return await finish_expired(poll_answer, state, test)
+
+    qidx = int(poll["qidx"])
+    current_q = int(s.get("current_q", 1))
+    total_q = int(s.get("total_q", len(test.get("questions") or [])))
+    if qidx != current_q:
+        return
+
+    try:
+        opt = poll["keys"][poll_answer.option_ids[0]]  # poll keys are canonical letters
+    except (IndexError, KeyError):
+        log.warning(f"Bad poll answer {poll_answer.option_ids} for question {qidx}")
+        return
+
+    shuffle = get_attempt_shuffle(s, test)
+    q_key = str(shuffle.question(qidx) if shuffle else qidx)
+    answers: Dict[str, str] = s.get("answers", {})
+    wrong_attempts: Dict[str, int] = s.get("wrong_attempts", {})
+    answers.setdefault(q_key, opt)
+    if opt != (test.get("answers") or {}).get(q_key):
+        wrong_attempts[q_key] = wrong_attempts.get(q_key, 0) + 1
+
+    if current_q < total_q:
+        await state.update_data(
+            current_q=current_q + 1,
+            answers=answers,
+            wrong_attempts=wrong_attempts,
+            active_poll=None,
+        )
+        await _save_session(poll_answer.user.id, tid, await state.get_data())
+        await _send_question(poll_answer, test, current_q + 1, state=state)
+    else:
+        await state.update_data(answers=answers, wrong_attempts=wrong_attempts, active_poll=None)
+        await _finish_test(poll_answer, state, test)
+
 async def process_understanding_response(cb: types.CallbackQuery, state: FSMContext):
     """Handle understanding confirmation - WITH IMPROVED CALLBACK HANDLING"""
     data = cb.data or ""
@@ -1602,20 +1480,29 @@ async def process_understanding_response(cb: types.CallbackQuery, state: FSMCont
     response = data.split(":")[1]
     
     s = await state.get_data()
+    in_place = s.get("delivery_mode") == "edit"
+    
+    if response == "no" and in_place:
+        # The explanation is still on screen in the test message
+        try:
+            await dispatch("interactive", cb.answer, "Izohni qayta o'qing")
+        except Exception as e:
+            if "Query is too old" not in str(e):
+                log.error(f"Callback answer error: {e}")
     
-    if response == "no":
-        reference = s.get("current_reference", "Izoh mavjud emas")
-        reference = sanitize_html_for_telegram(reference)
+    elif response == "no":
+        # Stored already sanitized by _process_answer
+        reference = s.get("current_reference") or "Izoh mavjud emas"
         msg = (
             f"❌ <b>Noto'g'ri javob!</b>\n\n"
             f"📖 <b>Izoh:</b>\n{reference}\n\n"
             f"Tushundingizmi?"
         )
-        await cb.message.answer(msg, reply_markup=_create_understanding_keyboard())
+        await dispatch("interactive", cb.message.answer, msg, reply_markup=_create_understanding_keyboard())
         
         # Safe callback answer
         try:
-            await cb.answer("Qayta o'qing")
+            await dispatch("interactive", cb.answer, "Qayta o'qing")
         except Exception as e:
             if "Query is too old" not in str(e):
                 log.error(f"Callback answer error: {e}")
@@ -1623,7 +1510,7 @@ async def process_understanding_response(cb: types.CallbackQuery, state: FSMCont
     elif response == "yes":
         # Safe callback answer
         try:
-            await cb.answer("Davom etamiz")
+            await dispatch("interactive", cb.answer, "Davom etamiz")
         except Exception as e:
             if "Query is too old" not in str(e):
                 log.error(f"Callback answer error: {e}")
@@ -1637,7 +1524,7 @@ async def process_understanding_response(cb: types.CallbackQuery, state: FSMCont
         excluded_for_q = excluded_options.get(q_key, [])
         
         if len(excluded_for_q) >= 3:
-            await cb.message.answer(
+            skip_notice = (
                 "⚠️ Ushbu savol uchun ko'p urinishlar bo'ldi. Keyingi savolga o'tamiz.\n"
                 "To'g'ri javobni test oxirida ko'rasiz."
             )
@@ -1650,15 +1537,21 @@ async def process_understanding_response(cb: types.CallbackQuery, state: FSMCont
                     waiting_understanding=False
                 )
                 await _save_session(cb.from_user.id, tid, await state.get_data())
-                await cb.message.answer("── * 30")
-                await _send_question(cb, test, next_q)
+                if in_place:
+                    await _send_question(cb, test, next_q, in_place=True, notice=skip_notice, state=state)
+                else:
+                    await dispatch("interactive", cb.message.answer, skip_notice)
+                    await dispatch("interactive", cb.message.answer, "── * 30")
+                    await _send_question(cb, test, next_q, state=state)
             else:
+                if not (in_place and await _edit_in_place(cb, skip_notice)):
+                    await dispatch("interactive", cb.message.answer, skip_notice)
                 await _finish_test(cb, state, test)
         else:
             await state.update_data(waiting_understanding=False)
             await _save_session(cb.from_user.id, tid, await state.get_data())
-            await cb.message.answer("🔄 Qayta urinib ko'ring:")
-            await _send_question(cb, test, current_q, excluded_for_q)
+            await _send_question(cb, test, current_q, excluded_for_q,
+                                 in_place=in_place, notice="🔄 Qayta urinib ko'ring:", state=state)
 
 async def process_start_choice(cb: types.CallbackQuery, state: FSMContext):
     """Handle continue/restart choice from old session format"""
@@ -1672,19 +1565,24 @@ async def process_start_choice(cb: types.CallbackQuery, state: FSMContext):
             
             if not test or not test.get("questions"):
                 await state.finish()
-                await cb.message.answer("Sessiya topilmadi yoki test o'chirilgan.")
-                return await cb.answer()
+                await dispatch("interactive", cb.message.answer, "Sessiya topilmadi yoki test o'chirilgan.")
+                return await dispatch("interactive", cb.answer)
             
             await StudentStates.Answering.set()
-            await cb.message.answer("Davom etamiz.")
+            await dispatch("interactive", cb.message.answer, "Davom etamiz.")
+            
+            if s.get("delivery_mode") == "sheet":
+                from answer_sheet import send_sheet
+                await send_sheet(cb, state, test)
+                return await dispatch("interactive", cb.answer)
             
             current_q = int(s.get("current_q", 1))
             excluded_options = s.get("excluded_options", {})
             q_key = str(current_q)
             excluded_for_q = excluded_options.get(q_key, [])
             
-            await _send_question(cb, test, current_q, excluded_for_q)
-            return await cb.answer()
+            await _send_question(cb, test, current_q, excluded_for_q, state=state)
+            return await dispatch("interactive", cb.answer)
         
         if data == "st:restart":
             await state.finish()
@@ -1708,54 +1606,26 @@ async def process_start_choice(cb: types.CallbackQuery, state: FSMContext):
                 t["test_name"] = _pretty_name(t)
             
             if not tests:
-                await cb.message.answer(
+                await dispatch("interactive", cb.message.answer,
                     "Hozircha siz uchun faollashtirilgan testlar yo'q.\n"
                     "Guruh admini testni guruhingiz uchun faollashtirishi kerak."
                 )
             else:
                 keyboard = _create_tests_keyboard(tests)
-                await cb.message.answer(
+                await dispatch("interactive", cb.message.answer,
                     "<b>📚 Mavjud testlar:</b>\n"
                     "Testni boshlash uchun quyidagi tugmalardan birini bosing:",
                     reply_markup=keyboard
                 )
             
-            return await cb.answer()
+            return await dispatch("interactive", cb.answer)
         
-        await cb.answer("Noma'lum tanlov")
+        await dispatch("interactive", cb.answer, "Noma'lum tanlov")
     except Exception as e:
         log.error(f"Error in process_start_choice: {e}")
-        await cb.answer("Xatolik yuz berdi")
+        await dispatch("interactive", cb.answer, "Xatolik yuz berdi")
 
 async def receive_test_id(message: types.Message, state: FSMContext):
     """Deprecated - kept for compatibility"""
-    await message.reply("Iltimos, yuqoridagi tugmalardan testni tanlang.")
-
-# Cleanup function
-async def cleanup_old_user_sessions(user_id: int, max_age_hours: int = 24) -> int:
-    """Clean up old session files for a user"""
-    cleaned = 0
-    try:
-        user_session_dir = get_user_session_dir(user_id)
-        cutoff_time = time.time() - (max_age_hours * 3600)
-        
-        for session_file in user_session_dir.glob("*.json"):
-            try:
-                if session_file.stat().st_mtime < cutoff_time:
-                    session_file.unlink()
-                    cleaned += 1
-            except Exception as e:
-                log.warning(f"Error cleaning session file {session_file}: {e}")
-        
-        # Remove empty directory
-        try:
-            if not any(user_session_dir.iterdir()):
-                user_session_dir.rmdir()
-        except:
-            pass
-            
-    except Exception as e:
-        log.error(f"Error cleaning user {user_id} sessions: {e}")
-    
-    return cleaned
+    await dispatch("interactive", message.reply, "Iltimos, yuqoridagi tugmalardan testni tanlang.")
 
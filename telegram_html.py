@@ -0,0 +1,280 @@
+"""
+TELEGRAM HTML SANITIZER
+
+Turns question / option / reference text into HTML that Telegram's parser
+accepts, in one left-to-right scan instead of a chain of regex passes:
+
+    text ──fences──> <pre><code> blocks, kept verbatim
+         ──text between code blocks──> unescape → tokenize/escape
+                                      → whitespace normalization
+
+Allowed tags: b, i, u, s, code, pre, a (attributes kept as-is).
+<script>/<style> blocks are removed with their content, every other tag is
+dropped, and stray &, <, > are escaped.
+
+Results are memoized (bounded LRU keyed by the input string), so the same
+question text sent to hundreds of students is sanitized once.
+
+Output matches the previous regex implementation on the test corpus (see
+test_sanitizer_differential.py), including code blocks inside <style> or an
+unknown tag, which are dropped with it. It can still differ on malformed
+markup where the old passes leaked their own placeholders (e.g. an
+unclosed allowed tag running into a code block).
+
+split_html_preserving_codeblocks() cuts sanitized HTML into messages under
+Telegram's 4096-char limit without breaking <pre><code> blocks.
+"""
+
+import html
+import re
+from functools import lru_cache
+
+SANITIZER_VERSION = 2
+SANITIZE_CACHE_SIZE = 4096
+
+ALLOWED_TAGS = frozenset({"b", "i", "u", "s", "code", "pre", "a"})
+
+# --- Markdown fenced code  ```lang ... ```  →  HTML <pre><code> normalizer ---
+
+_FENCE_RE = re.compile(
+    r"```([A-Za-z0-9_+\-]*)[ \t]*\n?([\s\S]*?)\n?```",
+    re.MULTILINE
+)
+
+_CODEBLOCK_RE = re.compile(r'(<pre><code[^>]*>.*?</code></pre>)', re.IGNORECASE | re.DOTALL)
+
+_TAG_RE = re.compile(r'</?([a-zA-Z][a-zA-Z0-9]*)[^>]*>')
+_WS_RE = re.compile(r'[ \t\f\v]+|\n{3,}')
+
+# Containers dropped together with their content
+_DROP_BLOCK_RES = (
+    re.compile(r'<script[^>]*>.*?</script>', re.IGNORECASE | re.DOTALL),
+    re.compile(r'<style[^>]*>.*?</style>', re.IGNORECASE | re.DOTALL),
+)
+
+
+def normalize_fenced_code_to_html(text: str) -> str:
+    """
+    Convert Markdown-style fenced blocks into Telegram-safe HTML:
+        ```js console.log('hi') ```
+        ```python
+        print('x')
+        ```
+    becomes:
+        <pre><code class="language-js">console.log('hi')</code></pre>
+        <pre><code class="language-python">print(&#x27;x&#x27;)</code></pre>
+    """
+    if not text:
+        return ""
+
+    def _repl(m: re.Match) -> str:
+        lang = (m.group(1) or "").strip()
+        code = (m.group(2) or "")
+        # Ensure code is on its own lines (handles one-line ```js console.log(...) ```)
+        code = code.strip("\n")
+        # Escape code content; code blocks are not touched by the sanitizer afterwards
+        escaped = html.escape(code, quote=False)
+        class_attr = f' class="language-{lang}"' if lang else ""
+        return f"<pre><code{class_attr}>{escaped}</code></pre>"
+
+    return _FENCE_RE.sub(_repl, text)
+
+
+def _escape_text(s: str) -> str:
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _sanitize_segment(text: str, mark: str = "") -> str:
+    """Tokenize text (code blocks replaced by `mark` placeholders) into Telegram-safe HTML."""
+    text = html.unescape(text)
+    out = []
+    pos = 0
+    n = len(text)
+
+    while pos < n:
+        lt = text.find('<', pos)
+        if lt < 0:
+            out.append(_escape_text(text[pos:]))
+            break
+        if lt > pos:
+            out.append(_escape_text(text[pos:lt]))
+
+        # <script ...>...</script>, <style ...>...</style>: drop with content
+        for block_re in _DROP_BLOCK_RES:
+            m = block_re.match(text, lt)
+            if m:
+                break
+        if m:
+            pos = m.end()
+            continue
+
+        m = _TAG_RE.match(text, lt)
+        if m is None:
+            out.append('&lt;')
+            pos = lt + 1
+            continue
+
+        tag = m.group(0)
+        name = m.group(1).lower()
+        if mark and mark in tag and name in ALLOWED_TAGS:
+            # An allowed tag never spans a code block: its "<" is text
+            out.append('&lt;')
+            pos = lt + 1
+            continue
+        if name in ALLOWED_TAGS:
+            if tag[1] != '/' or tag.lower() == f"</{name}>":
+                out.append(tag)
+            else:
+                # Closing tag with junk (</b foo>) is not a tag for Telegram
+                out.append(_escape_text(tag))
+        # Any other tag is dropped
+        pos = m.end()
+
+    return ''.join(out)
+
+
+def _normalize_ws(m: re.Match) -> str:
+    return '\n\n' if m.group(0)[0] == '\n' else ' '
+
+
+@lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def sanitize_html_for_telegram(text: str) -> str:
+    """
+    Sanitize text for Telegram's HTML parser while preserving code blocks.
+    - Normalizes ```lang fences → <pre><code class="language-...">...</code></pre>
+    - Escapes dangerous chars outside allowed tags
+    - Preserves whitespace/newlines inside code blocks
+    """
+    if not text:
+        return ""
+
+    text = normalize_fenced_code_to_html(text)
+
+    # Code blocks are swapped for placeholders and kept as-is; the text around
+    # them is sanitized in one scan, so a block inside a dropped container
+    # (<style>, an unknown tag) is dropped with it, as before
+    mark = _placeholder_mark(text)
+    blocks = []
+
+    def _stash(m: re.Match) -> str:
+        blocks.append(m.group(1))
+        return f"{mark}{len(blocks) - 1}{mark}"
+
+    text = _CODEBLOCK_RE.sub(_stash, text)
+    text = _WS_RE.sub(_normalize_ws, _sanitize_segment(text, mark)).strip()
+    if blocks:
+        text = re.sub(f"{mark}(\\d+){mark}", lambda m: blocks[int(m.group(1))], text)
+    return text
+
+
+def _placeholder_mark(text: str) -> str:
+    """A private-use character that occurs neither in `text` nor in its unescaped form."""
+    used = set(text) | set(html.unescape(text))
+    for code in range(0xE000, 0xF900):
+        if chr(code) not in used:
+            return chr(code)
+    raise ValueError("no free placeholder character")
+
+
+# --- Splitting long HTML into Telegram-sized messages (code blocks kept intact) ---
+
+MAX_TG_CHUNK = 3900  # 4096 limitdan xavfsiz zaxira bilan
+
+def _split_plain_text_preserving_paragraphs(text: str, max_len: int = MAX_TG_CHUNK) -> list:
+    """Oddiy tekst bo'lagini (HTML TAGsiz) paragraflar bo'yicha bo'lib chiqarish."""
+    parts = []
+    for para in text.split("\n\n"):
+        para = para.strip()
+        if not para:
+            continue
+        if len(para) <= max_len:
+            parts.append(para)
+        else:
+            # Juda uzun bo'lsa satrlar bo'yicha bo'lamiz
+            lines = para.splitlines()
+            buf, cur = [], 0
+            for ln in lines:
+                add = (len(ln) + 1)
+                if cur + add > max_len and buf:
+                    parts.append("\n".join(buf))
+                    buf, cur = [ln], len(ln) + 1
+                else:
+                    buf.append(ln); cur += add
+            if buf:
+                parts.append("\n".join(buf))
+    return parts
+
+def _split_codeblock_into_chunks(code_html: str, max_len: int = MAX_TG_CHUNK) -> list:
+    """
+    <pre><code ...> ... </code></pre> blokini hajmga qarab bo'lish.
+    Kod ichini satr bo'yicha bo'lib, har bo'lakni alohida <pre><code>...</code></pre> qilib qaytaramiz.
+    """
+    # code_html: to'liq <pre><code ...>...</code></pre>
+    m = re.match(r'(?is)<pre><code([^>]*)>(.*)</code></pre>', code_html)
+    if not m:
+        # Format kutilgandek bo'lmasa, o'zi bo'lib yuboramiz (lekin bu kam uchraydi)
+        return _split_plain_text_preserving_paragraphs(code_html, max_len=max_len)
+
+    code_attrs = m.group(1) or ""
+    inner = m.group(2) or ""
+    if len(code_html) <= max_len:
+        return [code_html]
+
+    # Kodni satrlar bo'yicha bo'limiz
+    lines = inner.splitlines()
+    chunks, buf, cur = [], [], 0
+    # 50 belgi zaxira: <pre><code ...></code></pre> teglari uchun
+    inner_limit = max(200, max_len - 50)
+
+    for ln in lines:
+        add = len(ln) + 1
+        if cur + add > inner_limit and buf:
+            piece = "\n".join(buf)
+            chunks.append(f"<pre><code{code_attrs}>{piece}</code></pre>")
+            buf, cur = [ln], len(ln) + 1
+        else:
+            buf.append(ln); cur += add
+    if buf:
+        piece = "\n".join(buf)
+        chunks.append(f"<pre><code{code_attrs}>{piece}</code></pre>")
+    return chunks
+
+def split_html_preserving_codeblocks(text: str, max_len: int = MAX_TG_CHUNK) -> list:
+    """
+    Matnni kod bloklarini atom sifatida ko'rib bo'lish:
+      - Kod bloklarini (_CODEBLOCK_RE) topamiz, ularni bo'lak sifatida olamiz
+      - Kod bloklari orasidagi oddiy tekstni paragraflar/satrlar bo'yicha bo'lamiz
+      - Juda katta kod bloklarni ham alohida bo'lamiz
+    """
+    parts = []
+    pos = 0
+    for m in _CODEBLOCK_RE.finditer(text):
+        pre_text = text[pos:m.start()]
+        if pre_text:
+            parts.extend(_split_plain_text_preserving_paragraphs(pre_text, max_len=max_len))
+
+        code_html = m.group(1)
+        if len(code_html) <= max_len:
+            parts.append(code_html)
+        else:
+            parts.extend(_split_codeblock_into_chunks(code_html, max_len=max_len))
+
+        pos = m.end()
+
+    tail = text[pos:]
+    if tail:
+        parts.extend(_split_plain_text_preserving_paragraphs(tail, max_len=max_len))
+
+    # Endi parts bo'laklarini MAX_TG_CHUNK ga "paketlab" birlashtiramiz
+    chunks, buf, cur = [], [], 0
+    for p in parts:
+        add = len(p) + 1
+        if cur + add > max_len and buf:
+            chunks.append("\n\n".join(buf).strip())
+            buf, cur = [p], len(p) + 1
+        else:
+            buf.append(p); cur += add
+    if buf:
+        chunks.append("\n\n".join(buf).strip())
+
+    return [c for c in chunks if c]
@@ -0,0 +1,132 @@
+# test_ordered_dispatch.py - Per-user ordering, worker slots and drops of the keyed executor
+import asyncio
+
+from ordered_dispatch import KeyedExecutor, worker_idle
+
+
+def test_one_key_in_order_keys_in_parallel():
+    async def main():
+        ex = KeyedExecutor(max_workers=8)
+        log, peak = [], [0]
+
+        async def job(key, i):
+            peak[0] = max(peak[0], ex.running)
+            log.append((key, i, "start"))
+            await asyncio.sleep(0.01)
+            log.append((key, i, "end"))
+
+        await asyncio.gather(*(ex.run(k, job, k, i) for i in range(3) for k in "abc"))
+        for k in "abc":
+            assert [e[1:] for e in log if e[0] == k] == [
+                (0, "start"), (0, "end"), (1, "start"), (1, "end"), (2, "start"), (2, "end")]
+        assert peak[0] == 3
+        assert ex.metrics()["users"] == 0 and ex.processed == 9
+
+    asyncio.run(main())
+
+
+def test_busy_workers_hold_back_other_users():
+    async def main():
+        ex = KeyedExecutor(max_workers=2)
+        release, done = asyncio.Event(), []
+
+        async def busy(i):
+            await release.wait()
+
+        async def quick():
+            done.append(True)
+
+        tasks = [asyncio.ensure_future(ex.run(i, busy, i)) for i in range(2)]
+        extra = asyncio.ensure_future(ex.run("other", quick))
+        await asyncio.sleep(0.05)
+        assert not done and ex.running == 2
+        release.set()
+        await asyncio.gather(extra, *tasks)
+        assert done
+
+    asyncio.run(main())
+
+
+def test_idle_handlers_free_their_worker_slot():
+    async def main():
+        ex = KeyedExecutor(max_workers=64)
+        release, done = asyncio.Event(), []
+
+        async def waiting(i):
+            async with worker_idle():
+                await release.wait()
+            done.append(i)
+
+        async def quick():
+            done.append("65th")
+
+        tasks = [asyncio.ensure_future(ex.run(i, waiting, i)) for i in range(64)]
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(ex.run("u65", quick), timeout=1)
+        assert done == ["65th"] and ex.running == 0
+
+        # Same user's next update still waits behind the idle handler
+        follow = asyncio.ensure_future(ex.run(0, quick))
+        await asyncio.sleep(0.01)
+        assert not follow.done()
+        release.set()
+        await asyncio.gather(follow, *tasks)
+        assert len(done) == 66 and ex.running == 0
+
+    asyncio.run(main())
+
+
+def test_duplicate_and_overflow_admission():
+    async def main():
+        ex = KeyedExecutor(max_workers=4, max_queue=2)
+        release = asyncio.Event()
+
+        async def job():
+            await release.wait()
+
+        first = asyncio.ensure_future(ex.run(1, job, fingerprint=(10, "ans:1:A")))
+        await asyncio.sleep(0)
+        assert ex.admit(1, (10, "ans:1:A")) == "duplicate"
+        assert ex.admit(1, (10, "ans:1:B")) is None
+        second = asyncio.ensure_future(ex.run(1, job))
+        await asyncio.sleep(0)
+        assert ex.admit(1) == "overflow"
+        assert ex.admit(2) is None
+        release.set()
+        await asyncio.gather(first, second)
+        assert ex.admit(1, (10, "ans:1:A")) is None
+
+    asyncio.run(main())
+
+
+def test_repeat_toggle_taps_both_run():
+    from aiogram import Bot, types
+    from ordered_dispatch import OrderedDispatcher
+
+    async def main():
+        dp = OrderedDispatcher(Bot("123456:TEST"))
+        release, seen = asyncio.Event(), []
+
+        async def notify(update):
+            seen.append(update.callback_query.data)
+            await release.wait()
+
+        dp.updates_handler.notify = notify
+
+        def tap(update_id, data):
+            return types.Update(update_id=update_id, callback_query={
+                "id": str(update_id), "chat_instance": "1", "data": data,
+                "from": {"id": 7, "is_bot": False, "first_name": "x"},
+                "message": {"message_id": 10, "date": 0, "chat": {"id": 7, "type": "private"}},
+            })
+
+        first = asyncio.ensure_future(dp.process_updates([tap(1, "sh:m:1:A")]))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(dp.process_updates([tap(2, "sh:m:1:A")]))
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, second)
+        assert seen == ["sh:m:1:A", "sh:m:1:A"]
+        assert dp.queue_metrics()["dropped_duplicates"] == 0
+
+    asyncio.run(main())
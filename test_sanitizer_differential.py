@@ -0,0 +1,194 @@
+# test_sanitizer_differential.py - New tokenizing sanitizer vs the old regex one
+import glob
+import html
+import json
+import os
+import re
+
+from telegram_html import sanitize_html_for_telegram
+
+
+# ---------------------------------------------------------------------------
+# Previous implementation (student_handlers.sanitize_html_for_telegram),
+# kept verbatim as the reference.
+# ---------------------------------------------------------------------------
+
+_LEGACY_FENCE_RE = re.compile(
+    r"```([A-Za-z0-9_+\-]*)[ \t]*\n?([\s\S]*?)\n?```",
+    re.MULTILINE
+)
+
+_LEGACY_CODEBLOCK_RE = re.compile(r'(<pre><code[^>]*>.*?</code></pre>)', re.IGNORECASE | re.DOTALL)
+
+
+def _legacy_normalize_fenced_code_to_html(text: str) -> str:
+    if not text:
+        return ""
+
+    def _repl(m: re.Match) -> str:
+        lang = (m.group(1) or "").strip()
+        code = (m.group(2) or "")
+        code = code.strip("\n")
+        escaped = html.escape(code, quote=False)
+        class_attr = f' class="language-{lang}"' if lang else ""
+        return f"<pre><code{class_attr}>{escaped}</code></pre>"
+
+    return _LEGACY_FENCE_RE.sub(_repl, text)
+
+
+def legacy_sanitize_html_for_telegram(text: str) -> str:
+    if not text:
+        return ""
+
+    text = _legacy_normalize_fenced_code_to_html(text)
+
+    code_blocks = {}
+    def _stash_codeblock(m: re.Match) -> str:
+        idx = len(code_blocks)
+        key = f"__CODEBLOCK_{idx}__"
+        code_blocks[key] = m.group(1)
+        return key
+    text = _LEGACY_CODEBLOCK_RE.sub(_stash_codeblock, text)
+
+    text = html.unescape(text)
+
+    text = re.sub(r'<script[^>]*>.*?</script>', '', text, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r'<style[^>]*>.*?</style>', '', text, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r'</?(?:html|head|body|meta|link)[^>]*>', '', text, flags=re.IGNORECASE)
+
+    allowed_tags = ['b', 'i', 'u', 's', 'code', 'pre', 'a', 'tg-spoiler']
+    def _strip_unallowed_tags(m: re.Match) -> str:
+        tag = m.group(1).lower()
+        return m.group(0) if tag in allowed_tags else ''
+    text = re.sub(r'</?([a-zA-Z][a-zA-Z0-9]*)[^>]*>', _strip_unallowed_tags, text)
+
+    tag_placeholders = {}
+    ph_counter = 0
+    for tag in allowed_tags:
+        for m in re.finditer(fr'<{tag}[^>]*>', text, flags=re.IGNORECASE):
+            ph = f'__TAGPH_{ph_counter}__'; ph_counter += 1
+            tag_placeholders[ph] = m.group(0)
+            text = text.replace(m.group(0), ph, 1)
+        for m in re.finditer(fr'</{tag}>', text, flags=re.IGNORECASE):
+            ph = f'__TAGPH_{ph_counter}__'; ph_counter += 1
+            tag_placeholders[ph] = m.group(0)
+            text = text.replace(m.group(0), ph, 1)
+
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    for ph, original in tag_placeholders.items():
+        text = text.replace(ph, original)
+
+    text = re.sub(r'[ \t\f\v]+', ' ', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = text.strip()
+
+    for ph, block in code_blocks.items():
+        text = text.replace(ph, block)
+
+    return text
+
+
+# ---------------------------------------------------------------------------
+# Corpus
+# ---------------------------------------------------------------------------
+
+EDGE_CASES = [
+    "",
+    "Oddiy matn",
+    "a < b && c > d",
+    "x<y va z>w",
+    "<b>Qalin</b> va <i>kursiv</i> <U>tagi</U> <s>o'chirilgan</s>",
+    "<a href=\"https://example.com?a=1&b=2\">havola</a>",
+    "<div class='c'><p>Paragraf</p><br/><span>span</span></div>",
+    "<h1>Sarlavha</h1>\n\n\n\n<ul><li>bir</li><li>ikki</li></ul>",
+    "&lt;b&gt;entity&lt;/b&gt; &amp; &quot;qo'shtirnoq&quot; &#39;",
+    "<script>alert('x')</script>Matn<style>.a{}</style>",
+    "<SCRIPT type='text/javascript'>var a = 1 < 2;</SCRIPT> keyin",
+    "<script>yopilmagan skript",
+    "<html><head><title>T</title></head><body>tana</body></html>",
+    "</b > yopilish",
+    "<b >bo'sh joyli</b>",
+    "<tg-spoiler>sir</tg-spoiler>",
+    "   bo'sh   joylar\t\tva\ttablar   \n\n\n\n\nko'p qator   ",
+    "```python\nprint('x' < 'y')\n```",
+    "```js console.log(a > b) ```",
+    "Kod: ```\nfor i in range(3):\n    print(i)\n``` tugadi  <b>ok</b>",
+    "<pre><code class=\"language-html\">&lt;div&gt;</code></pre>\n\n\n\nva <code>inline</code>",
+    "  <pre><code>a   b</code></pre>  ",
+    "<pre>oddiy pre</pre> & <code>x < y</code>",
+    "1 < 2 > 0 <3 <> </> <!-- izoh --> <!DOCTYPE html>",
+    "&nbsp;&nbsp;nbsp va ",
+    "<a>bir</a><A HREF='x'>ikki</A>",
+    "<input type=\"text\" value=\"<b>\">",
+    # Code blocks inside dropped containers go with them
+    "<style>```\nq\n``` </style>",
+    "<x ```y```>",
+]
+
+
+def _collect_strings(obj, out):
+    if isinstance(obj, str):
+        out.append(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _collect_strings(v, out)
+    elif isinstance(obj, list):
+        for v in obj:
+            _collect_strings(v, out)
+
+
+def load_corpus():
+    corpus = list(EDGE_CASES)
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = sorted(
+        glob.glob(os.path.join(root, "data", "tests", "test_*.json"))
+        + glob.glob(os.path.join(root, "backups", "*", "tests", "test_*.json"))
+    )
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                _collect_strings(json.load(f), corpus)
+        except (OSError, ValueError):
+            continue
+    return list(dict.fromkeys(corpus))
+
+
+def test_sanitizer_matches_legacy():
+    """New sanitizer must produce exactly the old output"""
+    corpus = load_corpus()
+    mismatches = []
+    for text in corpus:
+        expected = legacy_sanitize_html_for_telegram(text)
+        got = sanitize_html_for_telegram(text)
+        if got != expected:
+            mismatches.append((text, expected, got))
+
+    print(f"=== Sanitizer differential: {len(corpus)} inputs, {len(mismatches)} mismatches ===")
+    for text, expected, got in mismatches[:10]:
+        print(f"❌ Input:    {text[:80]!r}")
+        print(f"   Legacy:   {expected[:80]!r}")
+        print(f"   New:      {got[:80]!r}")
+    assert not mismatches
+
+
+def test_code_blocks_in_dropped_containers():
+    """Fences inside <style> / an unknown tag are dropped, not rendered"""
+    assert sanitize_html_for_telegram("<style>```\nq\n``` </style>") == ""
+    assert sanitize_html_for_telegram("<x ```y```>") == ""
+    assert sanitize_html_for_telegram("a ```\nq\n``` b") == "a <pre><code>q</code></pre> b"
+
+
+def test_sanitizer_is_memoized():
+    """Repeated inputs are served from the cache"""
+    sanitize_html_for_telegram.cache_clear()
+    for _ in range(3):
+        sanitize_html_for_telegram("<b>Savol</b> 1 < 2")
+    info = sanitize_html_for_telegram.cache_info()
+    assert info.hits == 2 and info.misses == 1
+
+
+if __name__ == "__main__":
+    test_sanitizer_matches_legacy()
+    test_code_blocks_in_dropped_containers()
+    test_sanitizer_is_memoized()
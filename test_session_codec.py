@@ -0,0 +1,38 @@
+# test_session_codec.py - Compact session encoding round trips and legacy pass-through
+from session_codec import SESSION_CODEC_VERSION, decode_session, encode_session
+
+
+def _session():
+    return {
+        "active_test_id": "abc",
+        "current_q": 4,
+        "total_q": 5,
+        "answers": {"1": "A", "3": "C"},
+        "excluded_options": {"3": ["B", "A"], "2": []},
+        "wrong_attempts": {"3": 2},
+    }
+
+
+def test_round_trip():
+    s = _session()
+    stored = encode_session(s)
+    assert stored["_v"] == SESSION_CODEC_VERSION
+    assert (stored["a"], stored["x"], stored["w"]) == ("A-C--", "00300", "00200")
+    assert "answers" not in stored and s["answers"] == {"1": "A", "3": "C"}
+
+    back = decode_session(stored)
+    assert back["answers"] == s["answers"]
+    assert back["excluded_options"] == {"3": ["A", "B"]}
+    assert back["wrong_attempts"] == s["wrong_attempts"]
+    assert back["current_q"] == 4 and "_v" not in back
+
+
+def test_legacy_sessions_pass_through():
+    legacy = _session()
+    assert decode_session(legacy) is legacy
+
+
+def test_unencodable_data_kept_as_dicts():
+    for bad in ({"answers": {"x": "A"}}, {"answers": {"1": "E"}}, {"wrong_attempts": {"1": 12}}, {"x": 1}):
+        s = dict(_session(), **bad)
+        assert encode_session(s) is s
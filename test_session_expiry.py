@@ -0,0 +1,38 @@
+# test_session_expiry.py - TTL bucket index of session last-activity times
+from session_expiry import SessionIndex
+
+
+def test_pop_expired_by_bucket():
+    idx = SessionIndex(bucket_seconds=60)
+    idx.touch(1, "a", 10)        # bucket 0
+    idx.touch(2, "b", 70)        # bucket 1
+    idx.touch(3, "c", 200)       # bucket 3
+    assert idx.pop_expired(65) == [((1, "a"), 10)]
+    assert idx.pop_expired(100) == []                    # bucket precision: 70 shares 100's minute
+    assert idx.pop_expired(125) == [((2, "b"), 70)]
+    assert len(idx) == 1
+    assert idx.pop_expired(125) == []
+
+
+def test_touch_moves_to_newer_bucket():
+    idx = SessionIndex(bucket_seconds=60)
+    idx.touch(1, "a", 10)
+    idx.touch(1, "a", 300)
+    assert idx.pop_expired(240) == []
+    assert idx.pop_expired(400) == [((1, "a"), 300)]
+
+
+def test_same_bucket_keeps_latest():
+    idx = SessionIndex(bucket_seconds=60)
+    idx.touch(1, "a", 30)
+    idx.touch(1, "a", 10)
+    assert idx.pop_expired(120) == [((1, "a"), 30)]
+
+
+def test_discard():
+    idx = SessionIndex(bucket_seconds=60)
+    idx.touch("5", "a", 10)
+    idx.touch(6, "b", 10)
+    idx.discard(5, "a")
+    assert idx.pop_expired(1000) == [((6, "b"), 10)]
+    assert len(idx) == 0
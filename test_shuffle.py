@@ -0,0 +1,48 @@
+# test_shuffle.py - Per-attempt question/option shuffling round trips
+from shuffle import AttemptShuffle, get_attempt_shuffle
+
+
+def _test(n=12):
+    return {
+        "questions": [
+            {"index": i, "text": f"Savol {i}", "options": {"A": "bir", "B": "ikki", "C": "uch", "D": "to'rt"}}
+            for i in range(1, n + 1)
+        ]
+    }
+
+
+def test_question_order_is_a_permutation():
+    s = AttemptShuffle(12345, _test())
+    order = [s.question(p) for p in range(1, 13)]
+    assert sorted(order) == list(range(1, 13))
+    assert all(s.position(s.question(p)) == p for p in range(1, 13))
+
+
+def test_letters_round_trip():
+    s = AttemptShuffle(987, _test())
+    for q in range(1, 13):
+        for letter in "ABCD":
+            assert s.to_canonical(q, s.to_display(q, letter)) == letter
+            assert s.to_display(q, s.to_canonical(q, letter)) == letter
+        assert s.to_canonical(q, "E") is None
+
+
+def test_stable_for_a_seed():
+    a, b = AttemptShuffle(42, _test()), AttemptShuffle(42, _test())
+    assert [a.question(p) for p in range(1, 13)] == [b.question(p) for p in range(1, 13)]
+    assert all(a.option_order(q) == b.option_order(q) for q in range(1, 13))
+
+    orders = {tuple(AttemptShuffle(seed, _test()).question(p) for p in range(1, 13)) for seed in range(20)}
+    assert len(orders) > 1
+
+
+def test_marks_to_display():
+    s = AttemptShuffle(7, _test())
+    shown = s.marks_to_display({"3": "B"})
+    [(pos, letter)] = shown.items()
+    assert s.question(int(pos)) == 3 and s.to_canonical(3, letter) == "B"
+
+
+def test_no_seed_no_shuffle():
+    assert get_attempt_shuffle({}, _test()) is None
+    assert get_attempt_shuffle({"shuffle_seed": 1}, _test()) is not None
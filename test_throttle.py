@@ -0,0 +1,38 @@
+# test_throttle.py - GCRA limiter accept/reject timing and key eviction
+from middleware import GCRALimiter
+
+
+def test_burst_then_steady_rate():
+    lim = GCRALimiter()
+    limit = (("u", "ans:"), 10, 60.0)
+    assert all(lim.check(limit, now=0.0) is None for _ in range(10))
+    assert lim.check(limit, now=0.0) == ("u", "ans:")
+    assert lim.check(limit, now=5.9) == ("u", "ans:")
+    assert lim.check(limit, now=6.0) is None          # one slot per 60/10 s
+    assert lim.check(limit, now=6.0) == ("u", "ans:")
+
+
+def test_rejected_call_consumes_no_limit():
+    lim = GCRALimiter()
+    user, tight = (("u", "*"), 30, 10.0), (("u", "x"), 1, 10.0)
+    assert lim.check(user, tight, now=0.0) is None
+    for _ in range(5):
+        assert lim.check(user, tight, now=0.0) == ("u", "x")
+    # Only the admitted call counted against the per-user limit
+    assert sum(lim.check(user, now=0.0) is None for _ in range(40)) == 29
+
+
+def test_keys_are_independent():
+    lim = GCRALimiter()
+    assert lim.check((("a",), 1, 10.0), now=0.0) is None
+    assert lim.check((("a",), 1, 10.0), now=0.0) == ("a",)
+    assert lim.check((("b",), 1, 10.0), now=0.0) is None
+
+
+def test_idle_keys_evicted_and_table_bounded():
+    lim = GCRALimiter(max_keys=3)
+    for i in range(10):
+        lim.check(((i,), 5, 10.0), now=0.0)
+    assert len(lim) == 3
+    lim.check((("x",), 5, 10.0), now=100.0)
+    assert len(lim) == 1
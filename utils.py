@@ -12,6 +12,9 @@ from typing import Dict, List, Tuple, Optional, Any, Set
 import asyncio
 import time
 
+from live_sessions import get_live_sessions
+from session_store import get_session_store, session_lock, session_path
+
 
 try:
     from config import (
@@ -391,19 +394,26 @@ def get_group_member_data(group_id: int) -> Dict:
 
 
 async def notify_group_students(group_id: int, test_name: str, test_id: str) -> Tuple[List[int], List[int]]:
-    """Enhanced notification with better error handling and reporting"""
+    """Notify one group's members about a test (see notify_test_students)"""
+    return await notify_test_students([group_id], test_name, test_id)
+
+
+async def notify_test_students(group_ids: List[int], test_name: str, test_id: str) -> Tuple[List[int], List[int]]:
+    """
+    DM every member of the given groups about a test through the broadcast engine.
+    A student in several of the groups gets a single message.
+    """
+    member_ids: List[int] = []
     try:
         from config import bot
-        from telethon_service import get_telethon_service
-        
-        member_ids = get_group_member_ids(group_id)
+        from broadcast import get_broadcast_engine
+
+        for group_id in group_ids:
+            member_ids.extend(get_group_member_ids(group_id))
         if not member_ids:
-            log.warning(f"No members found for group {group_id}")
+            log.warning(f"No members found for groups {group_ids}")
             return [], []
-        
-        notified = []
-        failed = []
-        
+
         bot_username = (await bot.get_me()).username
         message = (
             f"🧪 <b>Yangi test!</b>\n\n"
@@ -414,48 +424,22 @@ async def notify_group_students(group_id: int, test_name: str, test_id: str) ->
             f"2. Mavjud testlar ro'yxatidan tanlang\n\n"
             f"⏰ Test hozir faol!"
         )
-        
-        # Try to notify via bot first (faster)
-        for user_id in member_ids:
-            try:
-                await bot.send_message(user_id, message)
-                notified.append(user_id)
-                log.debug(f"Notified user {user_id} about test {test_name}")
-                
-                # Small delay to avoid rate limits
-                await asyncio.sleep(0.05)
-                
-            except Exception as e:
-                failed.append(user_id)
-                log.debug(f"Failed to notify user {user_id} via bot: {e}")
-        
-        # If many failed via bot, try Telethon as fallback
-        if len(failed) > len(notified) * 0.3:  # If more than 30% failed
-            log.info(f"Many bot notifications failed ({len(failed)}), trying Telethon fallback")
-            
-            telethon = await get_telethon_service()
-            if telethon:
-                telethon_message = (
-                    f"🧪 Yangi test: {test_name}\n\n"
-                    f"Testni boshlash uchun @{bot_username} botiga /start yuboring\n"
-                    f"Test kodi: test_{test_id}"
-                )
-                
-                telethon_notified, telethon_failed = await telethon.bulk_message_users(
-                    failed, telethon_message, delay=0.5
-                )
-                
-                notified.extend(telethon_notified)
-                failed = telethon_failed
-        
-        success_rate = len(notified) / len(member_ids) * 100 if member_ids else 0
-        log.info(f"Group {group_id} notification complete: {len(notified)}/{len(member_ids)} notified ({success_rate:.1f}% success rate)")
+
+        stats = await get_broadcast_engine().run(
+            f"notify_{test_id}_{int(time.time())}", member_ids, message
+        )
+        notified = stats["sent_ids"]
+        # Known-dead recipients were skipped by the engine; they still count as not notified
+        failed = stats["failed_ids"] + stats["skipped_ids"]
+
+        success_rate = stats["sent"] / stats["total"] * 100 if stats["total"] else 0
+        log.info(f"Groups {group_ids} notification complete: {stats['sent']}/{stats['total']} notified ({success_rate:.1f}% success rate)")
         
         return notified, failed
         
     except Exception as e:
-        log.error(f"Failed to notify group {group_id}: {e}")
-        return [], member_ids
+        log.error(f"Failed to notify groups {group_ids}: {e}")
+        return [], sorted(set(member_ids))
 async def _resolve_group_titles(ids):
     """Return list[(gid, title_or_id)] - resolves group IDs to titles"""
     out = []
@@ -895,23 +879,37 @@ async def check_user_current_admin_status(user_id: int) -> List[int]:
         log.error(f"Error checking admin status for user {user_id}: {e}")
         return []
 
-async def get_unreachable_users_info(group_id: int, failed_user_ids: List[int]) -> List[Dict]:
+async def get_unreachable_users_info(group_id: int, failed_user_ids: Optional[List[int]] = None) -> List[Dict]:
+    """
+    Group members the bot cannot message, from the unreachable registry.
+    `failed_user_ids` narrows the check to those ids (e.g. a broadcast's failures);
+    by default every known member of the group is checked.
+    """
     try:
+        from recipients import get_unreachable_registry, REASON_LABELS
+        registry = get_unreachable_registry()
         member_data = get_group_member_data(group_id)
+        candidates = failed_user_ids if failed_user_ids is not None else get_group_member_ids(group_id)
         unreachable = []
-        
-        for user_id in failed_user_ids:
+
+        for user_id in candidates:
+            entry = registry.get(user_id)
+            if not entry:
+                continue
             user_info = member_data.get(str(user_id), {})
             unreachable.append({
                 'id': user_id,
                 'first_name': user_info.get('first_name', 'Unknown'),
                 'last_name': user_info.get('last_name', ''),
                 'username': user_info.get('username', ''),
-                'full_name': f"{user_info.get('first_name', 'Unknown')} {user_info.get('last_name', '')}".strip()
+                'full_name': f"{user_info.get('first_name', 'Unknown')} {user_info.get('last_name', '')}".strip(),
+                'reason': entry['reason'],
+                'reason_label': REASON_LABELS.get(entry['reason'], entry['reason']),
+                'since': entry.get('since'),
             })
-        
+
         return unreachable
-        
+
     except Exception as e:
         log.error(f"Failed to get unreachable user info: {e}")
         return []
@@ -1054,6 +1052,10 @@ def get_student_admins(user_id: int) -> List[int]:
         log.error(f"Error getting student admins: {e}")
         return []
 
+def can_view_student_results(viewer_id: int, student_id: int) -> bool:
+    """Owner, or an admin of one of the student's groups (reviews, result files)"""
+    return is_owner(viewer_id) or int(viewer_id) in get_student_admins(int(student_id))
+
 def test_path(test_id: str) -> Path:
     p = Path(TESTS_DIR) / f"test_{test_id}.json"
     ensure_dir(p.parent)
@@ -1067,8 +1069,10 @@ def read_test(test_id: str) -> dict:
     return read_json(p, {})
 
 def write_test(test_id: str, obj: dict):
+    # Telegram-ready questions are compiled once here, not on every send
+    from question_compiler import ensure_compiled
     p = test_path(test_id)
-    write_json(p, obj)
+    write_json(p, ensure_compiled(obj))
 
 def add_test_index(test_id: str, name: str):
     obj = read_test(test_id) or {}
@@ -2359,138 +2363,35 @@ def validate_test_id(test_id: str) -> bool:
 
 
 
-_session_locks = {}
-_session_lock_main = asyncio.Lock()
-
-async def get_session_lock(user_id: int, test_id: str) -> asyncio.Lock:
-    """Get a lock specific to this user's test session"""
-    key = f"{user_id}:{test_id}"
-    async with _session_lock_main:
-        if key not in _session_locks:
-            _session_locks[key] = asyncio.Lock()
-        return _session_locks[key]
-
 def get_session_path(user_id: int, test_id: str) -> Path:
     """Get the path for a specific session file"""
-    session_dir = Path("data/sessions")
-    session_dir.mkdir(parents=True, exist_ok=True)
-    return session_dir / f"session_{user_id}_{test_id}.json"
+    return session_path(user_id, test_id)
 
 async def save_test_session_safe(user_id: int, test_id: str, session_data: dict) -> bool:
-    """Thread-safe session saving with error handling"""
-    try:
-        session_lock = await get_session_lock(user_id, test_id)
-        async with session_lock:
-            # Prepare data for JSON serialization
-            clean_data = session_data.copy()
-            clean_data['last_updated'] = int(time.time())
-            
-            # Handle excluded_options conversion
-            if 'excluded_options' in clean_data:
-                clean_excluded = {}
-                for k, v in clean_data['excluded_options'].items():
-                    if isinstance(v, set):
-                        clean_excluded[k] = list(v)
-                    elif isinstance(v, list):
-                        clean_excluded[k] = v
-                    else:
-                        clean_excluded[k] = []
-                clean_data['excluded_options'] = clean_excluded
-            
-            # Write to temporary file first, then move (atomic operation)
-            session_path = get_session_path(user_id, test_id)
-            temp_path = session_path.with_suffix('.tmp')
-            
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(clean_data, f, ensure_ascii=False, indent=2)
-            
-            # Atomic move
-            temp_path.replace(session_path)
-            return True
-            
-    except Exception as e:
-        log.error(f"Failed to save session for user {user_id}, test {test_id}: {e}")
-        return False
+    """Thread-safe session saving (the session store)"""
+    return await get_session_store().save(user_id, test_id, session_data)
 
 async def load_test_session_safe(user_id: int, test_id: str) -> Optional[dict]:
-    """Thread-safe session loading with error handling"""
-    try:
-        session_lock = await get_session_lock(user_id, test_id)
-        async with session_lock:
-            session_path = get_session_path(user_id, test_id)
-            
-            if not session_path.exists():
-                return None
-            
-            with open(session_path, 'r', encoding='utf-8') as f:
-                session_data = json.load(f)
-            
-            # Convert excluded_options back to the expected format
-            if 'excluded_options' in session_data:
-                for k, v in session_data['excluded_options'].items():
-                    if isinstance(v, list):
-                        session_data['excluded_options'][k] = v
-            
-            return session_data
-            
-    except Exception as e:
-        log.error(f"Failed to load session for user {user_id}, test {test_id}: {e}")
-        return None
+    """Thread-safe session loading (the session store)"""
+    return await get_session_store().load(user_id, test_id)
 
 async def delete_test_session_safe(user_id: int, test_id: str) -> bool:
     """Thread-safe session deletion"""
-    try:
-        session_lock = await get_session_lock(user_id, test_id)
-        async with session_lock:
-            session_path = get_session_path(user_id, test_id)
-            
-            if session_path.exists():
-                session_path.unlink()
-                return True
-            return False
-            
-    except Exception as e:
-        log.error(f"Failed to delete session for user {user_id}, test {test_id}: {e}")
-        return False
+    return await get_session_store().delete(user_id, test_id)
 
 def get_user_sessions_safe(user_id: int) -> List[Dict]:
-    """Get all sessions for a user"""
+    """Get all sessions for a user (live registry, most recent first)"""
     try:
-        session_dir = Path("data/sessions")
-        if not session_dir.exists():
-            return []
-        
-        sessions = []
-        pattern = f"session_{user_id}_*.json"
-        
-        for session_file in session_dir.glob(pattern):
-            try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    session_data = json.load(f)
-                
-                test_id = session_data.get("active_test_id")
-                if test_id:
-                    # Get test info
-                    test = read_test(test_id)
-                    if test:
-                        current_q = session_data.get("current_q", 1)
-                        total_q = session_data.get("total_q", 0)
-                        
-                        sessions.append({
-                            "test_id": test_id,
-                            "test_name": test.get("test_name", "Test"),
-                            "progress": f"{current_q}/{total_q}",
-                            "started_at": session_data.get("started_at", 0),
-                            "last_updated": session_data.get("last_updated", 0)
-                        })
-                        
-            except Exception as e:
-                log.warning(f"Error reading session file {session_file}: {e}")
-                continue
-        
-        # Sort by last updated
-        sessions.sort(key=lambda x: x.get("last_updated", 0), reverse=True)
-        return sessions
+        return [
+            {
+                "test_id": e["test_id"],
+                "test_name": e["test_name"],
+                "progress": f"{e['current_q']}/{e['total_q']}",
+                "started_at": e["started_at"],
+                "last_updated": e["last_activity"],
+            }
+            for e in get_live_sessions().for_user(user_id)
+        ]
         
     except Exception as e:
         log.error(f"Failed to get user sessions for {user_id}: {e}")
@@ -2522,61 +2423,29 @@ async def handle_student_error(cb_or_msg, error: Exception, context: str = "oper
 
 def save_test_session(user_id: int, test_id: str, session_data: dict) -> bool:
     """Synchronous wrapper for save_test_session_safe"""
-    import asyncio
     try:
         loop = asyncio.get_event_loop()
         if loop.is_running():
             # If called from async context, create task
-            future = asyncio.ensure_future(save_test_session_safe(user_id, test_id, session_data))
+            asyncio.ensure_future(save_test_session_safe(user_id, test_id, session_data))
             return True  # Return immediately, save happens in background
-        else:
-            # If called from sync context, run until complete
-            return loop.run_until_complete(save_test_session_safe(user_id, test_id, session_data))
+        return get_session_store().write(user_id, test_id, session_data)
     except Exception as e:
         log.error(f"Error in save_test_session wrapper: {e}")
-        # Fallback to simple file write
-        try:
-            session_path = get_session_path(user_id, test_id)
-            session_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(session_path, 'w', encoding='utf-8') as f:
-                json.dump(session_data, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as fallback_error:
-            log.error(f"Fallback save also failed: {fallback_error}")
-            return False
+        return False
 
 def load_test_session(user_id: int, test_id: str) -> Optional[dict]:
     """Synchronous wrapper for load_test_session_safe"""
-    import asyncio
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # Can't run async in already running loop, use sync fallback
-            session_path = get_session_path(user_id, test_id)
-            if not session_path.exists():
-                return None
-            with open(session_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        else:
-            return loop.run_until_complete(load_test_session_safe(user_id, test_id))
+        return get_session_store().read(user_id, test_id)
     except Exception as e:
         log.error(f"Error in load_test_session wrapper: {e}")
         return None
 
 def delete_test_session(user_id: int, test_id: str) -> bool:
     """Synchronous wrapper for delete_test_session_safe"""
-    import asyncio
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # Can't run async in already running loop, use sync fallback
-            session_path = get_session_path(user_id, test_id)
-            if session_path.exists():
-                session_path.unlink()
-                return True
-            return False
-        else:
-            return loop.run_until_complete(delete_test_session_safe(user_id, test_id))
+        return get_session_store().remove(user_id, test_id)
     except Exception as e:
         log.error(f"Error in delete_test_session wrapper: {e}")
         return False
@@ -2762,54 +2631,11 @@ async def get_bot_admin_groups(user_id: int) -> List[int]:
 def get_users_with_active_sessions(max_age_hours: int = 6) -> List[int]:
     """
     Get user IDs who have active test sessions.
-    Only considers sessions updated within max_age_hours.
+    Only considers sessions updated within max_age_hours (live registry,
+    no directory walk).
     """
     try:
-        session_dir = Path("data/sessions")
-        if not session_dir.exists():
-            return []
-        
-        active_users = set()
-        cutoff_time = time.time() - (max_age_hours * 3600)
-        
-        # Check session files
-        for session_file in session_dir.glob("*.json"):
-            try:
-                # Check file modification time first
-                if session_file.stat().st_mtime < cutoff_time:
-                    continue
-                
-                # Parse filename to get user_id
-                # Expecting format: session_<user_id>_<test_id>.json or <user_id>/<test_id>.json
-                if session_file.name.startswith("session_"):
-                    parts = session_file.stem.split("_")
-                    if len(parts) >= 2:
-                        user_id = int(parts[1])
-                        active_users.add(user_id)
-                elif session_file.parent.name.isdigit():
-                    # User directory structure
-                    user_id = int(session_file.parent.name)
-                    active_users.add(user_id)
-            except (ValueError, IndexError, OSError) as e:
-                log.debug(f"Skipping session file {session_file}: {e}")
-                continue
-        
-        # Also check user session directories
-        for user_dir in session_dir.iterdir():
-            if user_dir.is_dir() and user_dir.name.isdigit():
-                try:
-                    user_id = int(user_dir.name)
-                    
-                    # Check if user has any recent session files
-                    for test_session in user_dir.glob("*.json"):
-                        if test_session.stat().st_mtime >= cutoff_time:
-                            active_users.add(user_id)
-                            break
-                except (ValueError, OSError):
-                    continue
-        
-        return sorted(active_users)
-        
+        return get_live_sessions().users(since=time.time() - max_age_hours * 3600)
     except Exception as e:
         log.error(f"Error getting users with active sessions: {e}")
         return []
@@ -2839,21 +2665,15 @@ async def notify_groups_and_members(group_ids: List[int], test_name: str, tid: s
     if not groups:
         return {"groups_notified": 0, "total_notified": 0, "total_failed": 0}
 
-    titles = load_group_titles()
     members_map = load_group_members()  # { "chat_id_str": { "members": [...], "member_data": {...} } }
 
-    groups_notified = 0
-    total_notified = 0
-    total_failed = 0
-
     # Guruh e'lon matni
-    def group_text(title: str) -> str:
-        return (
-            "🟢 <b>Test boshlandi</b>\n\n"
-            f"📚 {test_name}\n"
-            f"🆔 <code>{tid}</code>\n\n"
-            "Imtihonni boshlash uchun: botga yozing yoki /start buyrug‘ini bosing."
-        )
+    group_text = (
+        "🟢 <b>Test boshlandi</b>\n\n"
+        f"📚 {test_name}\n"
+        f"🆔 <code>{tid}</code>\n\n"
+        "Imtihonni boshlash uchun: botga yozing yoki /start buyrug‘ini bosing."
+    )
 
     # DM matni
     user_text = (
@@ -2862,38 +2682,33 @@ async def notify_groups_and_members(group_ids: List[int], test_name: str, tid: s
         "Boshlash: shu botga /start yuboring yoki menyudagi tugmalardan foydalaning."
     )
 
-    for gid in groups:
-        title = titles.get(gid, f"Guruh {gid}")
-
-        # 1) Guruhga xabar
-        try:
-            await bot.send_message(gid, group_text(title), disable_web_page_preview=True)
-            groups_notified += 1
-        except Exception as e:
-            log.warning(f"Group notify failed for {gid}: {e}")
+    from broadcast import get_broadcast_engine
+    engine = get_broadcast_engine()
+    started = int(time.time())
 
-        # 2) A'zolarga DM
-        mems = members_map.get(str(gid), {}).get("members", []) or []
-        # Agar sinxronlanmagan bo‘lsa, shunchaki DM qismi bo‘sh qoladi.
-        # (xohlasang bu yerda fallback sifatida sync chaqirishingiz mumkin)
+    # 1) Guruhlarga xabar
+    group_stats = await engine.run(
+        f"activate_groups_{tid}_{started}", groups, group_text,
+        disable_web_page_preview=True,
+    )
+    for gid in group_stats["failed_ids"]:
+        log.warning(f"Group notify failed for {gid}")
 
-        for uid in mems:
-            try:
-                await bot.send_message(uid, user_text, disable_web_page_preview=True)
-                total_notified += 1
-            except Exception as e:
-                total_failed += 1
-                # Flood limitlarga tushmaslik uchun logni yumshoq qilamiz
-                if total_failed <= 5:
-                    log.debug(f"DM failed for {uid}: {e}")
+    # 2) A'zolarga DM — bir nechta guruhdagi talaba bitta xabar oladi.
+    # Agar sinxronlanmagan bo‘lsa, shunchaki DM qismi bo‘sh qoladi.
+    members = []
+    for gid in groups:
+        members.extend(members_map.get(str(gid), {}).get("members", []) or [])
 
-        # Telegram floodni yumshatamiz
-        await asyncio.sleep(0.2)
+    stats = await engine.run(
+        f"activate_{tid}_{started}", members, user_text,
+        disable_web_page_preview=True,
+    )
 
     return {
-        "groups_notified": groups_notified,
-        "total_notified": total_notified,
-        "total_failed": total_failed,
+        "groups_notified": group_stats["sent"],
+        "total_notified": stats["sent"],
+        "total_failed": stats["failed"],
     }
 
 def get_test_active_groups(test_id: str) -> List[int]: